@@ -0,0 +1,194 @@
+# api/app_logging.py
+# 結構化日誌：請求路徑上只把紀錄放進有界佇列 (佇列滿時丟棄並計數，不等待)，
+# 遮罩、格式化與寫出 stdout 都在背景執行緒完成，nohup 導向檔案時的阻塞 I/O 不再落在事件迴圈上。
+# 大型內容 (LLM 輸出、上游回應) 以 log_payload 抽樣記錄並截短；token、密碼與病患識別資料一律遮罩。
+#
+# 環境變數：
+#   LOG_LEVEL                 日誌等級 (預設 INFO；設為 DEBUG 才會輸出除錯訊息)
+#   LOG_FORMAT                text (預設) 或 json (每行一個 JSON 物件)
+#   LOG_PAYLOAD_SAMPLE_RATE   大型內容的抽樣比例 (預設 0.01)
+#   LOG_PAYLOAD_MAX_CHARS     大型內容最多保留的字元數 (預設 2000)
+#   LOG_CLINICAL_TEXT         是否記錄病歷文字 (LLM 輸出、逐字稿) 原文 (預設 false，只記錄長度；僅供測試環境除錯)
+#   LOG_QUEUE_SIZE            佇列上限 (預設 10000)
+
+import os
+import re
+import sys
+import json
+import queue
+import random
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+from .metrics import Counter, register
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "2000"))
+QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_CLINICAL_TEXT = os.environ.get("LOG_CLINICAL_TEXT", "false").lower() in ("1", "true", "yes")
+
+ROOT_LOGGER_NAME = "new_ui"
+REDACTED = "***"
+
+LOG_RECORDS_DROPPED = register(Counter(
+    "log_records_dropped_total", "日誌佇列已滿而丟棄的紀錄數", ("level",),
+))
+
+
+# --- 遮罩 ---
+# 欄位名稱 (不分大小寫) 屬於以下任一類時，整個值以 *** 取代
+SENSITIVE_FIELDS = frozenset({
+    # 認證資料
+    "password", "token", "access_token", "authorization", "api_key", "openai_api_key", "token_password",
+    # 病患識別資料與病歷內容
+    "name", "ptname", "idno", "birthday", "birth", "phone", "tel", "address", "email",
+    "subjective", "objective", "transcript", "generated_text",
+})
+_TEXT_PATTERNS = (
+    # Authorization 標頭與 Bearer token
+    (re.compile(r"(?i)(bearer\s+)[A-Za-z0-9\-._~+/]+=*"), r"\1" + REDACTED),
+    # JWT (三段 base64url)
+    (re.compile(r"eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+"), REDACTED),
+    # 'password': 'xxx'、api_key=xxx 之類的鍵值
+    (re.compile(r"""(?i)(["']?(?:password|token|api_key|openai_api_key|token_password|authorization)["']?\s*[:=]\s*)(["']?)[^"',\s}]+"""),
+     r"\1\2" + REDACTED),
+    # 身分證字號
+    (re.compile(r"\b[A-Z][12]\d{8}\b"), REDACTED),
+    # 手機號碼
+    (re.compile(r"\b09\d{2}-?\d{3}-?\d{3}\b"), REDACTED),
+)
+
+
+def redact_text(text: str) -> str:
+    for pattern, replacement in _TEXT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_value(value: Any, key: Optional[str] = None) -> Any:
+    """依欄位名稱遮罩整個值 (數值不遮罩，例如各欄位的 token 數)，巢狀的 dict / list 逐層處理，其餘字串套用文字規則"""
+    if key is not None and key.lower() in SENSITIVE_FIELDS and isinstance(value, (str, dict, list, tuple)) and value:
+        return REDACTED
+    if isinstance(value, dict):
+        return {k: redact_value(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact_value(v) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+# --- 格式 ---
+class StructuredFormatter(logging.Formatter):
+    """在背景執行緒中執行：遮罩訊息與欄位後輸出為文字或 JSON"""
+
+    def __init__(self, fmt: str = "text"):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = redact_text(record.getMessage())
+        fields = redact_value(getattr(record, "fields", None) or {})
+        exc_text = redact_text(record.exc_text) if record.exc_text else None
+        timestamp = datetime.datetime.fromtimestamp(record.created).astimezone()
+        logger_name = record.name[len(ROOT_LOGGER_NAME) + 1:] if record.name.startswith(ROOT_LOGGER_NAME + ".") else record.name
+
+        if self.fmt == "json":
+            entry = {
+                "ts": timestamp.isoformat(timespec="milliseconds"),
+                "level": record.levelname,
+                "logger": logger_name,
+                "msg": message,
+                **fields,
+            }
+            if exc_text:
+                entry["exc"] = exc_text
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        line = f"{timestamp:%Y-%m-%d %H:%M:%S} [{record.levelname}] {logger_name}: {message}"
+        if fields:
+            line += " " + " ".join(f"{k}={json.dumps(v, ensure_ascii=False, default=str)}" for k, v in fields.items())
+        if exc_text:
+            line += "\n" + exc_text
+        return line
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """呼叫端只做最少的工作：合併訊息參數、擷取例外堆疊，然後 put_nowait"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # traceback 物件不能跨執行緒保留，在此先轉成文字
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(level=record.levelname)
+
+
+# --- 初始化 ---
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging() -> None:
+    """於 main 啟動時呼叫一次；未呼叫時 (例如命令列工具) 日誌沿用 Python 預設行為"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter(LOG_FORMAT))
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=QUEUE_SIZE)
+    _listener = QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.handlers[:] = [NonBlockingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+
+def shutdown_logging() -> None:
+    """停止背景執行緒並寫出佇列中剩餘的紀錄"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+def log_payload(logger: logging.Logger, message: str, payload: Any, clinical: bool = False, **fields: Any) -> None:
+    """
+    以 DEBUG 等級抽樣記錄大型內容 (例如 LLM 原始輸出)，截短至 LOG_PAYLOAD_MAX_CHARS。
+    clinical 為 True 的內容 (病歷文字) 在未設定 LOG_CLINICAL_TEXT 時只記錄長度。
+    未啟用 DEBUG 或未被抽中時不做任何字串處理。
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= PAYLOAD_SAMPLE_RATE:
+        return
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+    if clinical and not LOG_CLINICAL_TEXT:
+        fields["payload_chars"] = len(text)
+        logger.debug(message, extra={"fields": fields})
+        return
+    if len(text) > PAYLOAD_MAX_CHARS:
+        fields["payload_chars"] = len(text)
+        text = text[:PAYLOAD_MAX_CHARS] + "…"
+    fields["payload"] = text
+    logger.debug(message, extra={"fields": fields})
+
+
+def log_fields(**fields: Any) -> Dict[str, Any]:
+    """logger.info("...", extra=log_fields(user=..., bytes=...)) 的簡寫"""
+    return {"fields": fields}
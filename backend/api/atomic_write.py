@@ -0,0 +1,156 @@
+# api/atomic_write.py
+# 安全寫入：同一檔案的寫入互斥、先寫暫存檔再以 os.replace 原子替換，並可將短時間內的連續寫入合併為一次
+
+import os
+import json
+import asyncio
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from .app_logging import get_logger
+
+logger = get_logger("atomic_write")
+
+# --- 每個檔案一把鎖 ---
+_path_locks: Dict[str, threading.Lock] = {}
+_path_locks_guard = threading.Lock()
+
+
+def get_path_lock(path: str) -> threading.Lock:
+    key = os.path.abspath(str(path))
+    with _path_locks_guard:
+        lock = _path_locks.get(key)
+        if lock is None:
+            lock = _path_locks[key] = threading.Lock()
+        return lock
+
+
+def atomic_write_text(path: str, content: str, encoding: str = "utf-8") -> None:
+    """
+    將內容寫入同目錄下的暫存檔，fsync 後以 os.replace 取代目標檔。
+    讀取端只會看到舊檔或完整的新檔，不會看到寫到一半的內容；同一檔案的寫入依序進行。
+    """
+    path = str(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with get_path_lock(path):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding=encoding) as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def atomic_write_json(path: str, data: Any, indent: Optional[int] = 2) -> None:
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+# --- 合併短時間內的連續寫入 ---
+_MISSING = object()
+
+
+class DeferredWriteError(Exception):
+    """
+    一或多個 key 的寫入失敗。failures 為 {key: 原始錯誤}；
+    待寫內容仍保留在寫入器中，下一次 flush 或該 key 的新 submit 會再嘗試寫入。
+    """
+
+    def __init__(self, failures: Dict[Hashable, BaseException]):
+        super().__init__(f"{len(failures)} 筆寫入失敗: " + "; ".join(str(e) for e in failures.values()))
+        self.failures = failures
+
+
+class CoalescingWriter:
+    """
+    以 key 為單位合併寫入：第一次 submit 後等待 window_seconds，期間同一 key 的後續 submit
+    只會覆蓋待寫內容，時間到才以最後一份內容呼叫一次 write_fn(key, payload)。
+    write_fn 為同步函式，在執行緒池中執行；同一 key 的寫入依序進行。
+    讀取前應先呼叫 flush / flush_where，確保讀到最新內容。
+    寫入失敗時待寫內容放回佇列 (期間若有較新的 submit 則保留較新者) 並記下錯誤；
+    flush / flush_where / raise_failure 會在處理完所有相符的 key 後，以 DeferredWriteError 回報仍未寫入的 key (每次失敗回報一次)。
+    """
+
+    def __init__(self, write_fn: Callable[[Hashable, Any], None], window_seconds: float, name: str = "writer"):
+        self._write_fn = write_fn
+        self.window_seconds = window_seconds
+        self.name = name
+        self._pending: Dict[Hashable, Any] = {}
+        self._timers: Dict[Hashable, asyncio.Task] = {}
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._failures: Dict[Hashable, BaseException] = {}
+
+    async def submit(self, key: Hashable, payload: Any) -> None:
+        if self.window_seconds <= 0:
+            self._pending[key] = payload
+            await self.flush(key)
+            return
+        self._pending[key] = payload
+        if key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    def has_pending(self, key: Hashable) -> bool:
+        return key in self._pending
+
+    async def _flush_later(self, key: Hashable) -> None:
+        await asyncio.sleep(self.window_seconds)
+        if not await self._write(key):
+            # key 可能含使用者名稱與病歷號，不寫入日誌；錯誤會在下一次存取同一 key 時回報
+            logger.error("%s 延遲寫入失敗，待寫內容保留至下次寫入", self.name, exc_info=self._failures.get(key))
+
+    async def _write(self, key: Hashable) -> bool:
+        """寫入 key 的待寫內容；失敗時放回待寫內容、記下錯誤並回傳 False"""
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            timer = self._timers.pop(key, None)
+            if timer is not None and timer is not asyncio.current_task():
+                timer.cancel()
+            payload = self._pending.pop(key, _MISSING)
+            if payload is _MISSING:
+                return True
+            try:
+                await run_in_threadpool(self._write_fn, key, payload)
+            except Exception as e:
+                self._pending.setdefault(key, payload)
+                self._failures[key] = e
+                return False
+            # 待寫內容已寫入，先前的失敗不必再回報
+            self._failures.pop(key, None)
+            return True
+
+    def _raise_failures(self, keys) -> None:
+        failures = {key: self._failures.pop(key) for key in keys if key in self._failures}
+        if failures:
+            raise DeferredWriteError(failures)
+
+    def raise_failure(self, key: Hashable) -> None:
+        """若指定 key 先前的寫入失敗且尚未重試成功，拋出 DeferredWriteError (每次失敗只回報一次)"""
+        self._raise_failures([key])
+
+    async def flush(self, key: Hashable) -> None:
+        """立即寫入指定 key 的待寫內容 (若有)；本次或先前的寫入失敗以 DeferredWriteError 拋出"""
+        if key in self._pending:
+            await self._write(key)
+        self._raise_failures([key])
+
+    async def flush_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        # 每個 key 都嘗試寫入，一筆失敗不會擋住其他紀錄；最後一併回報所有失敗的 key
+        for key in [k for k in self._pending if predicate(k)]:
+            await self._write(key)
+        self._raise_failures([k for k in self._failures if predicate(k)])
+
+    async def flush_all(self) -> None:
+        """關閉前寫入所有待寫內容；失敗時只記錄日誌"""
+        for key in list(self._pending):
+            await self._write(key)
+        for error in self._failures.values():
+            logger.error("%s 寫入失敗", self.name, exc_info=error)
+        self._failures.clear()
@@ -0,0 +1,291 @@
+# api/audio_processing.py
+# 音訊正規化：依檔頭判斷實際編碼，PCM 以 NumPy 原生重取樣，壓縮格式才交給 ffmpeg (pydub)
+
+import io
+import struct
+import wave
+from typing import Optional, Tuple
+
+from pydantic import BaseModel
+
+from .app_logging import get_logger, log_fields
+
+logger = get_logger("audio")
+
+# --- 選用依賴：NumPy (PCM 原生處理) ---
+try:
+    import numpy as np
+except ImportError:
+    logger.warning("numpy 未安裝。PCM 音訊的原生重取樣將不可用，改以 ffmpeg (pydub) 處理。請運行: pip install numpy")
+    np = None
+
+# --- 選用依賴：pydub (ffmpeg，用於壓縮格式) ---
+try:
+    from pydub import AudioSegment
+except ImportError:
+    logger.error("pydub 庫未安裝。音訊格式轉換功能將不可用。請運行: pip install pydub，並確保您的系統已安裝 ffmpeg。")
+    AudioSegment = None
+
+# Whisper 模型本身即以 16kHz 單聲道運作，送出更高取樣率只會增加上傳量
+WHISPER_SAMPLE_RATE = 16000
+
+# 檔頭偵測到的容器格式 -> pydub/ffmpeg 的 format 名稱
+FFMPEG_FORMATS = {
+    "webm": "webm",
+    "matroska": "matroska",
+    "mp4": "mp4",
+    "ogg": "ogg",
+    "mp3": "mp3",
+    "flac": "flac",
+    "wav": "wav",
+}
+
+# 低通濾波器的 tap 數 (Hann 視窗 sinc)，越大過渡帶越窄
+_LOWPASS_TAPS = 63
+
+
+class AudioInfo(BaseModel):
+    """由檔頭解析出的音訊資訊"""
+    container: str  # "wav"、"webm"、"mp4"、"ogg"、"mp3"、"flac" 或 "unknown"
+    codec: str  # 例如 "pcm_s16le"、"pcm_f32le"、"opus"、"aac"
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+    bits_per_sample: Optional[int] = None
+    data_offset: Optional[int] = None  # WAV data chunk 的起始位置
+    data_size: Optional[int] = None  # WAV data chunk 的大小 (bytes)
+
+    @property
+    def is_pcm(self) -> bool:
+        return self.container == "wav" and self.codec.startswith("pcm_")
+
+
+# --- 檔頭偵測 ---
+def _sniff_wav(data: bytes) -> AudioInfo:
+    """解析 RIFF/WAVE 檔頭，逐一走訪 chunk 取得 fmt 與 data 的資訊"""
+    info = AudioInfo(container="wav", codec="unknown")
+    pos = 12
+    format_tag = None
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+        body_start = pos + 8
+        if chunk_id == b"fmt " and chunk_size >= 16:
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack(
+                "<HHIIHH", data[body_start:body_start + 16]
+            )
+            # WAVE_FORMAT_EXTENSIBLE：實際格式在 SubFormat GUID 的前兩個 bytes
+            if format_tag == 0xFFFE and chunk_size >= 26:
+                format_tag = struct.unpack("<H", data[body_start + 24:body_start + 26])[0]
+            info.channels = channels
+            info.sample_rate = sample_rate
+            info.bits_per_sample = bits
+        elif chunk_id == b"data":
+            info.data_offset = body_start
+            # 串流錄音常把 data 大小寫成 0 或 0xFFFFFFFF，此時以檔案剩餘長度為準
+            available = len(data) - body_start
+            info.data_size = chunk_size if 0 < chunk_size <= available else available
+            break
+        # chunk 大小為奇數時有一個 padding byte
+        pos = body_start + chunk_size + (chunk_size & 1)
+
+    if format_tag == 1 and info.bits_per_sample in (8, 16, 24, 32):
+        info.codec = "pcm_u8" if info.bits_per_sample == 8 else f"pcm_s{info.bits_per_sample}le"
+    elif format_tag == 3 and info.bits_per_sample in (32, 64):
+        info.codec = f"pcm_f{info.bits_per_sample}le"
+    elif format_tag is not None:
+        info.codec = f"wav_0x{format_tag:04x}"
+    return info
+
+
+def sniff_audio_header(data: bytes) -> AudioInfo:
+    """
+    依檔案開頭的 magic bytes 判斷實際容器與編碼，不信任瀏覽器送來的 MIME 類型。
+    """
+    head = data[:64]
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return _sniff_wav(data)
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        # EBML：webm 或 matroska，編碼名稱 (A_OPUS 等) 位於 Tracks 元素內
+        probe = data[:4096]
+        container = "webm" if b"webm" in probe else "matroska"
+        codec = "opus" if b"A_OPUS" in probe else "vorbis" if b"A_VORBIS" in probe else "unknown"
+        return AudioInfo(container=container, codec=codec)
+    if head[4:8] == b"ftyp":
+        return AudioInfo(container="mp4", codec="aac")
+    if head[:4] == b"OggS":
+        probe = data[:512]
+        codec = "opus" if b"OpusHead" in probe else "vorbis" if b"vorbis" in probe else "unknown"
+        return AudioInfo(container="ogg", codec=codec)
+    if head[:4] == b"fLaC":
+        return AudioInfo(container="flac", codec="flac")
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+        return AudioInfo(container="mp3", codec="mp3")
+    return AudioInfo(container="unknown", codec="unknown")
+
+
+# --- PCM 原生處理 (NumPy) ---
+def decode_pcm_wav(data: bytes, info: AudioInfo) -> "np.ndarray":
+    """將 WAV 的 PCM 資料解碼為 float32 陣列，形狀為 (frames, channels)，範圍 [-1, 1]"""
+    raw = data[info.data_offset:info.data_offset + info.data_size]
+    channels = info.channels or 1
+    width = info.bits_per_sample // 8
+    usable = len(raw) - (len(raw) % (width * channels))
+    raw = raw[:usable]
+
+    if info.codec == "pcm_u8":
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif info.codec == "pcm_s16le":
+        samples = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+    elif info.codec == "pcm_s24le":
+        # 24-bit 沒有對應的 dtype：補一個低位 byte 後以 int32 解讀，再右移還原正負號
+        triples = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((triples.shape[0], 4), dtype=np.uint8)
+        padded[:, 1:] = triples
+        samples = (padded.view("<i4").reshape(-1) >> 8).astype(np.float32) / 8388608.0
+    elif info.codec == "pcm_s32le":
+        samples = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2147483648.0
+    elif info.codec == "pcm_f32le":
+        samples = np.frombuffer(raw, dtype="<f4").astype(np.float32)
+    elif info.codec == "pcm_f64le":
+        samples = np.frombuffer(raw, dtype="<f8").astype(np.float32)
+    else:
+        raise ValueError(f"不支援的 PCM 編碼: {info.codec}")
+
+    return samples.reshape(-1, channels)
+
+
+def downmix_to_mono(samples: "np.ndarray") -> "np.ndarray":
+    """多聲道取平均混成單聲道"""
+    if samples.ndim == 1:
+        return samples
+    if samples.shape[1] == 1:
+        return samples[:, 0]
+    return samples.mean(axis=1, dtype=np.float32)
+
+
+def _lowpass_kernel(cutoff_ratio: float) -> "np.ndarray":
+    """Hann 視窗 sinc 低通濾波器，cutoff_ratio 為截止頻率相對於取樣率的比例 (0~0.5)"""
+    n = np.arange(_LOWPASS_TAPS) - (_LOWPASS_TAPS - 1) / 2
+    kernel = 2 * cutoff_ratio * np.sinc(2 * cutoff_ratio * n) * np.hanning(_LOWPASS_TAPS)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def resample(samples: "np.ndarray", src_rate: int, dst_rate: int) -> "np.ndarray":
+    """
+    單聲道重取樣。降頻時先以 FIR 低通濾除新 Nyquist 以上的頻率避免混疊，
+    再以線性內插取出目標時間點；整數倍降頻 (48k/32k -> 16k) 時內插點恰好落在原樣本上。
+    """
+    if src_rate == dst_rate or samples.size == 0:
+        return samples
+    if dst_rate < src_rate:
+        samples = np.convolve(samples, _lowpass_kernel(0.5 * dst_rate / src_rate), mode="same")
+    out_length = int(round(samples.size * dst_rate / src_rate))
+    positions = np.arange(out_length, dtype=np.float64) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(samples.size), samples).astype(np.float32)
+
+
+def to_int16(samples: "np.ndarray") -> "np.ndarray":
+    return (np.clip(samples, -1.0, 1.0) * 32767.0).astype("<i2")
+
+
+def encode_wav_pcm16(samples_int16: "np.ndarray", sample_rate: int) -> bytes:
+    """將單聲道 int16 樣本封裝為 WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples_int16.tobytes())
+    return buffer.getvalue()
+
+
+def _normalize_pcm_natively(data: bytes, info: AudioInfo, target_rate: int) -> bytes:
+    samples = downmix_to_mono(decode_pcm_wav(data, info))
+    samples = resample(samples, info.sample_rate, target_rate)
+    return encode_wav_pcm16(to_int16(samples), target_rate)
+
+
+# --- 壓縮格式 (ffmpeg) ---
+def _normalize_with_ffmpeg(data: bytes, info: AudioInfo, target_format: str, target_rate: int) -> bytes:
+    ffmpeg_format = FFMPEG_FORMATS.get(info.container)
+    if ffmpeg_format:
+        audio_segment = AudioSegment.from_file(io.BytesIO(data), format=ffmpeg_format)
+    else:
+        # 未知容器：讓 ffmpeg 自行探測
+        audio_segment = AudioSegment.from_file(io.BytesIO(data))
+    logger.debug("pydub 成功讀取原始音訊", extra=log_fields(
+        container=info.container, codec=info.codec, seconds=round(audio_segment.duration_seconds, 2),
+        frame_rate=audio_segment.frame_rate, channels=audio_segment.channels,
+    ))
+
+    audio_segment = audio_segment.set_frame_rate(target_rate).set_channels(1).set_sample_width(2)
+
+    export_params = {}
+    if target_format == "wav":
+        export_params['codec'] = "pcm_s16le"  # 確保使用兼容性最好的 PCM
+    elif target_format == "mp3":
+        export_params['codec'] = "libmp3lame"
+
+    output_buffer = io.BytesIO()
+    audio_segment.export(output_buffer, format=target_format, **export_params)
+    return output_buffer.getvalue()
+
+
+def is_already_normalized(info: AudioInfo, target_rate: int) -> bool:
+    return info.codec == "pcm_s16le" and info.channels == 1 and info.sample_rate == target_rate
+
+
+def _extension_from_mime(mime: str) -> str:
+    # 例如 "audio/webm;codecs=opus" -> "webm"、"audio/x-m4a" -> "m4a"
+    return mime.split('/')[-1].split(';')[0].replace('x-', '') if '/' in mime else "bin"
+
+
+def normalize_audio(
+    data: bytes,
+    declared_format: str,
+    target_format: str = "wav",
+    target_rate: int = WHISPER_SAMPLE_RATE,
+) -> Tuple[bytes, str, str, AudioInfo]:
+    """
+    將任意上傳音訊正規化為 Whisper 所需的格式。
+    回傳 (音訊內容, MIME 類型, 副檔名, 原始音訊資訊)。
+
+    - 已是 16kHz 單聲道 16-bit PCM WAV：原樣送出，不做任何處理
+    - 其他 PCM WAV 且目標為 wav：以 NumPy 降混與重取樣，不啟動 ffmpeg
+    - 壓縮格式 (webm/opus、m4a、ogg、mp3、flac) 或非 wav 目標：交給 ffmpeg
+    - 無可用轉換方式或轉換失敗：以上傳時宣告的 MIME 類型原樣送出
+    """
+    info = sniff_audio_header(data)
+    logger.debug("音訊檔頭偵測結果", extra=log_fields(
+        container=info.container, codec=info.codec, sample_rate=info.sample_rate, channels=info.channels,
+    ))
+
+    original_mime = declared_format
+    original_ext = _extension_from_mime(declared_format)
+
+    if target_format == "wav" and is_already_normalized(info, target_rate):
+        logger.debug("音訊已符合 Whisper 目標格式，直接發送。")
+        return data, "audio/wav", "wav", info
+
+    try:
+        if target_format == "wav" and info.is_pcm and info.data_offset is not None and np is not None:
+            converted = _normalize_pcm_natively(data, info, target_rate)
+            logger.debug("以 NumPy 將 PCM 音訊轉為 %dHz 單聲道。新大小: %d bytes (原 %d bytes)", target_rate, len(converted), len(data))
+        elif AudioSegment is not None:
+            converted = _normalize_with_ffmpeg(data, info, target_format, target_rate)
+            logger.debug("以 ffmpeg 將 %s/%s 音訊轉為 %s。新大小: %d bytes (原 %d bytes)", info.container, info.codec, target_format, len(converted), len(data))
+        else:
+            logger.warning("無可用的轉換方式 (numpy/pydub)，將以原始 %s 格式發送。", info.container)
+            return data, original_mime, original_ext, info
+    except Exception as e:
+        logger.exception(
+            "音訊轉換失敗 (%s/%s -> %s): %s。將以原始格式繼續發送請求，但這可能導致地端服務錯誤。",
+            info.container, info.codec, target_format, e,
+        )
+        return data, original_mime, original_ext, info
+
+    if not converted:
+        logger.warning("轉換後的音訊內容為空，原始大小: %d bytes。", len(data))
+        return data, original_mime, original_ext, info
+
+    return converted, f"audio/{target_format}", target_format, info
@@ -4,17 +4,25 @@ import os
 import json
 import httpx
 import re
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
 from pydantic import BaseModel
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-import traceback 
 
 from .custom_template import get_current_username, get_auth_token, load_llm_config, auth_token_cache 
 from .voice_api import perform_actual_speech_to_text_conversion
+from .prompt_templates import CompiledTemplate, get_compiled_template, template_type_for
+from .prompt_builder import (
+    BuiltPrompt, GenerationPlan, assemble, estimate_tokens, generation_limits, is_output_complete, prefix_cache_monitor,
+)
+from .model_router import apply_route, route_stats_snapshot, select_route, track_route
+from .metrics import record_token_usage, time_stage, track_upstream
+from .app_logging import get_logger, log_fields, log_payload
 
 # --- 設定 ---
 router = APIRouter()
+logger = get_logger("chat")
 auth_token_cache = {"token": None}
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
@@ -31,23 +39,25 @@ async def get_auth_token():
     config = load_llm_config()
     login_data = {"account": config.get("token_account"), "password": config.get("token_password")} 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(config.get("token_url"), data=login_data)
+        with track_upstream("token") as call:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(config.get("token_url"), data=login_data)
+            call.status = response.status_code
         response.raise_for_status()
         token = response.json().get("data", {}).get("token")
         if not token:
-            print("[ERROR] 從中控台取得的 Token 為空")
+            logger.error("從中控台取得的 Token 為空")
             raise HTTPException(status_code=500, detail="從中控台取得的 Token 為空")
         auth_token_cache["token"] = token
         return token
     except httpx.HTTPStatusError as e:
-        print(f"[ERROR] 認證服務 HTTP 錯誤: {e.response.status_code} - {e.response.text}")
+        logger.error("認證服務 HTTP 錯誤: %s - %s", e.response.status_code, e.response.text)
         raise HTTPException(status_code=500, detail=f"認證服務回應錯誤: {e.response.status_code} - {e.response.text}")
     except httpx.RequestError as e:
-        print(f"[ERROR] 認證服務網路請求錯誤: {e}")
+        logger.error("認證服務網路請求錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"無法連線至認證服務: {e}")
     except Exception as e:
-        print(f"[ERROR] 認證服務發生未知錯誤: {e}")
+        logger.error("認證服務發生未知錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"認證服務發生未知錯誤: {e}")
 
 # --- 輔助函式：判斷是否應該移除某一行 (最終修訂版，修正組索引) ---
@@ -137,7 +147,7 @@ def should_remove_line(line: str) -> bool:
             
             # 如果標題後的內容是無意義的，並且該行被解析為一個模板行，則移除
             if is_meaningless:
-                print(f"[DEBUG_REMOVE] 移除空數據模板行: '{original_line_stripped}'")
+                logger.debug("移除空數據模板行: %r", original_line_stripped)
                 return True
             else:
                 # 如果找到標題且內容有意義，則這行不應該被移除
@@ -146,181 +156,374 @@ def should_remove_line(line: str) -> bool:
     # --- 額外處理：對於那些沒有明確模板標題的行，直接檢查是否為「無意義」內容 ---
     for meaningless_pattern in meaningless_content_patterns:
         if re.fullmatch(meaningless_pattern, original_line_stripped, re.IGNORECASE):
-            print(f"[DEBUG_REMOVE] 移除獨立的無意義行: '{original_line_stripped}'")
+            logger.debug("移除獨立的無意義行: %r", original_line_stripped)
             return True
 
     # 如果以上條件都不滿足，則認為這行有實際意義，不移除
     return False
 
-# --- handle_generate 函式 (其餘部分保持不變) ---
-@router.post("/generate") 
-async def handle_generate(
-    req: GenerateRequest,
-    current_user: str = Depends(get_current_username)
-):
-    config = load_llm_config()
-    llm_api_url = config.get("openai_api_base")
-    llm_model = config.get("llm_model")
-
-    if not llm_api_url or not llm_model:
-        raise HTTPException(status_code=500, detail="LLM 設定不完整")
-
-    template_type = 'subjective' if req.type == 'FillTemplate' else 'objective'
-    template_file_path = os.path.join(DATA_DIR, current_user, f"{template_type}_question.txt")
-
-    custom_prompt_template = ""
-    if os.path.exists(template_file_path):
-        with open(template_file_path, "r", encoding="utf-8") as f:
-            custom_prompt_template = f.read()
-
-    messages = []
-
-    if req.type == 'FillTemplate':
-        DEFAULT_SUBJECTIVE_TEMPLATE_STRUCTURE = (
-            "Chief Complaint:[]\n"
-            "History of Present Illness:[]\n"
-            "Past Medical History:[]\n"
-            "Surgical History:[]\n"
-            "Family History:[]\n"
-            "Medication History:[]\n"
-            "Allergy History:[]\n"
-            "Social History:[]\n"
-            "Sexual/Reproductive History:[]\n"
-            "Review of Systems:[]"
-        )
-        DEFAULT_FILLTEMPLATE_SYSTEM_PROMPT = (
-            "您是一個高效、自動化的醫療表單填充機器人，您的**唯一且絕對的任務**是**精確填寫**提供的「主觀病歷模板」中的**所有方括號 `[]`。**\n"
-            "請**逐字逐句，嚴格按照**下方「參考主觀數據」部分提供的資訊來填充，**絕不能使用任何外部知識，絕不能生成任何新內容，絕不能推斷。**\n" 
-            "**絕對不要添加任何「參考數據」中未明確提及或無法直接推斷的額外詞語或概念。**\n" 
-            "**如果資訊不存在或不明確，請在方括號 `[]` 中填入「無資料」（英文 \"no data\"），或保持空白。系統將會自動移除這些不包含實際數據的行。**\n" 
-            "**您的輸出內容必須且僅限於** 填寫好的主觀病歷模板內容本身，**別無他物。**"
-            "**絕對嚴禁包含任何引言、結論、解釋、額外文字、預設標題（例如 'Chief complaint:'）、額外區塊，以及任何 Markdown 格式。**\n"
-            "請務必保持模板的**原始行數、原始排版和方括號 `[]` 的原始格式**。\n"
-            "**絕對絕對不要重複輸出病歷模板的標題**，例如 'Chief complaint:' 等，這些已經是模板的一部分，您的任務只是填充。\n"
-            "**所有填充內容必須嚴格使用英文。**\n"
-            "**再次強調，您的輸出內容必須僅是提供的模板內容本身，不含任何其他字符或信息。**"
-        )
-        
-        messages.append({"role": "system", "content": DEFAULT_FILLTEMPLATE_SYSTEM_PROMPT})
+# --- 預設模板與系統提示詞 ---
+DEFAULT_SUBJECTIVE_TEMPLATE_STRUCTURE = (
+    "Chief Complaint:[]\n"
+    "History of Present Illness:[]\n"
+    "Past Medical History:[]\n"
+    "Surgical History:[]\n"
+    "Family History:[]\n"
+    "Medication History:[]\n"
+    "Allergy History:[]\n"
+    "Social History:[]\n"
+    "Sexual/Reproductive History:[]\n"
+    "Review of Systems:[]"
+)
+DEFAULT_FILLTEMPLATE_SYSTEM_PROMPT = (
+    "您是一個高效、自動化的醫療表單填充機器人，您的**唯一且絕對的任務**是**精確填寫**提供的「主觀病歷模板」中的**所有方括號 `[]`。**\n"
+    "請**逐字逐句，嚴格按照**下方「參考主觀數據」部分提供的資訊來填充，**絕不能使用任何外部知識，絕不能生成任何新內容，絕不能推斷。**\n" 
+    "**絕對不要添加任何「參考數據」中未明確提及或無法直接推斷的額外詞語或概念。**\n" 
+    "**如果資訊不存在或不明確，請在方括號 `[]` 中填入「無資料」（英文 \"no data\"），或保持空白。系統將會自動移除這些不包含實際數據的行。**\n" 
+    "**您的輸出內容必須且僅限於** 填寫好的主觀病歷模板內容本身，**別無他物。**"
+    "**絕對嚴禁包含任何引言、結論、解釋、額外文字、預設標題（例如 'Chief complaint:'）、額外區塊，以及任何 Markdown 格式。**\n"
+    "請務必保持模板的**原始行數、原始排版和方括號 `[]` 的原始格式**。\n"
+    "**絕對絕對不要重複輸出病歷模板的標題**，例如 'Chief complaint:' 等，這些已經是模板的一部分，您的任務只是填充。\n"
+    "**所有填充內容必須嚴格使用英文。**\n"
+    "**再次強調，您的輸出內容必須僅是提供的模板內容本身，不含任何其他字符或信息。**"
+)
+DEFAULT_SOAP_TEMPLATE_STRUCTURE = (
+    "1. Vital Signs:[]\n"
+    "2. General Appearance:[]\n"
+    "3. Physical Examination:[]\n"
+    "4. Diagnostic Test Results:[]\n"
+    "5. Imaging or Instrumentation Findings:[]\n"
+    "6. Procedure Done:[]\n"
+    "7. Others:[]"
+)
+STRICT_SYSTEM_PROMPT = (
+    "您是一個高效、自動化的醫療表單填充機器人，您的**唯一且絕對的任務**是**精確填寫**提供的病歷模板中的**所有方括號 `[]`。**\n"
+    "請**逐字逐句，嚴格按照**下方「參考數據」部分提供的資訊來填充，**絕不能使用任何外部知識，絕不能生成任何新內容，絕不能推斷。**\n" 
+    "**絕對不要添加任何「參考數據」中未明確提及或無法直接推斷的額外詞語或概念。**\n" 
+    "**如果資訊不存在或不明確，請在方括號 `[]` 中填入「無資料」（英文 \"no data\"），或保持空白。系統將會自動移除這些不包含實際數據的行。**\n" 
+    "**您的輸出內容必須且僅限於** 填寫好的病歷模板內容本身，**別無他物。**"
+    "**絕對嚴禁包含任何引言、結論、解釋、額外文字、預設標題（例如 'Chief Complaint:'）、額外區塊（例如『Next Steps』、『Planned Investigations』、『Additional Information』、『Additional Notes』、『Patient Education』、『Follow-Up』、『Additional Considerations』、『Current Status』等），以及任何 Markdown 格式（例如粗體符號 `**`、井字號 `#`、列表符號 `- *`、縮進等）。**\n"
+    "請務必保持模板的**原始行數、原始排版和方括號 `[]` 的原始格式**。\n"
+    "**絕對絕對不要重複輸出病歷模板的標題**，例如 'Chief Complaint:'、'Infertility for:' 等，這些已經是模板的一部分，您的任務只是填充。\n"
+    "**所有填充內容必須嚴格使用英文。**\n"
+    "**再次強調，您的輸出內容必須僅是提供的模板內容本身，不含任何其他字符或信息。**" 
+)
+
+GENERATION_TYPES = ("FillTemplate", "SOAP")
+
+
+# --- 輔助函式：取得使用者自定義提示詞 (已編譯、快取於記憶體，見 prompt_templates) ---
+def load_user_prompt_template(username: str, generation_type: str) -> Optional[CompiledTemplate]:
+    """未設定範本時回傳 None"""
+    return get_compiled_template(username, template_type_for(generation_type))
+
+
+# --- 輔助函式：組合送往 LLM 的 messages ---
+# 自定義範本中的 [subjective]/[objective] 改為指向參考資料區塊的說明，主客觀內容只在參考資料區塊出現一次
+FILLTEMPLATE_PLACEHOLDER_TEXT = {"subjective": "（見下方「參考主觀數據」）"}
+SOAP_PLACEHOLDER_TEXT = {
+    "subjective": "（見下方「參考數據」的主觀資訊）",
+    "objective": "（見下方「參考數據」的客觀資訊）",
+}
+
+
+def build_generation_messages(
+    generation_type: str,
+    subjective: str,
+    objective: str,
+    custom_prompt_template: Optional[CompiledTemplate],
+    current_user: str,
+    config: Dict[str, Any],
+) -> BuiltPrompt:
+    """
+    系統指令只放一次，使用者訊息為「範本 + 參考資料」。超出 config 中的 context 預算時截短過長的主客觀內容。
+    """
+    context_tokens, max_tokens = generation_limits(config)
 
+    if generation_type == 'FillTemplate':
         if custom_prompt_template:
-            processed_template = custom_prompt_template.replace('[subjective]', '{subjective}')
-            
-            messages.append({"role": "user", "content": (
-                f"{processed_template.format(subjective=req.subjective)}\n" 
-                f"\n--- 參考主觀數據 ---\n" 
-                f"{req.subjective}"
-            )})
-            print(f"[DEBUG] 使用者 {current_user} 的 'FillTemplate' 自定義提示詞 (包含主觀資訊佔位符，將使用嚴格系統指令進行填充)。")
+            template_text = custom_prompt_template.fill(**FILLTEMPLATE_PLACEHOLDER_TEXT)
         else:
-            messages.append({"role": "user", "content": (
-                f"{DEFAULT_SUBJECTIVE_TEMPLATE_STRUCTURE}\n" 
-                f"\n--- 參考主觀數據 ---\n" 
-                f"{req.subjective}" 
-            )})
-            print(f"[DEBUG] 使用者 {current_user} 未設定 'FillTemplate' 自定義提示詞，將使用結構化預設提示詞。")
-
-    elif req.type == 'SOAP':
-        DEFAULT_SOAP_TEMPLATE_STRUCTURE = (
-            "1. Vital Signs:[]\n"
-            "2. General Appearance:[]\n"
-            "3. Physical Examination:[]\n"
-            "4. Diagnostic Test Results:[]\n"
-            "5. Imaging or Instrumentation Findings:[]\n"
-            "6. Procedure Done:[]\n"
-            "7. Others:[]"
+            template_text = DEFAULT_SUBJECTIVE_TEMPLATE_STRUCTURE
+        prompt = assemble(
+            DEFAULT_FILLTEMPLATE_SYSTEM_PROMPT, template_text, "--- 參考主觀數據 ---",
+            [("subjective", None, subjective)],
+            context_tokens, max_tokens,
         )
-
-        STRICT_SYSTEM_PROMPT = (
-            "您是一個高效、自動化的醫療表單填充機器人，您的**唯一且絕對的任務**是**精確填寫**提供的病歷模板中的**所有方括號 `[]`。**\n"
-            "請**逐字逐句，嚴格按照**下方「參考數據」部分提供的資訊來填充，**絕不能使用任何外部知識，絕不能生成任何新內容，絕不能推斷。**\n" 
-            "**絕對不要添加任何「參考數據」中未明確提及或無法直接推斷的額外詞語或概念。**\n" 
-            "**如果資訊不存在或不明確，請在方括號 `[]` 中填入「無資料」（英文 \"no data\"），或保持空白。系統將會自動移除這些不包含實際數據的行。**\n" 
-            "**您的輸出內容必須且僅限於** 填寫好的病歷模板內容本身，**別無他物。**"
-            "**絕對嚴禁包含任何引言、結論、解釋、額外文字、預設標題（例如 'Chief Complaint:'）、額外區塊（例如『Next Steps』、『Planned Investigations』、『Additional Information』、『Additional Notes』、『Patient Education』、『Follow-Up』、『Additional Considerations』、『Current Status』等），以及任何 Markdown 格式（例如粗體符號 `**`、井字號 `#`、列表符號 `- *`、縮進等）。**\n"
-            "請務必保持模板的**原始行數、原始排版和方括號 `[]` 的原始格式**。\n"
-            "**絕對絕對不要重複輸出病歷模板的標題**，例如 'Chief Complaint:'、'Infertility for:' 等，這些已經是模板的一部分，您的任務只是填充。\n"
-            "**所有填充內容必須嚴格使用英文。**\n"
-            "**再次強調，您的輸出內容必須僅是提供的模板內容本身，不含任何其他字符或信息。**" 
-        )
-
+    elif generation_type == 'SOAP':
         if custom_prompt_template:
-            processed_template = custom_prompt_template.replace('[subjective]', '{subjective}')
-            processed_template = processed_template.replace('[objective]', '{objective}')
-
-            messages.append({"role": "system", "content": STRICT_SYSTEM_PROMPT}) 
-
-            if '{subjective}' in processed_template and '{objective}' in processed_template:
-                messages.append({"role": "user", "content": (
-                    f"{processed_template.format(subjective=req.subjective, objective=req.objective)}\n"
-                    f"\n--- 參考數據 ---\n" 
-                    f"主觀資訊:\n{req.subjective}\n\n" 
-                    f"客觀資訊:\n{req.objective}"
-                )})
-                print(f"[DEBUG] 使用者 {current_user} 的 'SOAP' 自定義提示詞 (包含主客觀資訊佔位符，使用嚴格系統指令)")
-            else:
-                messages.append({"role": "system", "content": STRICT_SYSTEM_PROMPT})
-                messages.append({"role": "user", "content": (
-                    f"{processed_template}\n"
-                    f"\n--- 參考數據 ---\n"
-                    f"主觀資訊:\n{req.subjective}\n\n"
-                    f"客觀資訊:\n{req.objective}"
-                )})
-                print(f"[DEBUG] 使用者 {current_user} 的 'SOAP' 自定義提示詞 (不包含所有必要佔位符，使用嚴格系統指令)，將主客觀資訊附加到末尾。")
+            template_text = custom_prompt_template.fill(**SOAP_PLACEHOLDER_TEXT)
         else:
-            messages.append({"role": "system", "content": STRICT_SYSTEM_PROMPT})
-            messages.append({"role": "user", "content": (
-                f"{DEFAULT_SOAP_TEMPLATE_STRUCTURE}\n" 
-                f"\n--- 參考數據 ---\n" 
-                f"主觀資訊:\n{req.subjective}\n\n" 
-                f"客觀資訊:\n{req.objective}" 
-            )})
-            print(f"[DEBUG] 使用者 {current_user} 未設定 'SOAP' 自定義提示詞，將使用結構化預設提示詞。")
-
+            template_text = DEFAULT_SOAP_TEMPLATE_STRUCTURE
+        prompt = assemble(
+            STRICT_SYSTEM_PROMPT, template_text, "--- 參考數據 ---",
+            [("subjective", "主觀資訊:", subjective), ("objective", "客觀資訊:", objective)],
+            context_tokens, max_tokens,
+        )
     else:
         raise HTTPException(status_code=400, detail="無效的生成類型")
 
+    logger.debug("組合生成提示詞", extra=log_fields(
+        user=current_user, type=generation_type, route=config.get("llm_route", "default"),
+        custom_template=bool(custom_prompt_template), estimated_tokens=prompt.estimated_tokens,
+        section_tokens=prompt.section_tokens, prefix_share=round(prompt.prefix_share, 3),
+        max_tokens=prompt.generation.max_tokens, truncated=prompt.truncated,
+    ))
+    return prompt
+
+
+# --- 輔助函式：呼叫 LLM 並做後處理 ---
+async def _stream_completion(
+    client: httpx.AsyncClient,
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    plan: Optional[GenerationPlan],
+) -> httpx.Response:
+    """
+    以串流方式呼叫上游，逐段累積輸出；範本最後一行完成時提前關閉連線 (vLLM 會隨之中止該請求，不再花時間解碼)。
+    回傳的 Response 已讀完或已關閉，輸出內容與 usage 放在 response.extensions["completion"]。
+    提前結束時收不到最後的 usage 區塊，usage 只含本地計算的 completion_tokens (vLLM 每個串流區塊約為一個 token)。
+    """
+    async with client.stream("POST", url, json=payload, headers=headers) as response:
+        if response.status_code >= 400:
+            await response.aread()
+            return response
+        parts = []
+        usage = {}
+        content_chunks = 0
+        finished_early = False
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content") or ""
+                if content:
+                    parts.append(content)
+                    content_chunks += 1
+            if plan is not None and is_output_complete("".join(parts), plan):
+                finished_early = True
+                usage = {"completion_tokens": content_chunks}
+                break
+        response.extensions["completion"] = {"content": "".join(parts), "usage": usage, "finished_early": finished_early}
+        return response
+
+
+async def generate_from_messages(
+    messages: List[Dict[str, str]],
+    config: Dict[str, Any],
+    on_usage: Optional[Callable[[Dict[str, Any]], None]] = None,
+    plan: Optional[GenerationPlan] = None,
+) -> str:
+    """
+    on_usage：收到上游回應時以其 usage 欄位呼叫 (量測用，例如前綴快取命中率)；
+    串流提前結束時上游沒有回報 usage，改以 None 呼叫，避免以不完整的數字計入命中率。
+    plan：依範本結構決定的 max_tokens 與停止字串 (見 prompt_builder.plan_generation)。
+    config 的 llm_streaming 為 true (預設) 時以串流呼叫，範本的最後一行產生後即結束。
+    """
+    llm_api_url = config.get("openai_api_base")
+    llm_model = config.get("llm_model")
+    streaming = config.get("llm_streaming", True)
+
     try:
         auth_token = await get_auth_token()
-        payload = {"model": llm_model, "messages": messages, "max_tokens": 1024, "temperature": 0.5} 
+        _, max_tokens = generation_limits(config)
+        payload = {"model": llm_model, "messages": messages, "max_tokens": max_tokens, "temperature": 0.5} 
+        if plan is not None:
+            payload["max_tokens"] = plan.max_tokens
+            if plan.stop:
+                payload["stop"] = plan.stop
+        if streaming:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
         headers = {"Authorization": f"Bearer {auth_token}", "Content-Type": "application/json"}
 
         async with httpx.AsyncClient(timeout=120.0) as client:
-             llm_response = await client.post(llm_api_url, json=payload, headers=headers)
-
-        if llm_response.status_code == 401:
-            print("[DEBUG] LLM service returned 401, refreshing token...")
-            auth_token_cache["token"] = None
-            auth_token = await get_auth_token()
-            headers["Authorization"] = f"Bearer {auth_token}"
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                llm_response = await client.post(llm_api_url, json=payload, headers=headers)
+            for attempt in range(2):
+                with track_upstream("llm", attempt=attempt + 1) as call:
+                    if streaming:
+                        llm_response = await _stream_completion(client, llm_api_url, payload, headers, plan)
+                    else:
+                        llm_response = await client.post(llm_api_url, json=payload, headers=headers)
+                    call.status = llm_response.status_code
+                if llm_response.status_code != 401 or attempt:
+                    break
+                logger.info("LLM 服務回傳 401，重新取得 Token")
+                auth_token_cache["token"] = None
+                auth_token = await get_auth_token()
+                headers["Authorization"] = f"Bearer {auth_token}"
 
         llm_response.raise_for_status()
-        response_data = llm_response.json()
-        ai_message = response_data["choices"][0]["message"]["content"]
+        if streaming:
+            completion = llm_response.extensions["completion"]
+            ai_message, usage = completion["content"], completion["usage"]
+            finished_early = completion["finished_early"]
+            if finished_early:
+                logger.debug("範本各行已產生，提前結束 LLM 串流")
+        else:
+            response_data = llm_response.json()
+            ai_message = response_data["choices"][0]["message"]["content"]
+            usage = response_data.get("usage") or {}
+            finished_early = False
+        record_token_usage(config.get("llm_route", "default"), usage)
+        if on_usage is not None:
+            on_usage(None if finished_early else usage)
 
         # --- 新增後處理邏輯：移除空方括號或「無資料」的行 ---
         processed_lines = []
-        for line in ai_message.splitlines():
-            if should_remove_line(line):
-                continue
-            processed_lines.append(line)
+        with time_stage("postprocess"):
+            for line in ai_message.splitlines():
+                if should_remove_line(line):
+                    continue
+                processed_lines.append(line)
         
         final_generated_text = "\n".join(processed_lines).strip()
 
-        print(f"[DEBUG] LLM 原始輸出:\n{ai_message}")
-        print(f"[DEBUG] LLM 後處理輸出:\n{final_generated_text}")
+        # 完整輸出只抽樣記錄 (見 app_logging.log_payload)
+        log_payload(logger, "LLM 原始輸出", ai_message, clinical=True, route=config.get("llm_route", "default"))
+        log_payload(logger, "LLM 後處理輸出", final_generated_text, clinical=True, route=config.get("llm_route", "default"))
         
-        return {"generated_text": final_generated_text}
+        return final_generated_text
 
     except httpx.HTTPStatusError as e:
-        print(f"[ERROR] LLM 服務 HTTP 錯誤: {e.response.status_code} - {e.response.reason_phrase}. Response text: {e.response.text}")
+        logger.error("LLM 服務 HTTP 錯誤: %s - %s. Response text: %s", e.response.status_code, e.response.reason_phrase, e.response.text)
         raise HTTPException(status_code=500, detail=f"LLM 服務回應錯誤: {e.response.status_code} - {e.response.text}")
     except httpx.RequestError as e:
-        print(f"[ERROR] 無法連線至 LLM 服務: {e}")
+        logger.error("無法連線至 LLM 服務: %s", e)
         raise HTTPException(status_code=500, detail=f"無法連線至 LLM 服務: {e}")
     except Exception as e:
-        print(f"[ERROR] LLM 溝通時發生未知錯誤: {e}")
-        print(f"詳細錯誤堆棧：\n{traceback.format_exc()}") 
+        logger.exception("LLM 溝通時發生未知錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"與 LLM 模型溝通時發生未知錯誤: {e}")
+
+
+def load_generation_config() -> Dict[str, Any]:
+    config = load_llm_config()
+    if not config.get("openai_api_base") or not config.get("llm_model"):
+        raise HTTPException(status_code=500, detail="LLM 設定不完整")
+    return config
+
+
+# --- 生成流程：選擇路由 -> 組合提示詞 -> 呼叫 LLM ---
+def prepare_generation(
+    generation_type: str,
+    subjective: str,
+    objective: str,
+    current_user: str,
+    config: Dict[str, Any],
+) -> Tuple[BuiltPrompt, Dict[str, Any]]:
+    """依任務類型與輸入長度選擇模型路由 (見 model_router)，回傳提示詞與套用路由後的 config"""
+    route = select_route(config, generation_type, estimate_tokens(subjective) + estimate_tokens(objective))
+    routed_config = apply_route(config, route)
+    with time_stage("prompt_build"):
+        custom_prompt_template = load_user_prompt_template(current_user, generation_type)
+        prompt = build_generation_messages(generation_type, subjective, objective, custom_prompt_template, current_user, routed_config)
+    return prompt, routed_config
+
+
+async def run_generation(prompt: BuiltPrompt, routed_config: Dict[str, Any]) -> str:
+    # 後處理後仍有內容才算可用的輸出
+    async with track_route(routed_config["llm_route"]) as outcome:
+        generated_text = await generate_from_messages(
+            prompt.messages, routed_config,
+            on_usage=lambda usage: prefix_cache_monitor.record(prompt, usage),
+            plan=prompt.generation,
+        )
+        outcome.accepted = bool(generated_text)
+    return generated_text
+
+
+# --- handle_generate 函式 ---
+@router.post("/generate") 
+async def handle_generate(
+    req: GenerateRequest,
+    current_user: str = Depends(get_current_username)
+):
+    config = load_generation_config()
+    prompt, routed_config = prepare_generation(req.type, req.subjective, req.objective, current_user, config)
+    final_generated_text = await run_generation(prompt, routed_config)
+    return {
+        "generated_text": final_generated_text,
+        "prompt_tokens_estimate": prompt.estimated_tokens,
+        "truncated_fields": prompt.truncated,
+    }
+
+
+# --- 前綴快取量測 ---
+@router.get("/prefix-cache-stats")
+async def get_prefix_cache_stats(current_user: str = Depends(get_current_username)):
+    """自行程啟動以來，提示詞中可被 vLLM 前綴快取重用的比例與上游回報的實際命中"""
+    return prefix_cache_monitor.snapshot()
+
+
+# --- 模型路由統計 ---
+@router.get("/route-stats")
+async def get_route_stats(current_user: str = Depends(get_current_username)):
+    """各模型路由 (含 ICD) 的處理中請求數、延遲百分位數與輸出可用率"""
+    return route_stats_snapshot()
+
+
+# --- 音訊直達 SOAP 的伺服器端管線 ---
+def _pipeline_event(stage: str, **fields) -> bytes:
+    """管線進度事件，每行一個 JSON 物件 (NDJSON)"""
+    return (json.dumps({"stage": stage, **fields}, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@router.post("/voice-generate")
+async def handle_voice_generate(
+    file: UploadFile = File(...),
+    type: str = Form(...),
+    field: Optional[Literal["subjective", "objective"]] = Form(None),
+    subjective: str = Form(""),
+    objective: str = Form(""),
+    vad: Optional[bool] = Form(None),
+    current_user: str = Depends(get_current_username)
+):
+    """
+    上傳音訊後在伺服器端依序完成語音辨識與生成，省去逐字稿往返瀏覽器。
+    逐字稿附加到 field 指定的欄位 (未指定時 FillTemplate 為 subjective、SOAP 為 objective)，
+    再以與 /generate 相同的邏輯生成。回應為 NDJSON 串流，每個階段一行：
+    received -> transcribing -> transcribed -> generating -> done (失敗時為 error)。
+    """
+    if type not in GENERATION_TYPES:
+        raise HTTPException(status_code=400, detail="無效的生成類型")
+    if not file.content_type or not file.content_type.startswith('audio/'):
+        raise HTTPException(status_code=400, detail="只接受音訊檔案。")
+
+    config = load_generation_config()
+    audio_content = await file.read()
+    file_format = file.content_type
+    target_field = field or ('subjective' if type == 'FillTemplate' else 'objective')
+
+    async def pipeline():
+        try:
+            yield _pipeline_event("received", bytes=len(audio_content))
+            yield _pipeline_event("transcribing")
+            audio_report = {}
+            transcript = (await perform_actual_speech_to_text_conversion(
+                audio_content, file_format, vad_enabled=vad, audio_report=audio_report
+            )).strip()
+            yield _pipeline_event("transcribed", text=transcript, **audio_report)
+
+            texts = {"subjective": subjective, "objective": objective}
+            if transcript:
+                current_text = texts[target_field]
+                texts[target_field] = (current_text + "\n" if current_text else "") + transcript
+
+            # 範本已編譯並快取於記憶體，逐字稿一到即可組合提示詞
+            prompt, routed_config = prepare_generation(type, texts["subjective"], texts["objective"], current_user, config)
+            yield _pipeline_event("generating", prompt_tokens_estimate=prompt.estimated_tokens, truncated_fields=prompt.truncated)
+            generated_text = await run_generation(prompt, routed_config)
+            yield _pipeline_event("done", generated_text=generated_text, **texts)
+        except HTTPException as e:
+            yield _pipeline_event("error", status_code=e.status_code, detail=e.detail)
+        except Exception as e:
+            logger.exception("音訊生成管線發生未知錯誤: %s", e)
+            yield _pipeline_event("error", status_code=500, detail=f"音訊生成管線發生未知錯誤: {e}")
+
+    return StreamingResponse(pipeline(), media_type="application/x-ndjson")
@@ -1,10 +1,21 @@
 # /home/phison/phison_doctor/new_UI/backend/api/custom_template.py
 import os
 import json
+import time
 import httpx
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
 from fastapi import HTTPException, Depends, status 
 from fastapi.security import OAuth2PasswordBearer 
 from jose import jwt, JWTError
+from pydantic import BaseModel
+from .user_store import UserStoreError, get_user_repository
+from .metrics import record_cache_lookup, track_upstream
+from .app_logging import get_logger
+from .tracing import span
+
+logger = get_logger("config")
 
 # JWT 相關配置 (請根據您的實際配置調整)
 JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "e0c3f5b8a9d1c7e6f2a4b8d0c9e7f1a3b5c7d9e2f4a8b0d1c3e5f7a9b2c4d6e8")
@@ -19,8 +30,13 @@ CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.j
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
 
 # --- 通用輔助函式：載入 LLM 配置 ---
-# 修改此函式以在解析前移除 JSON 註釋，包括行內註釋，並打印診斷信息
+# 修改此函式以在解析前移除 JSON 註釋，包括行內註釋
 def load_llm_config():
+    with span("config"):
+        return _load_llm_config()
+
+
+def _load_llm_config():
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             raw_content = f.read()
@@ -42,24 +58,21 @@ def load_llm_config():
                 raise ValueError(f"config.json 檔案為空或只包含註釋：{CONFIG_FILE}")
 
             parsed_config = json.loads(cleaned_content)
-            
-            # --- 新增的診斷信息 ---
-            openai_key_in_config = parsed_config.get("openai_api_key")
-            print(f"[診斷] load_llm_config 實際從 config.json 讀取到的 openai_api_key: '{openai_key_in_config}'")
-            # --- 診斷信息結束 ---
+            # 只記錄是否設定了金鑰，不輸出金鑰本身
+            logger.debug("已載入 LLM 配置 %s (openai_api_key %s)", CONFIG_FILE, "已設定" if parsed_config.get("openai_api_key") else "未設定")
 
             return parsed_config
     except json.JSONDecodeError as e:
-        print(f"[ERROR] 載入 LLM 配置失敗: JSON 語法錯誤 - {e}") 
-        print(f"錯誤發生在檔案: {CONFIG_FILE}, 行 {e.lineno}, 列 {e.colno}")
-        print("警告：儘管已嘗試移除註釋，config.json 仍存在 JSON 語法問題。")
-        print("請確保 config.json 是一個有效的 JSON 格式，無多餘逗號、不匹配的引號等非標準內容。")
+        logger.error(
+            "載入 LLM 配置失敗: JSON 語法錯誤 - %s (檔案 %s, 行 %s, 列 %s)。請確保 config.json 是有效的 JSON 格式，"
+            "無多餘逗號、不匹配的引號等非標準內容。", e, CONFIG_FILE, e.lineno, e.colno,
+        )
         raise HTTPException(status_code=500, detail="系統設定檔格式錯誤，請檢查 config.json")
     except ValueError as e:
-        print(f"[ERROR] 載入 LLM 配置失敗: {e}")
+        logger.error("載入 LLM 配置失敗: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
-        print(f"[ERROR] 載入 LLM 配置失敗: {e}") 
+        logger.error("載入 LLM 配置失敗: %s", e)
         raise HTTPException(status_code=500, detail="系統設定檔遺失、毀損或路徑不正確")
 
 # --- 通用輔助函式：獲取認證 Token ---
@@ -70,39 +83,109 @@ async def get_auth_token():
     login_data = {"account": config.get("token_account"), "password": config.get("token_password")}
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(config.get("token_url"), data=login_data) 
+        with track_upstream("token") as call:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(config.get("token_url"), data=login_data) 
+            call.status = response.status_code
         
         response.raise_for_status()
         token = response.json().get("data", {}).get("token")
         if not token:
-            print("[ERROR] 從中控台取得的 Token 為空")
+            logger.error("從中控台取得的 Token 為空")
             raise HTTPException(status_code=500, detail="從中控台取得的 Token 為空")
         auth_token_cache["token"] = token
         return token
     except httpx.HTTPStatusError as e:
-        print(f"[ERROR] 認證服務 HTTP 錯誤: {e.response.status_code} - {e.response.text}")
+        logger.error("認證服務 HTTP 錯誤: %s - %s", e.response.status_code, e.response.text)
         raise HTTPException(status_code=500, detail=f"認證服務回應錯誤: {e.response.status_code} - {e.response.text}")
     except httpx.RequestError as e:
-        print(f"[ERROR] 認證服務網路請求錯誤: {e}")
+        logger.error("認證服務網路請求錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"無法連線至認證服務: {e}")
     except Exception as e:
-        print(f"[ERROR] 認證服務發生未知錯誤: {e}")
+        logger.error("認證服務發生未知錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"認證服務發生未知錯誤: {e}")
 
-# --- JWT 驗證依賴 ---
-async def get_current_username(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="無法驗證憑證",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+# --- JWT 驗證結果快取 ---
+# 已驗證的 token -> (username, 到期時間)，到期前不必重複做簽章驗證；以 LRU 限制數量
+TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", "1024"))
+_token_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def decode_token_username(token: str) -> Optional[str]:
+    """回傳 token 的使用者名稱；簽章錯誤、過期或缺少 sub 時回傳 None"""
+    now = time.time()
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+        if cached is not None:
+            if cached[1] > now:
+                _token_cache.move_to_end(token)
+                record_cache_lookup("jwt", True)
+                return cached[0]
+            del _token_cache[token]
+    record_cache_lookup("jwt", False)
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        return None
+    username = payload.get("sub")
+    expires_at = payload.get("exp")
+    # 沒有 exp 的 token 不快取，每次都重新驗證
+    if username is not None and isinstance(expires_at, (int, float)) and TOKEN_CACHE_SIZE > 0:
+        with _token_cache_lock:
+            _token_cache[token] = (username, float(expires_at))
+            _token_cache.move_to_end(token)
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return username
+
+
+# --- JWT 驗證依賴 ---
+async def get_current_username(token: str = Depends(oauth2_scheme)):
+    username = decode_token_username(token)
+    if username is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="無法驗證憑證",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return username
 
+
+# --- 目前登入者 (每個請求只解析一次) ---
+class Principal(BaseModel):
+    username: str
+    role: Optional[str] = None
+    status: Optional[str] = None
+    department: Optional[str] = None
+    name: Optional[str] = None
+
+
+async def get_current_principal(username: str = Depends(get_current_username)) -> Principal:
+    """
+    由 token 的使用者名稱查詢使用者目錄 (記憶體索引) 取得角色等資訊。
+    FastAPI 在同一請求中會重用依賴的結果，路由與其子依賴都宣告此依賴時也只查詢一次。
+    """
+    try:
+        record = get_user_repository().get(username)
+    except UserStoreError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"伺服器設定錯誤：{e}")
+    if record is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="操作者不存在")
+    return Principal(
+        username=username,
+        role=record.get("role"),
+        status=record.get("status"),
+        department=record.get("department"),
+        name=record.get("name"),
+    )
+
+
+def require_roles(*roles: str, detail: str = "權限不足") -> Callable:
+    """產生只允許特定角色的依賴，例如 Depends(require_roles("admin"))"""
+    async def dependency(principal: Principal = Depends(get_current_principal)) -> Principal:
+        if principal.role not in roles:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+        return principal
+    return dependency
+
@@ -10,16 +10,23 @@ import csv
 import sys
 import difflib
 
+from .app_logging import get_logger, log_fields, log_payload
+
+logger = get_logger("icd")
+
 # --- 導入 OpenCC 相關 (如果已安裝) ---
 try:
     from opencc import OpenCC
     _converter = OpenCC('s2twp') 
-    print("[DEBUG] OpenCC 簡繁轉換器初始化成功。")
+    logger.debug("OpenCC 簡繁轉換器初始化成功。")
 except ImportError:
     _converter = None
-    print("[WARNING] opencc-python-reimplementation 未安裝。簡體轉繁體功能將不可用。請運行: pip install opencc-python-reimplementation")
+    logger.warning("opencc-python-reimplementation 未安裝。簡體轉繁體功能將不可用。請運行: pip install opencc-python-reimplementation")
 
 from .custom_template import get_current_username, get_auth_token, load_llm_config
+from .model_router import Route, apply_route, select_route, track_route
+from .prompt_builder import estimate_tokens
+from .metrics import record_token_usage, time_stage, track_upstream
 
 router = APIRouter()
 
@@ -31,9 +38,9 @@ try:
 except KeyError:
     PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     ICDX_CSV_PATH = os.path.join(PROJECT_ROOT, "frontend", "public", "ICDX.csv")
-    print("[WARNING] 'main' 模組未在 sys.modules 中找到，使用備用路徑推導 ICDX.csv。")
+    logger.warning("'main' 模組未在 sys.modules 中找到，使用備用路徑推導 ICDX.csv。")
 
-print(f"[DEBUG] ICDX_CSV_PATH 最終解析為: {ICDX_CSV_PATH}")
+logger.debug("ICDX_CSV_PATH 最終解析為: %s", ICDX_CSV_PATH)
 
 
 _icd_data_cache: List[Dict[str, str]] = []
@@ -48,9 +55,9 @@ def load_icd_data():
     """載入 ICDX.csv 數據並建立搜尋映射"""
     global _icd_data_cache, _icd_search_map
     if not _icd_data_cache: 
-        print(f"[DEBUG] 正在嘗試載入 ICDX.csv 數據，路徑: {ICDX_CSV_PATH}")
+        logger.debug("正在嘗試載入 ICDX.csv 數據，路徑: %s", ICDX_CSV_PATH)
         if not os.path.exists(ICDX_CSV_PATH):
-            print(f"[CRITICAL ERROR] ICDX.csv 檔案未找到或無權限讀取: {ICDX_CSV_PATH}")
+            logger.critical("ICDX.csv 檔案未找到或無權限讀取: %s", ICDX_CSV_PATH)
             return 
         try:
             with open(ICDX_CSV_PATH, "r", encoding="utf-8-sig") as f:
@@ -58,9 +65,9 @@ def load_icd_data():
                 _icd_data_cache = [row for row in reader]
                 
             _icd_search_map = {normalize_icd_code(row['Icdx']): row for row in _icd_data_cache if 'Icdx' in row}
-            print(f"[DEBUG] ICDX.csv 數據載入完成，共 {len(_icd_data_cache)} 條記錄，{len(_icd_search_map)} 個唯一規範化 ICD 碼。")
+            logger.info("ICDX.csv 數據載入完成，共 %d 條記錄，%d 個唯一規範化 ICD 碼。", len(_icd_data_cache), len(_icd_search_map))
         except Exception as e:
-            print(f"[CRITICAL ERROR] 載入 ICDX.csv 數據失敗: {e}", exc_info=True)
+            logger.critical("載入 ICDX.csv 數據失敗: %s", e, exc_info=True)
 
 
 class ICDRequest(BaseModel):
@@ -84,7 +91,7 @@ def retrieve_relevant_icds(query: str, top_k: int = 5, similarity_threshold: flo
         load_icd_data() 
 
     if not _icd_data_cache: 
-        print("[WARNING] ICD 數據未載入，無法執行 RAG 檢索。")
+        logger.warning("ICD 數據未載入，無法執行 RAG 檢索。")
         return []
 
     relevant_icds_with_score = []
@@ -117,7 +124,7 @@ def retrieve_relevant_icds(query: str, top_k: int = 5, similarity_threshold: flo
     relevant_icds_with_score.sort(key=lambda x: x["score"], reverse=True)
     relevant_icds = [item["icd_info"] for item in relevant_icds_with_score[:top_k]]
 
-    print(f"[DEBUG] 檢索到 {len(relevant_icds)} 個相關 ICD 碼 (基於相似度 {similarity_threshold})。")
+    logger.debug("檢索到 %d 個相關 ICD 碼 (基於相似度 %s)。", len(relevant_icds), similarity_threshold)
     return relevant_icds
 
 @router.post("/infer", response_model=List[ICDResponse])
@@ -127,7 +134,10 @@ async def infer_icd_codes(
 ):
     load_icd_data() 
 
+    # ICD 建議可由較小的模型處理 (見 config.json 的 llm_routes)
     config = load_llm_config()
+    route = select_route(config, "ICD", estimate_tokens(req.subjective_text))
+    config = apply_route(config, route)
     llm_api_url = config.get("openai_api_base")
     llm_model = config.get("llm_model")
 
@@ -135,7 +145,8 @@ async def infer_icd_codes(
         raise HTTPException(status_code=500, detail="LLM 設定不完整，請檢查 config.ini")
 
     # --- RAG 步驟 1: 檢索相關 ICD 碼 ---
-    retrieved_icds = retrieve_relevant_icds(req.subjective_text, top_k=10, similarity_threshold=0.1) # 這裡也調整為 0.1
+    with time_stage("icd_retrieval"):
+        retrieved_icds = retrieve_relevant_icds(req.subjective_text, top_k=10, similarity_threshold=0.1) # 這裡也調整為 0.1
 
     retrieval_context = ""
     if retrieved_icds:
@@ -146,9 +157,9 @@ async def infer_icd_codes(
                 f"{', 中文: ' + icd_info.cname if icd_info.cname else ''}\n"
             )
         retrieval_context += "\n"
-        print(f"[DEBUG] RAG 提示詞將包含檢索到的 ICD 數據：\n{retrieval_context}")
+        logger.debug("RAG 提示詞將包含檢索到的 ICD 數據", extra=log_fields(codes=[icd.code for icd in retrieved_icds]))
     else:
-        print("[DEBUG] 未檢索到相關 ICD 碼，RAG 提示詞將不包含額外上下文。")
+        logger.debug("未檢索到相關 ICD 碼，RAG 提示詞將不包含額外上下文。")
 
 
     prompt = (
@@ -161,12 +172,21 @@ async def infer_icd_codes(
         f"{retrieval_context}" 
     )
     
+    # 輸出可解析為至少一個 ICD 碼才算可用
+    async with track_route(route.name) as outcome:
+        final_icd_list = await _request_icd_codes(prompt, llm_api_url, llm_model, route)
+        outcome.accepted = bool(final_icd_list)
+    return final_icd_list
+
+
+async def _request_icd_codes(prompt: str, llm_api_url: str, llm_model: str, route: Route) -> List[ICDResponse]:
+    """呼叫 LLM 並將回應解析為 ICD 碼列表 (簡體名稱轉為繁體，英文名稱以 CSV 的中文名稱取代)"""
     try:
         auth_token = await get_auth_token()
         payload = {
             "model": llm_model,
             "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 512,
+            "max_tokens": route.max_tokens or 512,
             "temperature": 0.2
         }
         headers = {
@@ -174,14 +194,17 @@ async def infer_icd_codes(
             "Content-Type": "application/json"
         }
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            llm_response = await client.post(llm_api_url, json=payload, headers=headers)
+        with track_upstream("llm") as call:
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                llm_response = await client.post(llm_api_url, json=payload, headers=headers)
+            call.status = llm_response.status_code
         
         llm_response.raise_for_status() 
         response_data = llm_response.json()
+        record_token_usage(route.name, response_data.get("usage"))
         
         ai_message = response_data["choices"][0]["message"]["content"]
-        print(f"[DEBUG] LLM 原始回應: {ai_message}")
+        log_payload(logger, "LLM 原始回應", ai_message, route=route.name)
 
         if ai_message.strip().startswith("```json"):
             start_index = ai_message.find('[')
@@ -206,9 +229,9 @@ async def infer_icd_codes(
                 try:
                     processed_name = _converter.convert(llm_name_raw)
                     if processed_name != llm_name_raw: 
-                        print(f"[DEBUG] 簡體轉繁體: '{llm_name_raw}' -> '{processed_name}'")
+                        logger.debug("簡體轉繁體: %r -> %r", llm_name_raw, processed_name)
                 except Exception as e:
-                    print(f"[WARNING] OpenCC 轉換失敗: {e}. 將使用原始名稱。")
+                    logger.warning("OpenCC 轉換失敗: %s. 將使用原始名稱。", e)
             
             if code:
                 # --- 修正點：調整後處理邏輯的優先級 ---
@@ -235,7 +258,7 @@ async def infer_icd_codes(
                     else:
                         final_icd_list.append(ICDResponse(code=code, name=processed_name)) # CSV 無中文，保持 LLM 的英文
             
-        print(f"[DEBUG] 最終處理後的 ICD 列表 (包含簡繁轉換嘗試): {final_icd_list}")
+        logger.debug("最終處理後的 ICD 列表", extra=log_fields(codes=[icd.code for icd in final_icd_list]))
         return final_icd_list
 
     except json.JSONDecodeError as e:
@@ -244,4 +267,3 @@ async def infer_icd_codes(
         raise HTTPException(status_code=503, detail=f"無法連線至 AI 模型服務: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"與 AI 模型溝通時發生未知錯誤: {e}")
-
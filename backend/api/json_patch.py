@@ -0,0 +1,194 @@
+# api/json_patch.py
+# RFC 6902 JSON Patch (搭配 RFC 6901 JSON Pointer)：add / remove / replace / move / copy / test
+
+import copy
+from typing import Any, Dict, List, Tuple
+
+
+class JsonPatchError(ValueError):
+    """修補文件格式錯誤，或路徑無法套用於目前的文件"""
+
+
+class JsonPatchTestFailed(JsonPatchError):
+    """test 操作的值與文件內容不符"""
+
+
+# --- JSON Pointer ---
+def parse_pointer(pointer: str) -> List[str]:
+    if pointer == "":
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise JsonPatchError(f"無效的 JSON Pointer: {pointer!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _array_index(container: list, token: str, allow_end: bool) -> int:
+    if allow_end and token == "-":
+        return len(container)
+    # RFC 6901：不可有前導零或正負號
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise JsonPatchError(f"無效的陣列索引: {token!r}")
+    index = int(token)
+    limit = len(container) + 1 if allow_end else len(container)
+    if index >= limit:
+        raise JsonPatchError(f"陣列索引超出範圍: {index}")
+    return index
+
+
+def _resolve_parent(document: Any, tokens: List[str]) -> Tuple[Any, str]:
+    """回傳 (父容器, 最後一個 token)；tokens 不可為空"""
+    target = document
+    for token in tokens[:-1]:
+        if isinstance(target, dict):
+            if token not in target:
+                raise JsonPatchError(f"路徑不存在: /{'/'.join(tokens)}")
+            target = target[token]
+        elif isinstance(target, list):
+            target = target[_array_index(target, token, allow_end=False)]
+        else:
+            raise JsonPatchError(f"路徑不存在: /{'/'.join(tokens)}")
+    return target, tokens[-1]
+
+
+def get_value(document: Any, pointer: str) -> Any:
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return document
+    parent, last = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchError(f"路徑不存在: {pointer}")
+        return parent[last]
+    if isinstance(parent, list):
+        return parent[_array_index(parent, last, allow_end=False)]
+    raise JsonPatchError(f"路徑不存在: {pointer}")
+
+
+# --- 各項操作 (皆回傳新的根文件，以處理路徑為 "" 的情況) ---
+def _add(document: Any, pointer: str, value: Any) -> Any:
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return value
+    parent, last = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        parent[last] = value
+    elif isinstance(parent, list):
+        parent.insert(_array_index(parent, last, allow_end=True), value)
+    else:
+        raise JsonPatchError(f"無法在此路徑新增: {pointer}")
+    return document
+
+
+def _remove(document: Any, pointer: str) -> Tuple[Any, Any]:
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        raise JsonPatchError("不可移除根文件")
+    parent, last = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchError(f"路徑不存在: {pointer}")
+        return document, parent.pop(last)
+    if isinstance(parent, list):
+        return document, parent.pop(_array_index(parent, last, allow_end=False))
+    raise JsonPatchError(f"路徑不存在: {pointer}")
+
+
+def _replace(document: Any, pointer: str, value: Any) -> Any:
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return value
+    parent, last = _resolve_parent(document, tokens)
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchError(f"路徑不存在: {pointer}")
+        parent[last] = value
+    elif isinstance(parent, list):
+        parent[_array_index(parent, last, allow_end=False)] = value
+    else:
+        raise JsonPatchError(f"路徑不存在: {pointer}")
+    return document
+
+
+def _require(operation: Dict, member: str) -> Any:
+    if member not in operation:
+        raise JsonPatchError(f"{operation.get('op')} 操作缺少 {member}")
+    return operation[member]
+
+
+def apply_patch(document: Any, patch: List[Dict]) -> Any:
+    """
+    套用 JSON Patch 並回傳新文件。原文件不會被修改；任一操作失敗時整份修補都不生效。
+    """
+    if not isinstance(patch, list):
+        raise JsonPatchError("JSON Patch 必須是操作的陣列")
+    result = copy.deepcopy(document)
+    for operation in patch:
+        if not isinstance(operation, dict):
+            raise JsonPatchError("每個操作都必須是 JSON 物件")
+        op = operation.get("op")
+        path = _require(operation, "path")
+        if not isinstance(path, str):
+            raise JsonPatchError("path 必須是字串")
+        if op == "add":
+            result = _add(result, path, copy.deepcopy(_require(operation, "value")))
+        elif op == "remove":
+            result, _ = _remove(result, path)
+        elif op == "replace":
+            result = _replace(result, path, copy.deepcopy(_require(operation, "value")))
+        elif op == "move":
+            from_path = _require(operation, "from")
+            if not isinstance(from_path, str):
+                raise JsonPatchError("from 必須是字串")
+            if path != from_path and path.startswith(from_path + "/"):
+                raise JsonPatchError("不可將節點移動到自己的子節點")
+            result, value = _remove(result, from_path)
+            result = _add(result, path, value)
+        elif op == "copy":
+            value = copy.deepcopy(get_value(result, _require(operation, "from")))
+            result = _add(result, path, value)
+        elif op == "test":
+            expected = _require(operation, "value")
+            actual = get_value(result, path)
+            # JSON 中 1 與 true 不同，比較時需連同型別
+            if type(actual) is not type(expected) and not (
+                isinstance(actual, (int, float)) and isinstance(expected, (int, float))
+                and not isinstance(actual, bool) and not isinstance(expected, bool)
+            ):
+                raise JsonPatchTestFailed(f"test 失敗: {path}")
+            if actual != expected:
+                raise JsonPatchTestFailed(f"test 失敗: {path}")
+        else:
+            raise JsonPatchError(f"不支援的操作: {op!r}")
+    return result
+
+
+# --- 產生修補 ---
+def _escape_token(token: str) -> str:
+    return token.replace("~", "~0").replace("/", "~1")
+
+
+def _same_json(a: Any, b: Any) -> bool:
+    # 1 == True 在 Python 中成立，但在 JSON 中是不同的值
+    return type(a) is type(b) and a == b
+
+
+def make_patch(source: Any, target: Any, pointer: str = "") -> List[Dict]:
+    """
+    產生將 source 轉為 target 的 JSON Patch。物件逐鍵遞迴比較；陣列與字串有差異時整個取代。
+    apply_patch(source, make_patch(source, target)) == target。
+    """
+    if _same_json(source, target):
+        return []
+    if isinstance(source, dict) and isinstance(target, dict):
+        operations = []
+        for key, value in source.items():
+            path = f"{pointer}/{_escape_token(key)}"
+            if key not in target:
+                operations.append({"op": "remove", "path": path})
+            else:
+                operations.extend(make_patch(value, target[key], path))
+        for key, value in target.items():
+            if key not in source:
+                operations.append({"op": "add", "path": f"{pointer}/{_escape_token(key)}", "value": value})
+        return operations
+    return [{"op": "replace", "path": pointer, "value": target}]
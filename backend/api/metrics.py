@@ -0,0 +1,274 @@
+# api/metrics.py
+# 行程內的指標登錄表與 Prometheus 文字格式輸出 (GET /metrics)：
+# 各路由的請求延遲直方圖、上游 (LLM / Whisper / Token) 呼叫延遲、vLLM 回報的 token 用量、處理中請求數、
+# 熱點階段 (提示詞組合、輸出後處理、ICD 檢索、音訊轉換) 的耗時，以及各快取的命中次數。
+# 以 gunicorn 多 worker 執行時每個 worker 各有一份數值，請由 Prometheus 以 worker 為單位抓取或加總。
+
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import APIRouter
+from starlette.responses import Response
+
+from .tracing import span
+
+router = APIRouter()
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 請求與上游呼叫 (秒)；LLM 生成可能長達數十秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 行程內的處理階段 (秒)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# --- 指標型別 ---
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指標 {self.name} 的標籤應為 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 標籤 -> [各區間 (非累計) 的次數..., +Inf 區間次數], 總和
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(counts), total[0]) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+# --- 登錄表 ---
+_registry: List[_Metric] = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+HTTP_REQUEST_DURATION = register(Histogram(
+    "http_request_duration_seconds", "HTTP 請求處理時間 (含串流回應的傳送)", ("method", "route", "status"),
+))
+HTTP_REQUESTS_IN_PROGRESS = register(Gauge(
+    "http_requests_in_progress", "處理中的 HTTP 請求數", ("method",),
+))
+UPSTREAM_REQUEST_DURATION = register(Histogram(
+    "upstream_request_duration_seconds", "上游服務呼叫時間 (llm / whisper / token)", ("service", "status"),
+))
+UPSTREAM_REQUESTS_IN_FLIGHT = register(Gauge(
+    "upstream_requests_in_flight", "等待上游服務回應中的呼叫數", ("service",),
+))
+LLM_PROMPT_TOKENS = register(Counter(
+    "llm_prompt_tokens_total", "上游 usage 回報的提示詞 token 數", ("route",),
+))
+LLM_COMPLETION_TOKENS = register(Counter(
+    "llm_completion_tokens_total", "上游 usage 回報的生成 token 數", ("route",),
+))
+LLM_CACHED_PROMPT_TOKENS = register(Counter(
+    "llm_cached_prompt_tokens_total", "上游 usage 回報的前綴快取命中 token 數", ("route",),
+))
+STAGE_DURATION = register(Histogram(
+    "stage_duration_seconds", "行程內處理階段的耗時", ("stage",), buckets=STAGE_BUCKETS,
+))
+STAGE_CPU_SECONDS = register(Counter(
+    "stage_cpu_seconds_total", "行程內處理階段耗用的 CPU 時間 (執行該階段的執行緒)", ("stage",),
+))
+CACHE_LOOKUPS = register(Counter(
+    "cache_lookups_total", "快取查詢次數", ("cache", "result"),
+))
+
+
+# --- 量測輔助 ---
+@contextmanager
+def time_stage(stage: str):
+    """量測同步程式區塊的實際耗時與 CPU 時間 (例如在執行緒池中的音訊轉換)，同時記錄為請求追蹤的 span"""
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        with span(stage):
+            yield
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage)
+        STAGE_CPU_SECONDS.inc(time.thread_time() - cpu_start, stage=stage)
+
+
+class UpstreamCall:
+    """由呼叫端在收到回應後設定 status (HTTP 狀態碼)；未設定且發生例外時記為 error"""
+
+    def __init__(self):
+        self.status: Optional[int] = None
+
+
+@contextmanager
+def track_upstream(service: str, **span_attributes):
+    """上游呼叫的延遲與處理中數量；同時記錄為請求追蹤的 span (span_attributes 例如重試次數)"""
+    call = UpstreamCall()
+    UPSTREAM_REQUESTS_IN_FLIGHT.inc(service=service)
+    start = time.perf_counter()
+    try:
+        with span(service, **span_attributes) as current:
+            yield call
+            if current is not None and call.status is not None:
+                current.attributes["http.status_code"] = call.status
+    finally:
+        UPSTREAM_REQUESTS_IN_FLIGHT.dec(service=service)
+        status = str(call.status) if call.status is not None else "error"
+        UPSTREAM_REQUEST_DURATION.observe(time.perf_counter() - start, service=service, status=status)
+
+
+def record_token_usage(route: str, usage: Optional[dict]) -> None:
+    """記錄 OpenAI 相容 usage 欄位中的 token 數；上游未回報的欄位略過 (例如串流提前結束時只有 completion_tokens)"""
+    if not usage:
+        return
+    if usage.get("prompt_tokens") is not None:
+        LLM_PROMPT_TOKENS.inc(usage["prompt_tokens"], route=route)
+    if usage.get("completion_tokens") is not None:
+        LLM_COMPLETION_TOKENS.inc(usage["completion_tokens"], route=route)
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached:
+        LLM_CACHED_PROMPT_TOKENS.inc(cached, route=route)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+# --- 請求延遲中介層 ---
+class MetricsMiddleware:
+    """
+    ASGI 中介層：以 FastAPI 比對到的路由樣板 (例如 /api/patients/{id}) 作為 route 標籤，避免路徑參數造成標籤爆量；
+    找不到路由的請求一律記為 unmatched。時間計算到回應 (含串流) 傳送完畢為止。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_holder = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["status"] = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc(method=method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec(method=method)
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=method,
+                route=getattr(route, "path", None) or "unmatched",
+                status=str(status_holder["status"]),
+            )
+
+
+# --- 端點 ---
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus 抓取端點 (文字格式 0.0.4)，不需登入；請於反向代理限制只有監控主機可存取"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
@@ -0,0 +1,180 @@
+# api/model_router.py
+# 模型路由：依 config.json 的 llm_routes 規則，按任務類型、輸入長度與目前排隊數選擇模型與端點，
+# 例如 ICD 與 FillTemplate 交給小模型、SOAP 交給大模型。並記錄每條路由的延遲與輸出可用率。
+#
+# config.json 範例 (由上而下取第一條符合的規則，都不符合時使用 openai_api_base / llm_model)：
+#   "llm_routes": [
+#     {"name": "small", "tasks": ["ICD", "FillTemplate"], "max_input_tokens": 1500, "max_queue_depth": 8,
+#      "model": "small-model", "api_base": "http://small-llm/v1/chat/completions", "max_tokens": 512},
+#     {"name": "large", "tasks": ["SOAP"], "model": "large-model"}
+#   ]
+
+import time
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from .app_logging import get_logger
+
+logger = get_logger("model_router")
+
+TASKS = ("FillTemplate", "SOAP", "ICD")
+DEFAULT_ROUTE_NAME = "default"
+# 每條路由保留最近幾筆延遲用於計算百分位數
+LATENCY_WINDOW = 1000
+
+
+class Route(BaseModel):
+    name: str
+    model: Optional[str] = None  # 未指定時沿用 llm_model
+    api_base: Optional[str] = None  # 未指定時沿用 openai_api_base
+    tasks: List[str] = []  # 空白表示所有任務
+    min_input_tokens: int = 0
+    max_input_tokens: Optional[int] = None
+    # 此路由處理中的請求數達到上限時改走下一條規則 (本行程內的計數，作為上游排隊長度的近似)
+    max_queue_depth: Optional[int] = None
+    max_tokens: Optional[int] = None  # 覆寫 llm_max_tokens
+    context_tokens: Optional[int] = None  # 覆寫 llm_context_tokens
+
+
+# --- 路由統計 ---
+class RouteStats:
+    def __init__(self):
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.accepted = 0
+        self.latency_total = 0.0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+
+_stats: Dict[str, RouteStats] = {}
+_stats_lock = threading.Lock()
+
+
+def _route_stats(name: str) -> RouteStats:
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = RouteStats()
+        return stats
+
+
+def queue_depth(route_name: str) -> int:
+    stats = _stats.get(route_name)
+    return stats.in_flight if stats is not None else 0
+
+
+# --- 規則 ---
+def load_routes(config: Dict[str, Any]) -> List[Route]:
+    routes = []
+    for index, raw in enumerate(config.get("llm_routes") or []):
+        try:
+            routes.append(Route(**{"name": f"route{index}", **raw}))
+        except (ValidationError, TypeError) as e:
+            logger.warning("忽略格式錯誤的 llm_routes[%d]: %s", index, e)
+    return routes
+
+
+def _matches(route: Route, task: str, input_tokens: int) -> bool:
+    if route.tasks and task not in route.tasks:
+        return False
+    if input_tokens < route.min_input_tokens:
+        return False
+    if route.max_input_tokens is not None and input_tokens > route.max_input_tokens:
+        return False
+    if route.max_queue_depth is not None and queue_depth(route.name) >= route.max_queue_depth:
+        return False
+    return True
+
+
+def select_route(config: Dict[str, Any], task: str, input_tokens: int) -> Route:
+    for route in load_routes(config):
+        if _matches(route, task, input_tokens):
+            return route
+    return Route(name=DEFAULT_ROUTE_NAME)
+
+
+def apply_route(config: Dict[str, Any], route: Route) -> Dict[str, Any]:
+    """回傳以路由設定覆寫後的 config 複本，呼叫端照常讀取 openai_api_base / llm_model 等欄位"""
+    routed = dict(config)
+    if route.api_base:
+        routed["openai_api_base"] = route.api_base
+    if route.model:
+        routed["llm_model"] = route.model
+    if route.max_tokens:
+        routed["llm_max_tokens"] = route.max_tokens
+    if route.context_tokens:
+        routed["llm_context_tokens"] = route.context_tokens
+    routed["llm_route"] = route.name
+    return routed
+
+
+class RouteOutcome:
+    """
+    由呼叫端在取得輸出後設定 accepted (輸出通過檢查，例如非空白、JSON 可解析)。
+    建立時處理中的請求數 +1，由 track_route 在結束時呼叫 finish。
+    """
+
+    def __init__(self, route_name: str):
+        self.accepted = False
+        self._stats = _route_stats(route_name)
+        with _stats_lock:
+            self._stats.in_flight += 1
+        self._start = time.perf_counter()
+
+    def finish(self, failed: bool) -> None:
+        """記錄延遲與結果；failed 表示請求以例外結束"""
+        elapsed = time.perf_counter() - self._start
+        stats = self._stats
+        with _stats_lock:
+            stats.in_flight -= 1
+            stats.requests += 1
+            stats.latency_total += elapsed
+            stats.latencies.append(elapsed)
+            if failed:
+                stats.errors += 1
+            elif self.accepted:
+                stats.accepted += 1
+
+
+@asynccontextmanager
+async def track_route(route_name: str):
+    """記錄處理中的請求數、延遲、錯誤與可用率；例外會照常往外拋"""
+    outcome = RouteOutcome(route_name)
+    failed = False
+    try:
+        yield outcome
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        outcome.finish(failed)
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000, 1)
+
+
+def route_stats_snapshot() -> Dict[str, Dict[str, Any]]:
+    with _stats_lock:
+        items = [(name, stats, list(stats.latencies)) for name, stats in _stats.items()]
+    return {
+        name: {
+            "in_flight": stats.in_flight,
+            "requests": stats.requests,
+            "errors": stats.errors,
+            "accepted": stats.accepted,
+            "acceptance_rate": round(stats.accepted / stats.requests, 4) if stats.requests else None,
+            "latency_ms_mean": round(stats.latency_total / stats.requests * 1000, 1) if stats.requests else None,
+            "latency_ms_p50": _percentile(latencies, 50),
+            "latency_ms_p95": _percentile(latencies, 95),
+        }
+        for name, stats, latencies in items
+    }
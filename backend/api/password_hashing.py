@@ -0,0 +1,61 @@
+# api/password_hashing.py
+# 密碼雜湊：bcrypt (passlib)。雜湊與驗證屬 CPU 密集運算 (每次約 0.1–0.3 秒)，
+# 非同步路由一律交給固定大小的專用執行緒池，不佔用事件迴圈，也不會用光 Starlette 的共用執行緒池。
+
+import os
+import hmac
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+# bcrypt 成本參數 (2 的次方輪數)，每 +1 運算時間約加倍。調整後，舊成本的雜湊會在使用者下次登入時自動重算
+BCRYPT_ROUNDS = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", "12"))
+# 同時進行雜湊運算的上限；bcrypt 運算時會釋放 GIL，預設與 CPU 核心數相同 (最多 4 個)
+HASH_WORKERS = max(1, int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+_dummy_hash: Optional[str] = None
+
+
+def is_hashed(stored: Optional[str]) -> bool:
+    return bool(stored) and pwd_context.identify(stored, required=False) is not None
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    驗證密碼，回傳 (是否正確, 需要寫回的新雜湊)。
+    stored 為舊版的明文密碼時以固定時間比較，正確則回傳其雜湊以便遷移；
+    雜湊的成本參數與目前設定不同時，也會回傳以新成本重算的雜湊。
+    """
+    global _dummy_hash
+    if not stored:
+        # 帳號不存在時仍做一次雜湊運算，避免從回應時間判斷帳號是否存在
+        if _dummy_hash is None:
+            _dummy_hash = hash_password("dummy-password")
+        pwd_context.verify(password, _dummy_hash)
+        return False, None
+    if not is_hashed(stored):
+        if hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8")):
+            return True, hash_password(password)
+        return False, None
+    return pwd_context.verify_and_update(password, stored)
+
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, hash_password, password)
+
+
+async def verify_password_async(password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+    return await asyncio.get_running_loop().run_in_executor(_executor, verify_password, password, stored)
+
+
+def shutdown_executor() -> None:
+    _executor.shutdown(wait=False, cancel_futures=True)
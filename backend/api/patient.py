@@ -1,85 +1,134 @@
 # api/patient.py
 
-from fastapi import APIRouter, Request, HTTPException, Query, Depends
+from fastapi import APIRouter, Request, HTTPException, Query, Depends, Response, UploadFile, File, Form, Header
+from fastapi.responses import StreamingResponse
 import os
 import json
+import time
 from pathlib import Path # 導入 pathlib，用於更安全的檔案路徑操作
 from pydantic import ValidationError # 導入 ValidationError 處理 Pydantic 轉換錯誤
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional, Dict # 確保導入 Dict
 
 from models.patient_model import Patient, ICDAssessment # 保留原有的模型，如果其他地方有用到
-from models.chtno_patient_model import ChtnoPatient, ChtnoICDXAssessment # 導入新的 ChtnoPatient 模型
+from models.chtno_patient_model import ChtnoPatient, ChtnoICDXAssessment, is_fully_valid # 導入新的 ChtnoPatient 模型
 
 from .custom_template import get_current_username 
+from . import patient_store, patient_cache, patient_import, patient_export, patient_history, patient_search
+from .json_patch import apply_patch, JsonPatchError, JsonPatchTestFailed
+from .atomic_write import CoalescingWriter, DeferredWriteError
+from .app_logging import get_logger, log_fields
+from .tracing import span
 
 router = APIRouter()
+logger = get_logger("patient")
 
 # 使用 pathlib 確保跨平台相容性
 BASE_DATA_DIR = Path(__file__).parent.parent / 'data' # 調整路徑，使用 Path 物件
 
-# --- 輔助函式：根據 CHTNO 在特定用戶的 OPD.json 檔案中尋找病人資料 ---
-def find_patient_by_chtno_in_user_opd_file(username: str, chtno_to_find: str) -> Optional[Dict]:
+# --- 輔助函式：根據 CHTNO 在特定用戶的病患資料庫中尋找病人資料 ---
+def find_patient_by_chtno_for_user(username: str, chtno_to_find: str) -> Optional[Dict]:
     """
-    從指定用戶的 OPD.json 檔案中載入病人資料，並根據 CHTNO 進行比對。
-    假設每個用戶的 OPD.json 檔案只包含一個病患的資料。
+    從病患資料庫中以 (username, CHTNO) 索引查詢病人資料，同一病歷號有多次就診時回傳最近一次。
+    舊版的 data/{username}/OPD.json 會在第一次存取時自動匯入資料庫。
     """
-    opd_file_path = BASE_DATA_DIR / username / "OPD.json"
-    
-    if not opd_file_path.is_file(): # 使用 Path 物件的方法檢查檔案是否存在
-        print(f"[DEBUG] 用戶 {username} 的 OPD.json 檔案不存在: {opd_file_path}")
-        return None
-    
-    try:
-        with open(opd_file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        # 確保 CHTNO 匹配
-        if str(data.get("CHTNO")) == str(chtno_to_find):
-            return data
-        else:
-            print(f"[DEBUG] 用戶 {username} 的 OPD.json 中 CHTNO ({data.get('CHTNO')}) 不匹配請求的 CHTNO ({chtno_to_find})")
-            return None
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"[ERROR] 讀取或解析用戶 {username} 的 OPD.json 失敗: {e}")
-        return None
-
-# --- 新增輔助函式：直接載入指定用戶的 OPD.json 檔案內容 ---
-def load_single_patient_from_user_opd_file(username: str) -> Optional[Dict]:
+    record = find_patient_record_for_user(username, chtno_to_find)
+    return record["data"] if record else None
+
+def find_patient_record_for_user(username: str, chtno_to_find: str, caseno: Optional[str] = None) -> Optional[Dict]:
+    """同上，但回傳含 id / version 的完整紀錄，供 ETag 與條件式更新使用；可指定就診號"""
+    with span("db_read"):
+        record = patient_store.get_patient_record(username, chtno_to_find, caseno=caseno)
+    if record is None:
+        logger.debug("用戶 %s 下找不到 CHTNO 為 %s 的病人紀錄", username, chtno_to_find)
+    return record
+
+# --- ETag：單筆紀錄以 (資料列 id, 版本號) 表示，同一病歷號換成另一次就診時也會改變 ---
+def record_etag(record: Dict) -> str:
+    return f'"{record["id"]}-{record["version"]}"'
+
+def etag_matches(header_value: Optional[str], etag: str) -> bool:
+    """比對 If-None-Match / If-Match 標頭 (可為 * 或以逗號分隔的多個 ETag，忽略弱比對前綴 W/)"""
+    if not header_value:
+        return False
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+# --- 匯出：需註冊在 /patients/{chtno} 之前，否則 "export" 會被當成病歷號 ---
+@router.get("/patients/export")
+async def export_patients_for_user(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    schdate_from: Optional[str] = Query(None, description="SCHDATE 下限 (含)"),
+    schdate_to: Optional[str] = Query(None, description="SCHDATE 上限 (含)"),
+    exedept: Optional[str] = Query(None),
+    exedr: Optional[str] = Query(None),
+    current_username: str = Depends(get_current_username)
+):
     """
-    直接從指定用戶的 OPD.json 檔案中載入其病人資料。
-    假設每個用戶的 OPD.json 檔案只包含一個病患的資料。
+    以 NDJSON (原始病患 JSON，每行一筆) 或 CSV 串流匯出符合條件的病患紀錄。
+    資料庫以固定大小的區塊逐批讀取並逐批送出，整個結果集不會同時存在於記憶體中。
     """
-    opd_file_path = BASE_DATA_DIR / username / "OPD.json"
-    
-    if not opd_file_path.is_file():
-        print(f"[DEBUG] 用戶 {username} 的 OPD.json 檔案不存在: {opd_file_path}")
-        return None
-    
-    try:
-        with open(opd_file_path, "r", encoding="utf-8") as f:
-            raw_data = json.load(f)
-            # 添加除錯輸出：打印從檔案中讀取到的原始資料 (限制長度以防過長)
-            print(f"[DEBUG] 從 {opd_file_path} 讀取到的原始資料 (前500字): {str(raw_data)[:500]}...")
-            return raw_data
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"[ERROR] 讀取或解析用戶 {username} 的 OPD.json 失敗: {e}")
-        return None
-    except Exception as e:
-        print(f"[ERROR] 讀取用戶 {username} 的 OPD.json 時發生未知錯誤: {e}")
-        return None
+    await flush_pending_writes_for_user(current_username)
+    rows = patient_store.iter_patient_rows(
+        current_username,
+        schdate_from=schdate_from, schdate_to=schdate_to, exedept=exedept, exedr=exedr,
+    )
+    media_type, extension = patient_export.EXPORT_FORMATS[format]
+    logger.debug("用戶 %s 匯出病患資料，格式: %s", current_username, format)
+    return StreamingResponse(
+        patient_export.iter_export(rows, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="patients_{current_username}.{extension}"'},
+    )
 
+# --- 全文檢索：同樣需註冊在 /patients/{chtno} 之前 ---
+@router.get("/patients/search")
+async def search_patients_for_user(
+    q: str = Query(..., min_length=1, description="關鍵字：姓名、病歷號、診斷碼或 S/O 內容，以空白分隔的詞需全部符合"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_username: str = Depends(get_current_username)
+):
+    """依相關度排序回傳當前用戶的病患就診紀錄 (每筆為摘要欄位，完整資料請以 CHTNO 查詢)"""
+    await flush_pending_writes_for_user(current_username)
+    engine = patient_store.get_engine()
+    if not patient_search.SEARCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="伺服器的 SQLite 不支援全文檢索 (FTS5)。")
+    start = time.perf_counter()
+    with span("search"):
+        hits, has_more = await run_in_threadpool(patient_search.search, engine, current_username, q, limit, offset)
+    return {
+        "query": q,
+        "hits": hits,
+        "offset": offset,
+        "has_more": has_more,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    }
 
 # --- 主要 API 路由函式：根據當前登入用戶的 CHTNO 獲取病人資料 (保持返回 Patient 格式，如果需要) ---
 @router.get("/patients/{chtno}", response_model=Patient) # 這個路由可以選擇返回 Patient 或 ChtnoPatient
 async def get_patient_by_chtno(
     chtno: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_username: str = Depends(get_current_username)
 ):
-    raw_data = find_patient_by_chtno_in_user_opd_file(current_username, chtno)
+    await flush_pending_writes_for_user(current_username)
+    record = find_patient_record_for_user(current_username, chtno)
 
-    if not raw_data:
+    if not record:
         raise HTTPException(status_code=404, detail=f"找不到用戶 {current_username} 下病歷號為 {chtno} 的病人紀錄。")
 
+    # 版本未變更時不需重新轉換與傳送整筆資料
+    etag = record_etag(record)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    raw_data = record["data"]
+
     # 如果需要，這裡也可以將 raw_data 轉換為 ChtnoPatient 格式再返回
     # 例如: return ChtnoPatient.from_opd_data(raw_data)
     # 但為了兼容原有的 Patient 模型，這裡仍然使用 Patient
@@ -99,49 +148,127 @@ async def get_patient_by_chtno(
         patient_model = Patient(**raw_data)
         return patient_model
     except ValidationError as e: # 使用 ValidationError 捕獲 Pydantic 錯誤
-        print(f"[ERROR] 用戶 {current_username} 的病人資料 Pydantic 模型驗證失敗 (CHTNO: {chtno}): {e.errors()}")
+        logger.error("用戶 %s 的病人資料 Pydantic 模型驗證失敗 (CHTNO: %s): %s", current_username, chtno, e.errors(include_input=False))
         raise HTTPException(status_code=422, detail=e.errors()) # 返回 422 Unprocessable Entity
     except Exception as e:
-        print(f"[ERROR] 用戶 {current_username} 的病人資料轉換失敗 (CHTNO: {chtno}): {e}. 原始資料: {raw_data}")
+        # 原始資料含病患個資，只記錄欄位名稱
+        logger.error("用戶 %s 的病人資料轉換失敗 (CHTNO: %s): %s", current_username, chtno, e, extra=log_fields(keys=sorted(raw_data)))
         raise HTTPException(status_code=500, detail=f"伺服器資料處理失敗: {e}.")
 
-# --- 修改：直接載入當前用戶的 OPD.json 並轉換為 chtno.json 格式 ---
+# --- 載入當前用戶的所有病人資料並轉換為 chtno.json 格式 ---
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
 @router.get("/patients", response_model=List[ChtnoPatient]) # <-- response_model 修改為 List[ChtnoPatient]
-async def get_patient_for_current_user(current_username: str = Depends(get_current_username)):
+async def get_patient_for_current_user(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="每頁筆數"),
+    cursor: Optional[str] = Query(None, description="上一頁回應的 X-Next-Cursor"),
+    schdate_from: Optional[str] = Query(None, description="SCHDATE 下限 (含)"),
+    schdate_to: Optional[str] = Query(None, description="SCHDATE 上限 (含)"),
+    exedept: Optional[str] = Query(None),
+    exedr: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
+    current_username: str = Depends(get_current_username)
+):
     """
     獲取當前登入用戶下的病人資料，並將其轉換為 chtno.json 格式。
-    如果 OPD.json 存在且有效，則返回一個包含該病人資料的列表。
+    最近更新的病人排在第一筆；沒有任何資料時返回空列表。
+    未帶任何分頁或篩選參數時回傳全部資料，轉換結果與序列化後的 JSON 會快取，資料未變更時直接回傳快取內容。
+    帶參數時改為游標分頁 (新建立的紀錄在前，分頁途中編輯的紀錄不會被跳過或重複)：
+    回應主體仍是列表，若還有下一頁則以 X-Next-Cursor 標頭提供游標。
+    回應帶有 ETag，If-None-Match 相符時回傳 304。
     """
-    raw_data = load_single_patient_from_user_opd_file(current_username)
-    
-    if not raw_data:
-        # 如果找不到資料，回傳空列表
-        print(f"[DEBUG] get_patient_for_current_user: 為用戶 {current_username} 找到空資料或 OPD.json 不存在。")
-        return [] 
+    await flush_pending_writes_for_user(current_username)
 
+    paginated = any(value is not None for value in (limit, cursor, schdate_from, schdate_to, exedept, exedr))
+    next_cursor = None
     try:
-        # 使用 ChtnoPatient 模型的 from_opd_data 方法進行轉換
-        chtno_patient_model = ChtnoPatient.from_opd_data(raw_data)
-        # 添加除錯輸出：打印轉換後模型中的 Subjective 和 ObjectiveDetails
-        print(f"[DEBUG] 轉換後的 Subjective: {chtno_patient_model.Subjective}")
-        print(f"[DEBUG] 轉換後的 ObjectiveDetails (前5個): {chtno_patient_model.ObjectiveDetails[:5] if chtno_patient_model.ObjectiveDetails else '無'}")
-        return [chtno_patient_model] # 回傳一個包含轉換後病患資料的列表
+        if not paginated:
+            with span("patient_list"):
+                _, body, etag = patient_cache.get_patient_list(current_username)
+        else:
+            page_size = limit or DEFAULT_PAGE_SIZE
+            try:
+                after = patient_store.decode_cursor(cursor) if cursor else None
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            # 多取一筆判斷是否還有下一頁
+            with span("db_query"):
+                rows = await run_in_threadpool(
+                    patient_store.query_patient_rows, current_username,
+                    schdate_from, schdate_to, exedept, exedr, after, page_size + 1,
+                )
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_cursor = patient_store.encode_cursor(rows[-1].id)
+            with span("serialize"):
+                patients = [ChtnoPatient.from_opd_data(json.loads(row.data), trusted=bool(row.validated)) for row in rows]
+                body = patient_cache.encode_patients(patients)
+                etag = patient_cache.body_etag(body)
+    except HTTPException:
+        raise
     except ValidationError as e: # 捕獲 Pydantic 驗證錯誤
-        print(f"[ERROR] 用戶 {current_username} 的 OPD.json 轉換為 ChtnoPatient 模型失敗: {e.errors()}")
+        logger.error("用戶 %s 的病人資料轉換為 ChtnoPatient 模型失敗: %s", current_username, e.errors(include_input=False))
         raise HTTPException(status_code=422, detail=e.errors()) # 返回 422 Unprocessable Entity
     except Exception as e:
-        print(f"[ERROR] 處理用戶 {current_username} 病患資料時發生未知錯誤: {e}")
+        logger.exception("處理用戶 %s 病患資料時發生未知錯誤: %s", current_username, e)
         raise HTTPException(status_code=500, detail="處理病患資料時發生內部錯誤")
 
-# --- 輔助函數：儲存特定用戶的 OPD.json (恢復為用戶綁定儲存) ---
-def save_patient_data_for_user(username: str, patient_data: Dict):
-    patient_dir = BASE_DATA_DIR / username
-    patient_dir.mkdir(parents=True, exist_ok=True) # 使用 Path.mkdir 確保目錄存在
-    patient_file = patient_dir / "OPD.json"
-    print(f"[DEBUG] 嘗試儲存資料到: {patient_file}")
-    with open(patient_file, "w", encoding="utf-8") as f:
-        json.dump(patient_data, f, ensure_ascii=False, indent=2)
-    print(f"[DEBUG] 資料已儲存到: {patient_file}")
+    headers = {"ETag": etag}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    # 已是符合 response_model 的 JSON，直接回傳以略過再次驗證與序列化
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# --- 輔助函數：儲存特定用戶的病人資料 (只寫入該筆紀錄，不重寫整個檔案) ---
+def save_patient_data_for_user(username: str, patient_data: Dict, validated: Optional[bool] = None) -> int:
+    # 寫入時完整驗證一次，之後的讀取即可走免驗證的建構路徑；呼叫端已驗證時直接傳入結果
+    if validated is None:
+        with span("validate"):
+            validated = is_fully_valid(patient_data)
+
+    try:
+        with span("db_write"):
+            version = patient_store.upsert_patient(username, patient_data, validated=validated)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.debug("用戶 %s 的病人資料已儲存 (CHTNO: %s, 版本: %s)", username, patient_data.get('CHTNO'), version)
+    return version
+
+# --- 自動儲存合併：前端編輯時會連續 PUT 整筆資料，同一筆紀錄在時間窗內只寫入最後一份 ---
+AUTOSAVE_COALESCE_SECONDS = float(os.environ.get("PATIENT_AUTOSAVE_COALESCE_MS", "300")) / 1000
+
+def _autosave_key(username: str, patient_data: Dict) -> tuple:
+    fields = patient_store.extract_index_fields(patient_data)
+    return (username, fields["chtno"], fields["caseno"])
+
+# 待寫內容為 (病患資料, 是否通過完整驗證)；驗證在 PUT 當下完成，延遲寫入時不再重複
+autosave_writer = CoalescingWriter(
+    lambda key, payload: save_patient_data_for_user(key[0], *payload),
+    AUTOSAVE_COALESCE_SECONDS,
+    name="病患自動儲存",
+)
+
+def _autosave_failed(e: DeferredWriteError) -> HTTPException:
+    chtnos = ", ".join(str(key[1]) for key in e.failures)
+    errors = "; ".join(str(error) for error in e.failures.values())
+    return HTTPException(
+        status_code=500,
+        detail=f"病歷號 {chtnos} 的修改儲存失敗，內容已保留並會在下次存取時重試: {errors}",
+    )
+
+async def flush_pending_writes_for_user(username: str):
+    """讀取前先寫入該用戶尚在合併時間窗內的資料，確保讀到最新內容；先前背景寫入失敗時回應 500"""
+    with span("flush_autosave"):
+        try:
+            await autosave_writer.flush_where(lambda key: key[0] == username)
+        except DeferredWriteError as e:
+            raise _autosave_failed(e)
+
+async def flush_all_pending_patient_writes():
+    await autosave_writer.flush_all()
 
 @router.post("/patients")
 async def create_patient_for_user(
@@ -149,10 +276,47 @@ async def create_patient_for_user(
     current_username: str = Depends(get_current_username) 
 ):
     data = await request.json()
-    print(f"[DEBUG] 接收到創建病人資料請求，用戶: {current_username}, 資料 (前200字): {str(data)[:200]}...")
-    save_patient_data_for_user(current_username, data)
+    logger.debug("接收到創建病人資料請求", extra=log_fields(user=current_username, chtno=data.get("CHTNO"), fields=len(data)))
+    # 若同一筆紀錄仍有待寫入的自動儲存，先寫入以維持順序
+    try:
+        await autosave_writer.flush(_autosave_key(current_username, data))
+    except DeferredWriteError as e:
+        raise _autosave_failed(e)
+    # 驗證與 SQLite 寫入交易在執行緒池中執行，不阻塞事件迴圈
+    await run_in_threadpool(save_patient_data_for_user, current_username, data)
     return {"success": True, "chtno": data.get("CHTNO")}
 
+@router.post("/patients/import")
+async def import_patients_for_user(
+    file: UploadFile = File(...),
+    format: Optional[str] = Form(None),
+    batch_size: int = Form(patient_import.DEFAULT_BATCH_SIZE),
+    strict: bool = Form(False),
+    current_username: str = Depends(get_current_username)
+):
+    """
+    批次匯入 HIS 匯出的門診排程 (NDJSON 每行一筆，或含標題列的 CSV)，寫入當前用戶的病患資料。
+    上傳內容由 multipart 解析器暫存於磁碟，逐行讀取、分批驗證與寫入；回傳匯入速度與被拒絕的資料列。
+    """
+    try:
+        fmt = patient_import.detect_format(file.filename, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info("接收到批次匯入請求，用戶: %s, 檔案: %s, 格式: %s", current_username, file.filename, fmt)
+    # 先寫入尚在合併時間窗內的自動儲存，避免稍後覆蓋匯入的資料
+    await flush_pending_writes_for_user(current_username)
+    try:
+        report = await run_in_threadpool(
+            patient_import.import_stream, current_username, file.file, fmt, batch_size, strict
+        )
+    except Exception as e:
+        logger.error("用戶 %s 批次匯入失敗: %s", current_username, e)
+        raise HTTPException(status_code=500, detail=f"批次匯入失敗: {e}")
+    finally:
+        await file.close()
+    return report.model_dump()
+
 @router.put("/patients/{chtno}")
 async def update_patient_for_user(
     chtno: str,
@@ -160,10 +324,149 @@ async def update_patient_for_user(
     current_username: str = Depends(get_current_username) 
 ):
     data = await request.json()
-    print(f"[DEBUG] 接收到更新病人資料請求，用戶: {current_username}, CHTNO: {chtno}, 資料 (前200字): {str(data)[:200]}...")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="病人資料必須是 JSON 物件。")
+    logger.debug("接收到更新病人資料請求", extra=log_fields(user=current_username, chtno=chtno, fields=len(data)))
     if str(data.get("CHTNO")) != str(chtno):
-        print(f"[ERROR] 請求路徑中的 CHTNO ({chtno}) 與資料中的 CHTNO ({data.get('CHTNO')}) 不符。")
+        logger.warning("請求路徑中的 CHTNO (%s) 與資料中的 CHTNO (%s) 不符。", chtno, data.get('CHTNO'))
         raise HTTPException(status_code=400, detail="請求路徑中的 CHTNO 與資料中的 CHTNO 不符。")
-    
-    save_patient_data_for_user(current_username, data)
+
+    # 寫入會延遲到合併時間窗結束，回應前先完成驗證，格式錯誤仍在本次請求回應 400
+    key = _autosave_key(current_username, data)
+    if not key[1]:
+        raise HTTPException(status_code=400, detail="病患資料缺少 CHTNO")
+    with span("validate"):
+        validated = is_fully_valid(data)
+    # 同一筆紀錄先前的背景寫入若失敗，於本次請求回報 (未合併時 submit 會直接寫入，失敗也在此回報)
+    try:
+        autosave_writer.raise_failure(key)
+        await autosave_writer.submit(key, (data, validated))
+    except DeferredWriteError as e:
+        raise _autosave_failed(e)
     return {"success": True, "chtno": chtno}
+
+@router.patch("/patients/{chtno}")
+async def patch_patient_for_user(
+    chtno: str,
+    request: Request,
+    caseno: Optional[str] = Query(None, description="指定就診號；未指定時修改最近一次就診"),
+    if_match: Optional[str] = Header(None),
+    current_username: str = Depends(get_current_username)
+):
+    """
+    以 RFC 6902 JSON Patch 修改一筆病患紀錄，只需傳送變更的欄位。
+    帶 If-Match 時，ETag 與目前版本不符 (他人已修改) 回傳 412；成功時回應新的 ETag。
+    """
+    try:
+        patch = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="JSON Patch 格式錯誤。")
+
+    await flush_pending_writes_for_user(current_username)
+    record = find_patient_record_for_user(current_username, chtno, caseno=caseno)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"找不到用戶 {current_username} 下病歷號為 {chtno} 的病人紀錄。")
+
+    current_etag = record_etag(record)
+    if if_match and not etag_matches(if_match, current_etag):
+        raise HTTPException(status_code=412, detail="病人資料已被修改，請重新載入後再試。", headers={"ETag": current_etag})
+
+    try:
+        patched = apply_patch(record["data"], patch)
+    except JsonPatchTestFailed as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except JsonPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not isinstance(patched, dict):
+        raise HTTPException(status_code=422, detail="修補後的病人資料必須是 JSON 物件。")
+
+    # 病歷號與就診號決定紀錄的身分，不可透過 PATCH 變更
+    before = patient_store.extract_index_fields(record["data"])
+    after = patient_store.extract_index_fields(patched)
+    if (after["chtno"], after["caseno"]) != (before["chtno"], before["caseno"]):
+        raise HTTPException(status_code=422, detail="不可透過 PATCH 修改 CHTNO 或 CASENO。")
+
+    validated = is_fully_valid(patched)
+
+    with span("db_write"):
+        new_version = await run_in_threadpool(
+            patient_store.update_patient_if_version,
+            current_username, record["id"], record["version"], patched, validated,
+        )
+    if new_version is None:
+        # 讀取與寫入之間被其他請求搶先更新
+        raise HTTPException(status_code=412, detail="病人資料已被修改，請重新載入後再試。")
+
+    logger.debug("用戶 %s 以 JSON Patch 更新病人資料 (CHTNO: %s, 版本: %s)", current_username, chtno, new_version)
+    return Response(
+        content=json.dumps({"success": True, "chtno": chtno, "version": new_version}),
+        media_type="application/json",
+        headers={"ETag": record_etag({"id": record["id"], "version": new_version})},
+    )
+
+# --- 修訂歷史 ---
+async def _require_record(username: str, chtno: str, caseno: Optional[str]) -> Dict:
+    await flush_pending_writes_for_user(username)
+    record = find_patient_record_for_user(username, chtno, caseno=caseno)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"找不到用戶 {username} 下病歷號為 {chtno} 的病人紀錄。")
+    return record
+
+@router.get("/patients/{chtno}/revisions")
+async def list_patient_revisions(
+    chtno: str,
+    caseno: Optional[str] = Query(None, description="指定就診號；未指定時為最近一次就診"),
+    current_username: str = Depends(get_current_username)
+):
+    """列出病患紀錄的修訂 (新到舊)，stored_bytes 為該修訂壓縮後的儲存大小"""
+    record = await _require_record(current_username, chtno, caseno)
+    revisions = await run_in_threadpool(patient_history.list_revisions, record["id"])
+    return {"chtno": chtno, "current_version": record["version"], "revisions": revisions}
+
+@router.get("/patients/{chtno}/revisions/{version}")
+async def get_patient_revision(
+    chtno: str,
+    version: int,
+    caseno: Optional[str] = Query(None, description="指定就診號；未指定時為最近一次就診"),
+    current_username: str = Depends(get_current_username)
+):
+    """取得指定版本的完整病患資料"""
+    record = await _require_record(current_username, chtno, caseno)
+    data = await run_in_threadpool(patient_history.get_revision, record["id"], version)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"找不到版本 {version} 的修訂紀錄 (可能已被壓縮合併)。")
+    return {"chtno": chtno, "version": version, "data": data}
+
+@router.post("/patients/{chtno}/revisions/{version}/restore")
+async def restore_patient_revision(
+    chtno: str,
+    version: int,
+    caseno: Optional[str] = Query(None, description="指定就診號；未指定時為最近一次就診"),
+    if_match: Optional[str] = Header(None),
+    current_username: str = Depends(get_current_username)
+):
+    """
+    將紀錄還原為指定版本的內容。還原本身會寫入一個新版本，歷史不會被刪除，因此還原也可以再復原。
+    """
+    record = await _require_record(current_username, chtno, caseno)
+    if if_match and not etag_matches(if_match, record_etag(record)):
+        raise HTTPException(status_code=412, detail="病人資料已被修改，請重新載入後再試。", headers={"ETag": record_etag(record)})
+
+    data = await run_in_threadpool(patient_history.get_revision, record["id"], version)
+    if data is None:
+        raise HTTPException(status_code=404, detail=f"找不到版本 {version} 的修訂紀錄 (可能已被壓縮合併)。")
+
+    validated = is_fully_valid(data)
+    new_version = await run_in_threadpool(
+        patient_store.update_patient_if_version,
+        current_username, record["id"], record["version"], data, validated,
+    )
+    if new_version is None:
+        raise HTTPException(status_code=412, detail="病人資料已被修改，請重新載入後再試。")
+
+    logger.info("用戶 %s 將病人資料還原為版本 %s (CHTNO: %s, 新版本: %s)", current_username, version, chtno, new_version)
+    return Response(
+        content=json.dumps({"success": True, "chtno": chtno, "restored_from": version, "version": new_version}),
+        media_type="application/json",
+        headers={"ETag": record_etag({"id": record["id"], "version": new_version})},
+    )
@@ -0,0 +1,71 @@
+# api/patient_cache.py
+# 病患列表快取：保存每位使用者已轉換好的 ChtnoPatient 列表與序列化後的 JSON，
+# 以寫入世代與資料庫檔案的 stat 判斷是否仍有效
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+from models.chtno_patient_model import ChtnoPatient
+from . import patient_store
+from .metrics import record_cache_lookup
+
+# 最多保留的使用者數，超過時淘汰最久未使用者
+MAX_CACHED_USERS = 512
+
+# username -> (stamp, 病患列表, 序列化後的 JSON bytes, ETag)
+_cache: "OrderedDict[str, Tuple[tuple, List[ChtnoPatient], bytes, str]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _current_stamp(username: str) -> tuple:
+    return (patient_store.get_user_generation(username), patient_store.storage_signature())
+
+
+def encode_patients(patients: List[ChtnoPatient]) -> bytes:
+    # 與 FastAPI JSONResponse 相同的序列化方式
+    return json.dumps(
+        [patient.model_dump(mode="json") for patient in patients],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def body_etag(body: bytes) -> str:
+    """以回應內容的雜湊作為強 ETag：任何一筆紀錄的版本變更都會改變內容"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def get_patient_list(username: str) -> Tuple[List[ChtnoPatient], bytes, str]:
+    """
+    取得使用者的 ChtnoPatient 列表、其 JSON 與 ETag。快取有效時不查詢資料庫也不重新建構模型；
+    寫入時已驗證過的紀錄走 from_opd_data(trusted=True) 的免驗證路徑。
+    """
+    # 先取 stamp 再讀資料：讀取期間若有寫入，下次請求的 stamp 必然不同
+    stamp = _current_stamp(username)
+    with _cache_lock:
+        entry = _cache.get(username)
+        if entry is not None and entry[0] == stamp:
+            _cache.move_to_end(username)
+            record_cache_lookup("patient_list", True)
+            return entry[1], entry[2], entry[3]
+    record_cache_lookup("patient_list", False)
+
+    records = patient_store.list_patient_records(username)
+    patients = [ChtnoPatient.from_opd_data(record["data"], trusted=record["validated"]) for record in records]
+    body = encode_patients(patients)
+    etag = body_etag(body)
+
+    with _cache_lock:
+        _cache[username] = (stamp, patients, body, etag)
+        _cache.move_to_end(username)
+        while len(_cache) > MAX_CACHED_USERS:
+            _cache.popitem(last=False)
+    return patients, body, etag
+
+
+def invalidate_user(username: str) -> None:
+    with _cache_lock:
+        _cache.pop(username, None)
@@ -0,0 +1,66 @@
+# api/patient_export.py
+# 病患資料匯出：逐筆產生 NDJSON / CSV，搭配 StreamingResponse 使用，不會在記憶體中組出完整結果
+
+import io
+import csv
+import json
+from typing import Dict, Iterable, Iterator
+
+from .patient_import import CSV_COLUMNS, CSV_JSON_FIELDS
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+}
+
+
+def iter_ndjson(rows: Iterable) -> Iterator[bytes]:
+    # data 欄位本身就是 JSON 字串，直接輸出不需重新解析
+    for row in rows:
+        yield (row.data + "\n").encode("utf-8")
+
+
+def _csv_value(data: Dict, column: str):
+    # 兩種格式的大小寫不同 (OPD.json 為 CASENO/SUBJECTIVE，前端 chtno 格式為 caseno/Subjective)
+    value = data.get(column)
+    if value is None:
+        value = data.get(column.upper() if column != column.upper() else column.lower())
+    if value is None:
+        return ""
+    if column in CSV_JSON_FIELDS or isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def iter_csv(rows: Iterable) -> Iterator[bytes]:
+    """逐筆輸出 CSV；開頭加上 BOM 讓 Excel 正確辨識 UTF-8，匯入時會自動略過"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        data = json.loads(row.data)
+        writer.writerow([_csv_value(data, column) for column in CSV_COLUMNS])
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _coalesce_chunks(chunks: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    # StreamingResponse 每取一個區塊就切換一次執行緒，逐筆輸出太碎，合併成較大的區塊再送出
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= chunk_size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b"".join(pending)
+
+
+def iter_export(rows: Iterable, fmt: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    chunks = iter_csv(rows) if fmt == "csv" else iter_ndjson(rows)
+    return _coalesce_chunks(chunks, chunk_size)
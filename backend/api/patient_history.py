@@ -0,0 +1,195 @@
+# api/patient_history.py
+# 病患紀錄修訂歷史：重建任一版本、列出修訂，以及合併自動儲存產生的密集修訂的背景壓縮
+
+import os
+import time
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam, delete, select, text, update
+from starlette.concurrency import run_in_threadpool
+
+from models.user_model import get_tw_time
+from . import patient_store
+from .json_patch import apply_patch, make_patch
+from .app_logging import get_logger, log_fields
+
+logger = get_logger("patient_history")
+
+revisions = patient_store.revisions_table
+
+# 早於此時間的修訂才會被壓縮，近期的修訂全部保留供復原
+COMPACT_AFTER_HOURS = float(os.environ.get("PATIENT_HISTORY_COMPACT_AFTER_HOURS", "24"))
+# 與下一個修訂間隔在此秒數內的修訂 (例如連續自動儲存) 壓縮時只保留最後一個
+MERGE_WINDOW_SECONDS = float(os.environ.get("PATIENT_HISTORY_MERGE_WINDOW_SECONDS", "120"))
+# 背景壓縮的執行間隔，0 表示停用
+COMPACT_INTERVAL_SECONDS = float(os.environ.get("PATIENT_HISTORY_COMPACT_INTERVAL_SECONDS", "3600"))
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+# --- 查詢 ---
+def list_revisions(patient_id: int) -> List[Dict]:
+    stmt = (
+        select(revisions.c.version, revisions.c.kind, revisions.c.created_at, revisions.c.payload)
+        .where(revisions.c.patient_id == patient_id)
+        .order_by(revisions.c.version.desc())
+    )
+    with patient_store.get_engine().connect() as conn:
+        return [
+            {"version": row.version, "kind": row.kind, "created_at": row.created_at, "stored_bytes": len(row.payload)}
+            for row in conn.execute(stmt)
+        ]
+
+
+def get_revision(patient_id: int, version: int) -> Optional[Dict]:
+    """
+    重建指定版本的病患資料：從不晚於該版本的最近快照開始，依序套用之後的 delta。
+    該版本不存在 (或已被壓縮合併) 時回傳 None。
+    """
+    c = revisions.c
+    latest_snapshot = (
+        select(c.version)
+        .where(c.patient_id == patient_id, c.kind == "snapshot", c.version <= version)
+        .order_by(c.version.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = (
+        select(c.version, c.kind, c.payload)
+        .where(c.patient_id == patient_id, c.version >= latest_snapshot, c.version <= version)
+        .order_by(c.version)
+    )
+    with patient_store.get_engine().connect() as conn:
+        rows = conn.execute(stmt).all()
+    if not rows or rows[-1].version != version:
+        return None
+
+    document = patient_store.decode_payload(rows[0].payload)
+    for row in rows[1:]:
+        document = apply_patch(document, patient_store.decode_payload(row.payload))
+    return document
+
+
+# --- 壓縮 ---
+def _parse_time(value: str) -> datetime:
+    return datetime.strptime(value, _TIME_FORMAT)
+
+
+def _compact_patient(conn, patient_id: int, cutoff: str) -> int:
+    """
+    壓縮單一紀錄的修訂，回傳刪除的修訂數。早於 cutoff 且與下一個修訂相隔不到 MERGE_WINDOW_SECONDS 的修訂會被移除；
+    保留下來的修訂重新編碼 (delta 改為相對於前一個保留的修訂，並維持快照間隔)。最新的修訂一定保留。
+    """
+    rows = conn.execute(
+        select(revisions.c.id, revisions.c.version, revisions.c.kind, revisions.c.payload, revisions.c.created_at)
+        .where(revisions.c.patient_id == patient_id)
+        .order_by(revisions.c.version)
+    ).all()
+    if len(rows) < 2 or rows[0].kind != "snapshot":
+        return 0
+
+    documents = []
+    document = None
+    for row in rows:
+        payload = patient_store.decode_payload(row.payload)
+        document = payload if row.kind == "snapshot" else apply_patch(document, payload)
+        documents.append(document)
+
+    kept, dropped = [], []
+    for i, row in enumerate(rows):
+        is_last = i == len(rows) - 1
+        if is_last or row.created_at >= cutoff or \
+                (_parse_time(rows[i + 1].created_at) - _parse_time(row.created_at)).total_seconds() > MERGE_WINDOW_SECONDS:
+            kept.append(i)
+        else:
+            dropped.append(row.id)
+    if not dropped:
+        return 0
+
+    updates = []
+    previous = None
+    last_snapshot = None
+    for i in kept:
+        row, document = rows[i], documents[i]
+        if previous is None or row.version - last_snapshot >= patient_store.SNAPSHOT_INTERVAL:
+            kind, payload = "snapshot", patient_store.encode_payload(document)
+            last_snapshot = row.version
+        else:
+            kind, payload = "delta", patient_store.encode_payload(make_patch(previous, document))
+        previous = document
+        if kind != row.kind or payload != row.payload:
+            updates.append({"row_id": row.id, "new_kind": kind, "new_payload": payload})
+
+    conn.execute(delete(revisions).where(revisions.c.id.in_(dropped)))
+    if updates:
+        conn.execute(
+            update(revisions)
+            .where(revisions.c.id == bindparam("row_id"))
+            .values(kind=bindparam("new_kind"), payload=bindparam("new_payload")),
+            updates,
+        )
+    return len(dropped)
+
+
+def compact_history() -> Dict:
+    """
+    壓縮所有紀錄的修訂歷史。先以視窗函式找出有可合併修訂的紀錄，再逐筆在各自的短交易中處理，
+    避免長時間持有寫入鎖。
+    """
+    start = time.perf_counter()
+    cutoff = (get_tw_time() - timedelta(hours=COMPACT_AFTER_HOURS)).strftime(_TIME_FORMAT)[:-3]
+    candidates_sql = text(
+        "SELECT DISTINCT patient_id FROM ("
+        "  SELECT patient_id, created_at,"
+        "         LEAD(created_at) OVER (PARTITION BY patient_id ORDER BY version) AS next_at"
+        "  FROM patient_revisions"
+        ") WHERE next_at IS NOT NULL AND created_at < :cutoff"
+        "  AND (julianday(next_at) - julianday(created_at)) * 86400 <= :window"
+    )
+    with patient_store.get_engine().connect() as conn:
+        patient_ids = [row[0] for row in conn.execute(candidates_sql, {"cutoff": cutoff, "window": MERGE_WINDOW_SECONDS})]
+
+    removed = 0
+    for patient_id in patient_ids:
+        with patient_store.write_transaction() as conn:
+            removed += _compact_patient(conn, patient_id, cutoff)
+
+    report = {
+        "patients": len(patient_ids),
+        "removed_revisions": removed,
+        "elapsed_seconds": round(time.perf_counter() - start, 3),
+    }
+    logger.info("修訂歷史壓縮完成", extra=log_fields(**report))
+    return report
+
+
+# --- 背景壓縮工作 ---
+_compaction_task: Optional[asyncio.Task] = None
+
+
+async def _compaction_loop():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(compact_history)
+        except Exception:
+            logger.error("修訂歷史壓縮失敗", exc_info=True)
+
+
+def start_compaction_task() -> None:
+    global _compaction_task
+    if COMPACT_INTERVAL_SECONDS > 0 and _compaction_task is None:
+        _compaction_task = asyncio.create_task(_compaction_loop())
+
+
+async def stop_compaction_task() -> None:
+    global _compaction_task
+    if _compaction_task is not None:
+        _compaction_task.cancel()
+        try:
+            await _compaction_task
+        except asyncio.CancelledError:
+            pass
+        _compaction_task = None
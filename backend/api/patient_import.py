@@ -0,0 +1,235 @@
+# api/patient_import.py
+# 病患批次匯入：逐行串流解析 HIS 匯出的 NDJSON / CSV 門診排程，分批驗證後以大交易寫入病患資料庫
+
+import io
+import csv
+import json
+import time
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel, ValidationError
+
+from models.chtno_patient_model import ChtnoPatient
+from models.patient_model import Patient
+from . import patient_store
+from .app_logging import get_logger, log_fields
+
+logger = get_logger("patient_import")
+
+SUPPORTED_FORMATS = ("ndjson", "csv")
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 20000
+# 報告中最多列出的拒絕筆數 (總數仍完整計算)
+MAX_REPORTED_REJECTIONS = 100
+
+# CSV 欄位皆為字串，數值欄位需先轉型 (from_opd_data 會以數值計算 BMI)
+CSV_NUMERIC_FIELDS = {"AGE": int, "HEIGHT": float, "WEIGHT": float, "BMI": float, "PULSE": int}
+# CSV 中以 JSON 字串表示的欄位
+CSV_JSON_FIELDS = ("Assessment", "ASSESSMENT", "ObjectiveDetails")
+# 匯出 CSV 的欄位順序 (匯入時依標題列對應，欄位順序不拘)
+CSV_COLUMNS = (
+    "CHTNO", "NAME", "CASENO", "SCHDATE", "EXEDEPT", "EXEDR",
+    "AGE", "GENDER", "HEIGHT", "WEIGHT", "BMI", "PULSE", "BP",
+    "ALLERGY", "IDENTITY", "NOTE", "Subjective", "Objective", "ObjectiveDetails", "Assessment",
+)
+
+
+class RejectedRow(BaseModel):
+    line: int  # 來源檔案中的行號 (從 1 起算)
+    chtno: Optional[str] = None
+    reason: str
+
+
+class ImportReport(BaseModel):
+    format: str
+    total_rows: int = 0
+    imported: int = 0
+    rejected: int = 0
+    rejected_rows: List[RejectedRow] = []
+    batches: int = 0
+    elapsed_seconds: float = 0.0
+    rows_per_second: float = 0.0
+
+
+class _RowError(Exception):
+    def __init__(self, reason: str, chtno: Optional[str] = None):
+        super().__init__(reason)
+        self.chtno = chtno
+
+
+def detect_format(filename: Optional[str], declared_format: Optional[str] = None) -> str:
+    """以明確指定的格式優先，否則依副檔名判斷 (.csv 為 CSV，其餘視為 NDJSON)"""
+    if declared_format:
+        fmt = declared_format.lower()
+        if fmt in ("jsonl", "json"):
+            fmt = "ndjson"
+        if fmt not in SUPPORTED_FORMATS:
+            raise ValueError(f"不支援的匯入格式: {declared_format}，僅支援 {', '.join(SUPPORTED_FORMATS)}")
+        return fmt
+    if filename and filename.lower().endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+# --- 串流解析：一次只持有一行，回傳 (行號, 病患資料) 或 (行號, 錯誤) ---
+def iter_ndjson_records(stream: IO[bytes]) -> Iterator[Tuple[int, object]]:
+    for line_no, raw_line in enumerate(stream, start=1):
+        if line_no == 1 and raw_line.startswith(b"\xef\xbb\xbf"):
+            raw_line = raw_line[3:]
+        if not raw_line.strip():
+            continue
+        try:
+            record = json.loads(raw_line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            yield line_no, _RowError(f"JSON 格式錯誤: {e}")
+            continue
+        if not isinstance(record, dict):
+            yield line_no, _RowError("每一行必須是一個 JSON 物件")
+            continue
+        yield line_no, record
+
+
+def _csv_row_to_record(row: Dict[str, Optional[str]]) -> Dict:
+    record = {}
+    for key, value in row.items():
+        if key is None or value is None:
+            continue  # 欄位數多於標題列的部分
+        key = key.strip()
+        value = value.strip()
+        if not key or value == "":
+            continue
+        if key in CSV_NUMERIC_FIELDS:
+            try:
+                number = float(value)
+            except ValueError:
+                raise _RowError(f"欄位 {key} 不是數值: {value}")
+            if CSV_NUMERIC_FIELDS[key] is int:
+                if not number.is_integer():
+                    raise _RowError(f"欄位 {key} 必須是整數: {value}")
+                number = int(number)
+            record[key] = number
+        elif key in CSV_JSON_FIELDS:
+            try:
+                record[key] = json.loads(value)
+            except json.JSONDecodeError as e:
+                raise _RowError(f"欄位 {key} 的 JSON 格式錯誤: {e}")
+        else:
+            record[key] = value.replace("\r\n", "\n")
+    return record
+
+
+def iter_csv_records(stream: IO[bytes]) -> Iterator[Tuple[int, object]]:
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            # line_num 為目前讀到的實體行，欄位內含換行時指向該筆的最後一行
+            try:
+                yield reader.line_num, _csv_row_to_record(row)
+            except _RowError as e:
+                e.chtno = (row.get("CHTNO") or "").strip() or None
+                yield reader.line_num, e
+    finally:
+        # 不關閉呼叫端的串流
+        text_stream.detach()
+
+
+def iter_records(stream: IO[bytes], fmt: str) -> Iterator[Tuple[int, object]]:
+    return iter_csv_records(stream) if fmt == "csv" else iter_ndjson_records(stream)
+
+
+# --- 驗證 ---
+def _describe_validation_error(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors())
+
+
+def validate_record(record: Dict, strict: bool = False) -> Optional[str]:
+    """
+    以 ChtnoPatient (列表 API 的輸出模型) 驗證一筆資料，strict 時另需符合 Patient 模型
+    (GET /patients/{chtno} 的輸出模型，要求完整的 OPD.json 欄位)。通過回傳 None，否則回傳原因。
+    ObjectiveDetails 中有任何項目無法解析時也視為不通過 (匯入的紀錄一律標記為已驗證，讀取時不再逐項驗證)。
+    """
+    if not str(record.get("CHTNO") or "").strip():
+        return "缺少 CHTNO"
+    rejected: List[str] = []
+    try:
+        ChtnoPatient.from_opd_data(record, rejected=rejected)
+        if rejected:
+            return "; ".join(rejected)
+        if strict:
+            Patient(**record)
+    except ValidationError as e:
+        return _describe_validation_error(e)
+    except (TypeError, ValueError, AttributeError) as e:
+        return f"資料格式錯誤: {e}"
+    return None
+
+
+# --- 匯入 ---
+def _iter_batches(records: Iterable[Tuple[int, object]], batch_size: int) -> Iterator[List[Tuple[int, object]]]:
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_records(
+    username: str,
+    records: Iterable[Tuple[int, object]],
+    fmt: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    strict: bool = False,
+) -> ImportReport:
+    """
+    分批驗證並寫入病患資料：每批通過驗證的紀錄在同一個交易中 upsert。
+    驗證失敗的資料列記入報告，不影響同批其他資料列。
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    report = ImportReport(format=fmt)
+    start = time.perf_counter()
+
+    def reject(line_no: int, chtno: Optional[str], reason: str):
+        report.rejected += 1
+        if len(report.rejected_rows) < MAX_REPORTED_REJECTIONS:
+            report.rejected_rows.append(RejectedRow(line=line_no, chtno=chtno, reason=reason))
+
+    for batch in _iter_batches(records, batch_size):
+        accepted: List[Tuple[Dict, bool]] = []
+        for line_no, record in batch:
+            report.total_rows += 1
+            if isinstance(record, _RowError):
+                reject(line_no, record.chtno, str(record))
+                continue
+            reason = validate_record(record, strict)
+            if reason:
+                chtno = record.get("CHTNO")
+                reject(line_no, str(chtno) if chtno is not None else None, reason)
+                continue
+            accepted.append((record, True))
+
+        if accepted:
+            report.imported += patient_store.upsert_patients(username, accepted)
+            report.batches += 1
+
+    report.elapsed_seconds = round(time.perf_counter() - start, 3)
+    report.rows_per_second = round(report.total_rows / report.elapsed_seconds, 1) if report.elapsed_seconds else 0.0
+    logger.info("批次匯入完成", extra=log_fields(
+        user=username, total_rows=report.total_rows, imported=report.imported,
+        rejected=report.rejected, rows_per_second=report.rows_per_second,
+    ))
+    return report
+
+
+def import_stream(
+    username: str,
+    stream: IO[bytes],
+    fmt: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    strict: bool = False,
+) -> ImportReport:
+    """從位元組串流 (上傳檔案或本機檔案) 匯入，整個檔案不會一次載入記憶體"""
+    return import_records(username, iter_records(stream, fmt), fmt, batch_size, strict)
@@ -0,0 +1,197 @@
+# api/patient_search.py
+# 病患全文檢索：SQLite FTS5 倒排索引，於每次寫入病患資料時在同一交易中更新。
+# FTS5 內建的 unicode61 斷詞會把連續的中文字視為一個詞，因此寫入與查詢前都先把中日韓文字拆成重疊的雙字詞 (bigram)。
+# 擁有者以雜湊後的單一 token 存於索引的 owner 欄位，查詢時在 MATCH 中一併比對，只在呼叫者自己的紀錄中檢索。
+
+import re
+import json
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from .app_logging import get_logger
+
+logger = get_logger("patient_search")
+
+SEARCH_TABLE = "patients_fts"
+# 欄位順序同時決定 bm25 權重的順序
+SEARCH_COLUMNS = ("name", "chtno", "codes", "subjective", "objective")
+COLUMN_WEIGHTS = (10.0, 10.0, 5.0, 1.0, 1.0)
+# 擁有者欄位 (排在內容欄位之後，不參與相關度計算)
+OWNER_COLUMN = "owner"
+_INDEX_COLUMNS = SEARCH_COLUMNS + (OWNER_COLUMN,)
+
+# FTS5 是否可用 (部分 SQLite 編譯版本未包含)，由 ensure_search_index 設定
+SEARCH_AVAILABLE = False
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"  # 假名、中日韓統一表意文字、韓文
+_CJK_RUN = re.compile(f"[{_CJK}]+")
+_QUERY_TOKEN = re.compile(f"[{_CJK}]+|[^\\W_]+")
+
+
+# --- 文字前處理 ---
+def _cjk_grams(run: str, for_query: bool) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    grams = [run[i:i + 2] for i in range(len(run) - 1)]
+    # 索引時補上最後一個字，讓單字查詢 (以前綴比對) 也能找到位於詞尾的字
+    return grams if for_query else grams + [run[-1]]
+
+
+def to_index_text(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    return _CJK_RUN.sub(lambda m: " " + " ".join(_cjk_grams(m.group(0), for_query=False)) + " ", value)
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    將使用者輸入轉為 FTS5 查詢：以空白分隔的每個詞都必須出現 (AND)，
+    每個詞轉為片語並以最後一個 token 做前綴比對，例如 "高血壓 J00" -> '"高血 血壓" * AND "J00" *'。
+    只保留文字與數字，使用者輸入不會被當成 FTS5 語法。
+    """
+    phrases = []
+    for term in query.split():
+        tokens = []
+        for piece in _QUERY_TOKEN.findall(term):
+            tokens.extend(_cjk_grams(piece, for_query=True) if _CJK_RUN.fullmatch(piece) else [piece])
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '" *')
+    return " AND ".join(phrases) if phrases else None
+
+
+def _first(data: Dict, *keys: str) -> str:
+    for key in keys:
+        value = data.get(key)
+        if value:
+            return str(value)
+    return ""
+
+
+def search_document(data: Dict) -> Tuple[str, ...]:
+    """擷取病患資料中要索引的欄位，依 SEARCH_COLUMNS 的順序回傳前處理後的文字"""
+    codes = []
+    for key in ("Assessment", "ASSESSMENT"):
+        items = data.get(key)
+        if isinstance(items, list):
+            for item in items:
+                if isinstance(item, dict):
+                    codes.append(_first(item, "code", "ICDX"))
+                    codes.append(_first(item, "name", "ICDX_NAME"))
+    objective = _first(data, "Objective", "OBJECTIVE")
+    if not objective and isinstance(data.get("ObjectiveDetails"), list):
+        objective = "\n".join(
+            str(detail.get("original_line", "")) for detail in data["ObjectiveDetails"] if isinstance(detail, dict)
+        )
+    return (
+        to_index_text(_first(data, "NAME")),
+        to_index_text(" ".join(filter(None, (_first(data, "CHTNO"), _first(data, "CASENO", "caseno"))))),
+        to_index_text(" ".join(filter(None, codes))),
+        to_index_text(_first(data, "Subjective", "SUBJECTIVE")),
+        to_index_text(objective),
+    )
+
+
+def owner_token(username: str) -> str:
+    """使用者名稱可能含斷詞時會被拆開的符號，以雜湊轉為單一英數 token，確保只比對到同一位使用者"""
+    return "u" + hashlib.sha256(username.encode("utf-8")).hexdigest()[:24]
+
+
+# --- 索引維護 ---
+_CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    + ", ".join(_INDEX_COLUMNS)
+    + ", tokenize='unicode61 remove_diacritics 2')"
+)
+_DELETE_SQL = f"DELETE FROM {SEARCH_TABLE} WHERE rowid = ?"
+_INSERT_SQL = (
+    f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(_INDEX_COLUMNS)}) VALUES (?{', ?' * len(_INDEX_COLUMNS)})"
+)
+
+
+def index_patients(conn, username: str, entries: List[Tuple[int, Dict]]) -> None:
+    """在呼叫端的寫入交易中更新索引；entries 為 username 的 (patients.id, 病患資料)"""
+    if not SEARCH_AVAILABLE or not entries:
+        return
+    owner = owner_token(username)
+    conn.exec_driver_sql(_DELETE_SQL, [(patient_id,) for patient_id, _ in entries])
+    conn.exec_driver_sql(_INSERT_SQL, [(patient_id, *search_document(data), owner) for patient_id, data in entries])
+
+
+def ensure_search_index(engine: Engine, batch_size: int = 1000) -> None:
+    """建立 FTS5 資料表，並補建尚未索引的紀錄 (例如啟用此功能前就已存在的資料)"""
+    global SEARCH_AVAILABLE
+    try:
+        with engine.begin() as conn:
+            # 舊版索引沒有 owner 欄位：整個重建 (下方的補建流程會重新索引所有紀錄)
+            columns = [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({SEARCH_TABLE})")]
+            if columns and OWNER_COLUMN not in columns:
+                conn.exec_driver_sql(f"DROP TABLE {SEARCH_TABLE}")
+                logger.info("病患全文檢索索引缺少擁有者欄位，將重建")
+            conn.exec_driver_sql(_CREATE_SQL)
+    except Exception as e:
+        logger.warning("此 SQLite 不支援 FTS5，病患全文檢索停用: %s", e)
+        SEARCH_AVAILABLE = False
+        return
+    SEARCH_AVAILABLE = True
+
+    missing_sql = text(
+        f"SELECT id, username, data FROM patients WHERE id > :after AND id NOT IN (SELECT rowid FROM {SEARCH_TABLE}) "
+        "ORDER BY id LIMIT :limit"
+    )
+    indexed = 0
+    after = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(missing_sql, {"after": after, "limit": batch_size}).all()
+            if not rows:
+                break
+            by_user: Dict[str, List[Tuple[int, Dict]]] = {}
+            for row in rows:
+                by_user.setdefault(row.username, []).append((row.id, json.loads(row.data)))
+            for username, entries in by_user.items():
+                index_patients(conn, username, entries)
+        indexed += len(rows)
+        after = rows[-1].id
+    if indexed:
+        logger.info("病患全文檢索索引已補建 %d 筆", indexed)
+
+
+# --- 查詢 ---
+def search(engine: Engine, username: str, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[Dict], bool]:
+    """
+    依 bm25 相關度排序 (姓名、病歷號權重最高，其次為診斷，再來是 S/O 內容)，回傳 (命中列表, 是否還有下一頁)。
+    擁有者條件放在 MATCH 中，由 FTS5 在索引內與查詢詞一併比對，不會先找出所有使用者的命中再過濾；
+    查詢詞限定在內容欄位，不會比對到 owner 欄位。
+    """
+    terms = build_match_query(query)
+    if terms is None:
+        return [], False
+    match = f'{OWNER_COLUMN} : "{owner_token(username)}" AND {{{" ".join(SEARCH_COLUMNS)}}} : ({terms})'
+    weights = ", ".join(str(w) for w in COLUMN_WEIGHTS + (0.0,))
+    sql = text(
+        f"SELECT p.chtno, p.caseno, p.name, p.schdate, p.exedept, p.exedr, p.updated_at, "
+        f"       bm25({SEARCH_TABLE}, {weights}) AS score "
+        f"FROM {SEARCH_TABLE} JOIN patients p ON p.id = {SEARCH_TABLE}.rowid "
+        f"WHERE {SEARCH_TABLE} MATCH :match AND p.username = :username "
+        "ORDER BY score LIMIT :limit OFFSET :offset"
+    )
+    with engine.connect() as conn:
+        rows = conn.execute(sql, {"match": match, "username": username, "limit": limit + 1, "offset": offset}).all()
+    hits = [
+        {
+            "CHTNO": row.chtno,
+            "caseno": row.caseno,
+            "NAME": row.name,
+            "SCHDATE": row.schdate,
+            "EXEDEPT": row.exedept,
+            "EXEDR": row.exedr,
+            "updated_at": row.updated_at,
+            # bm25 越小越相關，轉為越大越相關較直覺
+            "score": round(-row.score, 4),
+        }
+        for row in rows[:limit]
+    ]
+    return hits, len(rows) > limit
@@ -0,0 +1,516 @@
+# api/patient_store.py
+# 病患資料庫：以 SQLite (WAL 模式) 儲存每位使用者的多筆病患紀錄，取代單一的 data/{username}/OPD.json
+
+import os
+import json
+import zlib
+import base64
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import (
+    Column, Index, Integer, LargeBinary, MetaData, String, Table, Text,
+    and_, case, create_engine, event, func, select,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+
+from models.user_model import get_tw_time
+from .json_patch import make_patch
+from . import patient_search
+from .app_logging import get_logger, log_fields
+
+logger = get_logger("patient_store")
+
+BASE_DATA_DIR = Path(__file__).parent.parent / 'data'
+PATIENT_DB_PATH = Path(os.environ.get("PATIENT_DB_PATH", BASE_DATA_DIR / "patients.db"))
+
+metadata = MetaData()
+
+# 一筆紀錄代表某位使用者 (醫師) 的一個病患就診 (CHTNO + CASENO)。
+# 完整的病患 JSON 存在 data 欄位，常用查詢條件另外拆成有索引的欄位。
+patients_table = Table(
+    "patients",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("username", String, nullable=False),
+    Column("chtno", String, nullable=False),
+    Column("caseno", String, nullable=False, default=""),
+    Column("schdate", String, nullable=False, default=""),
+    Column("exedept", String, nullable=False, default=""),
+    Column("exedr", String, nullable=False, default=""),
+    Column("name", String, nullable=False, default=""),
+    Column("data", Text, nullable=False),
+    Column("version", Integer, nullable=False, default=1),
+    Column("updated_at", String, nullable=False),
+    # 1 表示寫入時已通過 ChtnoPatient.from_opd_data 驗證，讀取時可走免驗證的建構路徑
+    Column("validated", Integer, nullable=False, default=0, server_default="0"),
+    # (username, chtno) 為最左前綴，同時服務依病歷號的查詢
+    Index("ux_patients_username_chtno_caseno", "username", "chtno", "caseno", unique=True),
+    Index("ix_patients_schdate", "schdate"),
+    Index("ix_patients_caseno", "caseno"),
+    # 完整列表依更新時間排序
+    Index("ix_patients_username_updated_at", "username", "updated_at", "id"),
+    # 分頁與匯出依不會變動的 id 分頁 (keyset)
+    Index("ix_patients_username_id", "username", "id"),
+)
+
+# 修訂紀錄 (只增不改)：每次寫入 patients 時在同一交易中新增一筆。
+# kind 為 snapshot 時 payload 是完整病患 JSON，delta 時是相對前一修訂的 JSON Patch；皆以 zlib 壓縮。
+revisions_table = Table(
+    "patient_revisions",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("patient_id", Integer, nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("kind", String, nullable=False),
+    Column("payload", LargeBinary, nullable=False),
+    Column("created_at", String, nullable=False),
+    Index("ux_patient_revisions_patient_version", "patient_id", "version", unique=True),
+)
+
+# 每隔幾個修訂存一次完整快照，重建任一版本最多只需套用這麼多個 delta
+SNAPSHOT_INTERVAL = max(1, int(os.environ.get("PATIENT_HISTORY_SNAPSHOT_INTERVAL", "20")))
+
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+
+# 每位使用者的寫入世代：每次寫入 +1，讓讀取端快取得知資料已變更
+_user_generations: Dict[str, int] = {}
+
+# 已檢查過舊版 OPD.json 的使用者，避免每次請求都去碰檔案系統
+_legacy_checked_users = set()
+_legacy_lock = threading.Lock()
+
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL：讀取不會被寫入阻塞；NORMAL 在 WAL 下仍保證不會損毀資料庫
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _migrate_schema(engine: Engine) -> None:
+    """舊版資料庫缺少後來新增的欄位或索引時補上 (create_all 不會修改既有資料表)"""
+    with engine.begin() as conn:
+        existing = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(patients)")}
+        for column in patients_table.columns:
+            if column.name not in existing:
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                conn.exec_driver_sql(f"ALTER TABLE patients ADD COLUMN {column.name} {column.type.compile(engine.dialect)} NOT NULL{default}")
+                logger.info("病患資料庫新增欄位: %s", column.name)
+        # 後來新增的索引 (create_all 只在資料表不存在時建立索引)
+        for index in patients_table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def get_engine() -> Engine:
+    """延遲建立資料庫連線，第一次呼叫時建立資料表與索引"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                PATIENT_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+                engine = create_engine(
+                    f"sqlite:///{PATIENT_DB_PATH}",
+                    connect_args={"check_same_thread": False},
+                )
+                event.listen(engine, "connect", _configure_sqlite)
+                metadata.create_all(engine)
+                _migrate_schema(engine)
+                patient_search.ensure_search_index(engine)
+                logger.debug("病患資料庫已就緒: %s", PATIENT_DB_PATH)
+                _engine = engine
+    return _engine
+
+
+# --- 欄位擷取 ---
+def _field(data: Dict, *keys: str) -> str:
+    """依序嘗試多個鍵名 (OPD.json 與前端 chtno 格式的大小寫不同)，回傳字串"""
+    for key in keys:
+        value = data.get(key)
+        if value is not None:
+            return str(value)
+    return ""
+
+
+def extract_index_fields(patient_data: Dict) -> Dict[str, str]:
+    return {
+        "chtno": _field(patient_data, "CHTNO"),
+        "caseno": _field(patient_data, "CASENO", "caseno"),
+        "schdate": _field(patient_data, "SCHDATE"),
+        "exedept": _field(patient_data, "EXEDEPT"),
+        "exedr": _field(patient_data, "EXEDR"),
+        "name": _field(patient_data, "NAME"),
+    }
+
+
+# --- 舊版 OPD.json 匯入 ---
+def _import_legacy_opd_file(username: str) -> None:
+    """第一次存取某使用者時，若其 OPD.json 存在且資料庫中尚無紀錄，將其匯入"""
+    if username in _legacy_checked_users:
+        return
+    with _legacy_lock:
+        if username in _legacy_checked_users:
+            return
+        opd_file_path = BASE_DATA_DIR / username / "OPD.json"
+        if opd_file_path.is_file() and count_patients(username) == 0:
+            try:
+                with open(opd_file_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and data.get("CHTNO"):
+                    upsert_patient(username, data)
+                    logger.info("已將舊版 OPD.json 匯入病患資料庫", extra=log_fields(user=username))
+            except (json.JSONDecodeError, IOError):
+                logger.error("匯入舊版 OPD.json 失敗", extra=log_fields(user=username), exc_info=True)
+        _legacy_checked_users.add(username)
+
+
+# --- 快取失效判斷 ---
+def get_user_generation(username: str) -> int:
+    return _user_generations.get(username, 0)
+
+
+def bump_user_generation(username: str) -> None:
+    _user_generations[username] = _user_generations.get(username, 0) + 1
+
+
+def storage_signature() -> tuple:
+    """
+    資料庫檔案 (含 WAL) 的 mtime 與大小。其他行程 (例如批次匯入工具) 寫入時會改變此值，
+    讓本行程的快取也能發現變更；只需要兩次 stat，遠比重新查詢便宜。
+    """
+    signature = []
+    for path in (PATIENT_DB_PATH, PATIENT_DB_PATH.with_name(PATIENT_DB_PATH.name + "-wal")):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+# --- 查詢 ---
+def _row_to_record(row) -> Dict:
+    return {
+        "id": row.id,
+        "data": json.loads(row.data),
+        "version": row.version,
+        "updated_at": row.updated_at,
+    }
+
+
+def count_patients(username: str) -> int:
+    with get_engine().connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(patients_table).where(patients_table.c.username == username)
+        ).scalar_one()
+
+
+def get_patient_record(username: str, chtno: str, caseno: Optional[str] = None) -> Optional[Dict]:
+    """
+    依 (username, CHTNO) 取得最近一次就診的紀錄，走唯一索引的前綴查詢；指定 caseno 時取該次就診。
+    回傳 {"id": 資料列 id, "data": 病患 JSON, "version": 版本號, "updated_at": 更新時間}，找不到時回傳 None。
+    """
+    _import_legacy_opd_file(username)
+    stmt = (
+        select(patients_table.c.id, patients_table.c.data, patients_table.c.version, patients_table.c.updated_at)
+        .where(patients_table.c.username == username, patients_table.c.chtno == str(chtno))
+        .order_by(patients_table.c.schdate.desc(), patients_table.c.id.desc())
+        .limit(1)
+    )
+    if caseno is not None:
+        stmt = stmt.where(patients_table.c.caseno == str(caseno))
+    with get_engine().connect() as conn:
+        row = conn.execute(stmt).first()
+    return _row_to_record(row) if row else None
+
+
+def get_patient(username: str, chtno: str) -> Optional[Dict]:
+    record = get_patient_record(username, chtno)
+    return record["data"] if record else None
+
+
+def list_patient_records(username: str) -> List[Dict]:
+    """
+    列出使用者的所有病患紀錄，最近更新者在前。
+    每筆為 {"data": 病患 JSON, "version": 版本號, "validated": 寫入時是否已驗證}。
+    """
+    _import_legacy_opd_file(username)
+    stmt = (
+        select(patients_table.c.data, patients_table.c.version, patients_table.c.validated)
+        .where(patients_table.c.username == username)
+        .order_by(patients_table.c.updated_at.desc(), patients_table.c.id.desc())
+    )
+    with get_engine().connect() as conn:
+        return [
+            {"data": json.loads(row.data), "version": row.version, "validated": bool(row.validated)}
+            for row in conn.execute(stmt)
+        ]
+
+
+def list_patients(username: str) -> List[Dict]:
+    """列出使用者的所有病患紀錄，最近更新者在前"""
+    return [record["data"] for record in list_patient_records(username)]
+
+
+# --- 分頁查詢 ---
+# 以不會變動的 id 分頁 (新建立者在前)：updated_at 在每次儲存時都會改變，
+# 分頁或匯出途中被編輯的紀錄會跳到游標之前而被漏掉或重複。
+# 游標為上一頁最後一筆的 id，以 base64 編碼後交給前端，不透露內部結構
+def encode_cursor(row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row_id]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        (row_id,) = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(row_id, int) or isinstance(row_id, bool):
+            raise ValueError
+        return row_id
+    except (ValueError, TypeError, UnicodeError) as e:
+        raise ValueError("無效的分頁游標") from e
+
+
+def query_patient_rows(
+    username: str,
+    schdate_from: Optional[str] = None,
+    schdate_to: Optional[str] = None,
+    exedept: Optional[str] = None,
+    exedr: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = 100,
+) -> List:
+    """
+    依條件查詢一頁病患紀錄，新建立者在前。SCHDATE 範圍為含頭含尾的字串比較
+    (格式需與資料中的 SCHDATE 相同)。after 為上一頁最後一筆的 id。
+    回傳的資料列含 id、updated_at、data (JSON 字串)、version、validated。
+    """
+    _import_legacy_opd_file(username)
+    c = patients_table.c
+    stmt = select(c.id, c.updated_at, c.data, c.version, c.validated).where(c.username == username)
+    if schdate_from:
+        stmt = stmt.where(c.schdate >= schdate_from)
+    if schdate_to:
+        stmt = stmt.where(c.schdate <= schdate_to)
+    if exedept:
+        stmt = stmt.where(c.exedept == exedept)
+    if exedr:
+        stmt = stmt.where(c.exedr == exedr)
+    if after is not None:
+        stmt = stmt.where(c.id < after)
+    stmt = stmt.order_by(c.id.desc()).limit(limit)
+    with get_engine().connect() as conn:
+        return conn.execute(stmt).all()
+
+
+def iter_patient_rows(username: str, chunk_size: int = 500, **filters) -> Iterator:
+    """
+    逐筆產生符合條件的資料列，每次只查詢 chunk_size 筆。每個區塊使用獨立的短連線，
+    匯出大量資料時不會長時間持有讀取交易 (阻礙 WAL checkpoint)。
+    """
+    after = None
+    while True:
+        rows = query_patient_rows(username, after=after, limit=chunk_size, **filters)
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1].id
+
+
+# --- 修訂紀錄 ---
+def encode_payload(obj: Any) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_payload(payload: bytes) -> Any:
+    return json.loads(zlib.decompress(payload))
+
+
+def _append_revisions(conn, entries: List[Tuple[int, int, Optional[Dict], Dict]], now: str) -> None:
+    """
+    為剛寫入的資料列新增修訂。entries 為 (patient_id, 新版本號, 寫入前的資料, 寫入後的資料)。
+    前一版本有修訂且距上次快照未滿 SNAPSHOT_INTERVAL 時存 delta，否則存完整快照
+    (新紀錄、啟用修訂前就存在的舊紀錄、壓縮後的斷點皆從快照開始)。
+    """
+    c = revisions_table.c
+    chain: Dict[int, Tuple[int, Optional[int]]] = {}
+    patient_ids = [entry[0] for entry in entries]
+    for start in range(0, len(patient_ids), 500):
+        stmt = (
+            select(c.patient_id, func.max(c.version), func.max(case((c.kind == "snapshot", c.version))))
+            .where(c.patient_id.in_(patient_ids[start:start + 500]))
+            .group_by(c.patient_id)
+        )
+        for patient_id, last_version, last_snapshot in conn.execute(stmt):
+            chain[patient_id] = (last_version, last_snapshot)
+
+    rows = []
+    for patient_id, version, before, after in entries:
+        last_version, last_snapshot = chain.get(patient_id, (None, None))
+        if before is None or last_version != version - 1 or last_snapshot is None \
+                or version - last_snapshot >= SNAPSHOT_INTERVAL:
+            kind, payload = "snapshot", encode_payload(after)
+            last_snapshot = version
+        else:
+            kind, payload = "delta", encode_payload(make_patch(before, after))
+        chain[patient_id] = (version, last_snapshot)
+        rows.append({"patient_id": patient_id, "version": version, "kind": kind, "payload": payload, "created_at": now})
+    if rows:
+        conn.execute(sqlite_insert(revisions_table).on_conflict_do_nothing(), rows)
+
+
+@contextmanager
+def write_transaction():
+    """
+    寫入交易。以 BEGIN IMMEDIATE 先取得寫入鎖：交易內先讀後寫時，
+    若以一般的延遲交易開始，另一個寫入者搶先提交會讓本交易立即失敗 (不會等待 busy_timeout)。
+    """
+    with get_engine().connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+# --- 寫入 ---
+def _row_values(username: str, patient_data: Dict, validated: bool, now: str) -> Dict:
+    fields = extract_index_fields(patient_data)
+    if not fields["chtno"]:
+        raise ValueError("病患資料缺少 CHTNO")
+    return {
+        "username": username,
+        **fields,
+        "data": json.dumps(patient_data, ensure_ascii=False),
+        "version": 1,
+        "updated_at": now,
+        "validated": int(validated),
+    }
+
+
+def _upsert_statement():
+    stmt = sqlite_insert(patients_table)
+    return stmt.on_conflict_do_update(
+        index_elements=["username", "chtno", "caseno"],
+        set_={
+            "schdate": stmt.excluded.schdate,
+            "exedept": stmt.excluded.exedept,
+            "exedr": stmt.excluded.exedr,
+            "name": stmt.excluded.name,
+            "data": stmt.excluded.data,
+            "version": patients_table.c.version + 1,
+            "updated_at": stmt.excluded.updated_at,
+            "validated": stmt.excluded.validated,
+        },
+    )
+
+
+def _now() -> str:
+    # 毫秒精度，讓同一秒內的多次儲存仍能正確排序
+    return get_tw_time().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def upsert_patient(username: str, patient_data: Dict, validated: bool = False) -> int:
+    """
+    新增或更新一筆病患紀錄 (以 username + CHTNO + CASENO 為鍵)，只寫入該筆資料列。
+    validated 表示呼叫端已驗證過資料可轉換為 ChtnoPatient。回傳更新後的版本號。
+    """
+    values = _row_values(username, patient_data, validated, _now())
+    c = patients_table.c
+    stmt = _upsert_statement().values(**values).returning(c.id, c.version)
+    try:
+        with write_transaction() as conn:
+            before = conn.execute(
+                select(c.data).where(c.username == username, c.chtno == values["chtno"], c.caseno == values["caseno"])
+            ).scalar_one_or_none()
+            row = conn.execute(stmt).one()
+            _append_revisions(conn, [(row.id, row.version, json.loads(before) if before else None, patient_data)], values["updated_at"])
+            patient_search.index_patients(conn, username, [(row.id, patient_data)])
+            return row.version
+    finally:
+        bump_user_generation(username)
+
+
+def upsert_patients(username: str, items: List[Tuple[Dict, bool]]) -> int:
+    """
+    批次新增或更新多筆病患紀錄，全部在同一個交易中以 executemany 寫入。
+    items 為 (病患資料, 是否已驗證) 的列表；任一筆缺少 CHTNO 時整批不寫入並拋出 ValueError。
+    回傳寫入的筆數 (含同批中被後者覆蓋的重複鍵)。
+    """
+    if not items:
+        return 0
+    now = _now()
+    # 同一批中重複的鍵只保留最後一筆：結果相同，且每筆修訂都能對應到寫入前的版本
+    latest: Dict[Tuple[str, str], Tuple[Dict, Dict]] = {}
+    for patient_data, validated in items:
+        row = _row_values(username, patient_data, validated, now)
+        latest[(row["chtno"], row["caseno"])] = (row, patient_data)
+
+    c = patients_table.c
+    chtnos = sorted({chtno for chtno, _ in latest})
+
+    def select_existing(conn, *columns):
+        found = {}
+        for start in range(0, len(chtnos), 500):
+            stmt = select(c.chtno, c.caseno, *columns).where(
+                c.username == username, c.chtno.in_(chtnos[start:start + 500])
+            )
+            for row in conn.execute(stmt):
+                if (row.chtno, row.caseno) in latest:
+                    found[(row.chtno, row.caseno)] = row
+        return found
+
+    try:
+        with write_transaction() as conn:
+            before = select_existing(conn, c.data)
+            conn.execute(_upsert_statement(), [row for row, _ in latest.values()])
+            after = select_existing(conn, c.id, c.version)
+            _append_revisions(conn, [
+                (after[key].id, after[key].version, json.loads(before[key].data) if key in before else None, patient_data)
+                for key, (_, patient_data) in latest.items()
+            ], now)
+            patient_search.index_patients(conn, username, [(after[key].id, patient_data) for key, (_, patient_data) in latest.items()])
+        return len(items)
+    finally:
+        bump_user_generation(username)
+
+
+def update_patient_if_version(
+    username: str, row_id: int, expected_version: int, patient_data: Dict, validated: bool = False
+) -> Optional[int]:
+    """
+    樂觀並行控制的更新：只有在資料列的版本仍為 expected_version 時才寫入。
+    成功回傳新版本號；版本已被其他寫入變更 (或資料列不存在) 時回傳 None。
+    呼叫端需確保 CHTNO / CASENO 未變更 (不會搬移資料列)。
+    """
+    values = _row_values(username, patient_data, validated, _now())
+    c = patients_table.c
+    condition = and_(c.id == row_id, c.username == username, c.version == expected_version)
+    stmt = (
+        patients_table.update()
+        .where(condition)
+        .values(
+            schdate=values["schdate"], exedept=values["exedept"], exedr=values["exedr"], name=values["name"],
+            data=values["data"], version=c.version + 1, updated_at=values["updated_at"], validated=values["validated"],
+        )
+        .returning(c.version)
+    )
+    try:
+        with write_transaction() as conn:
+            before = conn.execute(select(c.data).where(condition)).scalar_one_or_none()
+            if before is None:
+                return None
+            new_version = conn.execute(stmt).scalar_one()
+            _append_revisions(conn, [(row_id, new_version, json.loads(before), patient_data)], values["updated_at"])
+            patient_search.index_patients(conn, username, [(row_id, patient_data)])
+            return new_version
+    finally:
+        bump_user_generation(username)
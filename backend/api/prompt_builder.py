@@ -0,0 +1,326 @@
+# api/prompt_builder.py
+# 組合送往 LLM 的 messages：系統指令與每項輸入只出現一次，估算提示詞 token 數，
+# 並在超出 context 預算時截短過長的主客觀內容，讓每個請求的 prefill 成本可預期。
+#
+# 排列順序配合 vLLM 的自動前綴快取 (automatic prefix caching)：所有請求共用的系統指令在最前面，
+# 接著是使用者的範本與參考資料標題，每次看診不同的主客觀內容放在最後。
+# 前綴的內容逐位元組固定，相同前綴的請求可直接重用已計算的 KV cache，只需 prefill 尾端的看診資料。
+
+import re
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+DEFAULT_CONTEXT_TOKENS = 8192
+DEFAULT_MAX_TOKENS = 1024
+# chat template 為每則訊息加上的角色標記等額外 token (估計值)
+MESSAGE_OVERHEAD_TOKENS = 4
+# 截短時保留開頭的比例 (其餘保留結尾)：開頭多為主訴，結尾多為最新的口述內容
+TRUNCATE_HEAD_RATIO = 0.6
+
+# 動態 max_tokens：範本本身 + 輸入內容 (中文轉為英文填寫時 token 數可能增加) + 每行的餘裕
+OUTPUT_EXPANSION_RATIO = 1.5
+PER_LINE_SLACK_TOKENS = 16
+MIN_MAX_TOKENS = 64
+# 系統指令明確禁止、但模型偶爾仍會附加的結尾區塊；出現時即可停止生成
+TRAILING_SECTION_HEADERS = (
+    "Next Steps", "Planned Investigations", "Additional Information", "Additional Notes",
+    "Patient Education", "Follow-Up", "Additional Considerations", "Current Status",
+)
+# 範本行的「標題」：第一個 [ 或冒號 (含) 之前的內容
+_LINE_HEADER = re.compile(r"^\s*([^\[:：]*[:：]|[^\[:：]*(?=\[))")
+
+# 中日韓文字與全形符號大致每字一個 token，其餘 (英數、空白、半形符號) 約每 4 字元一個 token
+_WIDE_CHAR = re.compile("[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+class GenerationPlan(BaseModel):
+    max_tokens: int
+    stop: List[str] = []
+    template_lines: int = 0
+    # 範本最後一行的標題；輸出中這一行完成 (換行) 後即可結束上游串流，None 表示無法判斷
+    last_line_header: Optional[str] = None
+
+
+class BuiltPrompt(BaseModel):
+    messages: List[Dict[str, str]]
+    estimated_tokens: int  # 整份提示詞的估計 token 數
+    section_tokens: Dict[str, int]  # 各部分 (system / template / 各項輸入) 的估計 token 數
+    truncated: List[str] = []  # 被截短的輸入名稱
+    prefix_tokens: int = 0  # 與看診資料無關、可被前綴快取重用的開頭部分的估計 token 數
+    prefix_hash: str = ""  # 該前綴內容的雜湊，相同者代表 vLLM 可重用同一份 KV cache
+    generation: Optional[GenerationPlan] = None
+
+    @property
+    def prefix_share(self) -> float:
+        return self.prefix_tokens / self.estimated_tokens if self.estimated_tokens else 0.0
+
+
+def normalize_prompt_text(text: str) -> str:
+    """統一換行並移除行尾空白，讓內容相同的範本 (例如在不同作業系統上編輯) 產生逐位元組相同的前綴"""
+    return "\n".join(line.rstrip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"))
+
+
+def estimate_tokens(text: str) -> int:
+    """不依賴模型 tokenizer 的粗估，偏保守 (寧可高估)"""
+    if not text:
+        return 0
+    wide = len(_WIDE_CHAR.findall(text))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+
+def generation_limits(config: Dict[str, Any]) -> Tuple[int, int]:
+    """config.json 的 llm_context_tokens (模型 context 長度) 與 llm_max_tokens (生成上限)"""
+    context_tokens = int(config.get("llm_context_tokens") or DEFAULT_CONTEXT_TOKENS)
+    max_tokens = int(config.get("llm_max_tokens") or DEFAULT_MAX_TOKENS)
+    return context_tokens, max_tokens
+
+
+# --- 生成參數 ---
+def _line_header(line: str) -> Optional[str]:
+    match = _LINE_HEADER.match(line)
+    header = match.group(1).strip() if match else ""
+    return header or None
+
+
+def plan_generation(template_text: str, input_tokens: int, max_tokens_ceiling: int) -> GenerationPlan:
+    """
+    依範本結構決定生成參數：輸出應與範本行數相同，每行為範本文字加上依輸入填入的內容，
+    max_tokens 取估計上限 (不超過設定值)；停止字串只用範本中沒有的結尾區塊標題。
+    Markdown 標記 (# 或 **) 不作為停止字串：模型把欄位標題加粗時，停止會讓之後的內容全部遺失。
+    範本最後一行的標題在範本中出現多次 (例如每行都以 "•" 或 "-" 開頭)，或該行不是以方括號填寫的欄位
+    (無法判斷跨多行的內容何時結束) 時，last_line_header 為 None，不提前結束。
+    """
+    lines = [line for line in template_text.split("\n") if line.strip()]
+    estimate = (
+        estimate_tokens(template_text)
+        + math.ceil(input_tokens * OUTPUT_EXPANSION_RATIO)
+        + PER_LINE_SLACK_TOKENS * len(lines)
+    )
+    max_tokens = max(MIN_MAX_TOKENS, min(max_tokens_ceiling, estimate))
+
+    lowered = template_text.lower()
+    stop = [f"\n{header}" for header in TRAILING_SECTION_HEADERS if header.lower() not in lowered]
+
+    last_line_header = _line_header(lines[-1]) if lines and "[" in lines[-1] else None
+    if last_line_header and sum(1 for line in lines if _line_header(line) == last_line_header) > 1:
+        last_line_header = None
+
+    return GenerationPlan(
+        max_tokens=max_tokens,
+        stop=stop,
+        template_lines=len(lines),
+        last_line_header=last_line_header,
+    )
+
+
+def _bracket_closed(text: str) -> bool:
+    """text 中第一個 [ 開啟的方括號是否已關閉 (內容可跨多行，可含成對的巢狀方括號)"""
+    start = text.find("[")
+    if start == -1:
+        return False
+    depth = 0
+    for ch in text[start:]:
+        if ch == "[":
+            depth += 1
+        elif ch == "]":
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+
+def is_output_complete(text: str, plan: GenerationPlan) -> bool:
+    """
+    輸出中已有不少於範本行數的「完整的行」(之後已換行)，且範本最後一個欄位已結束：
+    以最後一行標題開頭的行所開啟的方括號已在某個完整的行中關閉。欄位內容可跨多行 (例如條列的 Plan)，
+    關閉前不會提前結束；輸出未以方括號填寫該欄位時無法判斷，一律不提前結束。
+    """
+    header = plan.last_line_header
+    if not header or "\n" not in text:
+        return False
+    completed = [line.strip() for line in text[:text.rfind("\n")].split("\n") if line.strip()]
+    if len(completed) < plan.template_lines:
+        return False
+    key = header.lower()
+    starts = [i for i, line in enumerate(completed) if line.lower().startswith(key)]
+    if not starts:
+        return False
+    return _bracket_closed("\n".join(completed[starts[-1]:])[len(header):])
+
+
+# --- 截短 ---
+def _take(text: str, budget: int, from_end: bool) -> str:
+    """從開頭 (或結尾) 取不超過 budget token 的內容，盡量停在換行處"""
+    used = 0.0
+    chars = reversed(text) if from_end else iter(text)
+    count = 0
+    for ch in chars:
+        used += 1.0 if _WIDE_CHAR.match(ch) else 0.25
+        if used > budget:
+            break
+        count += 1
+    piece = text[len(text) - count:] if from_end else text[:count]
+    if count == len(text):
+        return piece
+    # 切在換行處，但不要因此丟掉超過一半的內容
+    cut = piece.find("\n") + 1 if from_end else piece.rfind("\n")
+    if 0 < cut and (len(piece) - cut if from_end else cut) >= len(piece) // 2:
+        piece = piece[cut:] if from_end else piece[:cut]
+    return piece
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """保留開頭與結尾、省略中間，使估計 token 數不超過 max_tokens"""
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+    marker = f"\n…（中間省略約 {total - max_tokens} tokens）…\n"
+    budget = max(0, max_tokens - estimate_tokens(marker))
+    head_budget = int(budget * TRUNCATE_HEAD_RATIO)
+    head = _take(text, head_budget, from_end=False)
+    tail = _take(text[len(head):], budget - estimate_tokens(head), from_end=True)
+    return head.rstrip("\n") + marker + tail.lstrip("\n")
+
+
+def allocate_budget(needs: Dict[str, int], available: int) -> Dict[str, int]:
+    """
+    公平分配 (max-min fairness)：需求小於平均份額的輸入拿到全部所需，
+    剩下的預算由較長的輸入平分，避免一項很長的輸入把另一項擠掉。
+    """
+    allocation = {}
+    remaining = max(0, available)
+    pending = sorted(needs.items(), key=lambda item: item[1])
+    while pending:
+        share = remaining // len(pending)
+        name, need = pending.pop(0)
+        allocation[name] = min(need, share)
+        remaining -= allocation[name]
+    return allocation
+
+
+# --- 組合 ---
+def assemble(
+    system_prompt: str,
+    template_text: str,
+    reference_header: str,
+    inputs: List[Tuple[str, Optional[str], str]],
+    context_tokens: int,
+    max_tokens: int,
+) -> BuiltPrompt:
+    """
+    產生 [system, user] 兩則訊息。user 訊息為範本，之後接參考資料區塊；
+    inputs 為 (名稱, 標籤, 內容)，每項只放入參考資料區塊一次。
+    提示詞預算為 context_tokens - max_tokens；範本與系統指令本身放不下時回傳 400。
+    """
+    template_text = normalize_prompt_text(template_text)
+
+    def reference_block(values: Dict[str, str]) -> str:
+        parts = [f"{label}\n{values[name]}" if label else values[name] for name, label, _ in inputs]
+        return f"{template_text}\n\n{reference_header}\n" + "\n\n".join(parts)
+
+    budget = context_tokens - max_tokens - 2 * MESSAGE_OVERHEAD_TOKENS
+    fixed = estimate_tokens(system_prompt) + estimate_tokens(reference_block({name: "" for name, _, _ in inputs}))
+    available = budget - fixed
+    if available <= 0:
+        raise HTTPException(status_code=400, detail=f"提示詞範本過長 (約 {fixed} tokens)，超出模型的 context 預算 {budget} tokens")
+
+    values = {name: text for name, _, text in inputs}
+    needs = {name: estimate_tokens(text) for name, text in values.items()}
+    truncated = []
+    if sum(needs.values()) > available:
+        allocation = allocate_budget(needs, available)
+        for name, limit in allocation.items():
+            if needs[name] > limit:
+                values[name] = truncate_to_tokens(values[name], limit)
+                truncated.append(name)
+
+    user_content = reference_block(values)
+    # 第一項輸入之前的內容與看診資料無關
+    _, first_label, _ = inputs[0]
+    user_prefix = f"{template_text}\n\n{reference_header}\n" + (f"{first_label}\n" if first_label else "")
+    prefix_hash = hashlib.sha1((system_prompt + "\0" + user_prefix).encode("utf-8")).hexdigest()
+    section_tokens = {"system": estimate_tokens(system_prompt), "template": estimate_tokens(template_text)}
+    section_tokens.update({name: estimate_tokens(value) for name, value in values.items()})
+    return BuiltPrompt(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        estimated_tokens=estimate_tokens(system_prompt) + estimate_tokens(user_content) + 2 * MESSAGE_OVERHEAD_TOKENS,
+        section_tokens=section_tokens,
+        truncated=truncated,
+        prefix_tokens=estimate_tokens(system_prompt) + estimate_tokens(user_prefix) + 2 * MESSAGE_OVERHEAD_TOKENS,
+        prefix_hash=prefix_hash,
+        generation=plan_generation(template_text, sum(estimate_tokens(v) for v in values.values()), max_tokens),
+    )
+
+
+# --- 前綴快取量測 ---
+class PrefixCacheMonitor:
+    """
+    累計每個提示詞中可重用前綴所佔的比例，以及前綴在最近 max_prefixes 個不同前綴中是否出現過 (可能命中快取)。
+    上游回報 usage.prompt_tokens_details.cached_tokens 時 (vLLM 以 --enable-prompt-tokens-details 啟動)，
+    一併累計實際命中的 token 數。
+    """
+
+    def __init__(self, max_prefixes: int = 4096):
+        self.max_prefixes = max_prefixes
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._seen.clear()
+            self.requests = 0
+            self.repeated_prefixes = 0
+            self.prompt_tokens = 0
+            self.prefix_tokens = 0
+            self.reported_requests = 0
+            self.reported_prompt_tokens = 0
+            self.reported_cached_tokens = 0
+
+    def record(self, prompt: BuiltPrompt, usage: Optional[Dict[str, Any]] = None) -> None:
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt.estimated_tokens
+            self.prefix_tokens += prompt.prefix_tokens
+            if prompt.prefix_hash in self._seen:
+                self.repeated_prefixes += 1
+                self._seen.move_to_end(prompt.prefix_hash)
+            else:
+                self._seen[prompt.prefix_hash] = None
+                while len(self._seen) > self.max_prefixes:
+                    self._seen.popitem(last=False)
+
+            details = (usage or {}).get("prompt_tokens_details") or {}
+            if isinstance(details, dict) and details.get("cached_tokens") is not None and usage.get("prompt_tokens"):
+                self.reported_requests += 1
+                self.reported_prompt_tokens += int(usage["prompt_tokens"])
+                self.reported_cached_tokens += int(details["cached_tokens"])
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "estimated_prompt_tokens": self.prompt_tokens,
+                "estimated_prefix_tokens": self.prefix_tokens,
+                # 可重用前綴佔全部提示詞的比例 (上限；實際命中取決於 vLLM 的快取容量)
+                "reusable_prefix_share": round(self.prefix_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+                "repeated_prefix_rate": round(self.repeated_prefixes / self.requests, 4) if self.requests else 0.0,
+                "distinct_prefixes": len(self._seen),
+                "upstream_reported_requests": self.reported_requests,
+                "upstream_cached_token_share": (
+                    round(self.reported_cached_tokens / self.reported_prompt_tokens, 4)
+                    if self.reported_prompt_tokens else None
+                ),
+            }
+
+
+prefix_cache_monitor = PrefixCacheMonitor()
@@ -0,0 +1,186 @@
+# api/prompt_templates.py
+# 自定義提示詞範本：儲存時驗證佔位符並預先編譯為「文字片段 + 佔位符」的序列，編譯結果常駐記憶體，
+# 生成時只需依序接上主客觀內容，不必讀檔，也不再用 str.format (範本中的 { } 會被當成格式語法)。
+
+import os
+import re
+import time
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from .atomic_write import atomic_write_text
+from .user_store import UserStoreError, get_user_repository
+from .metrics import record_cache_lookup
+from .app_logging import get_logger
+
+logger = get_logger("prompt_templates")
+
+BASE_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# 科別共用範本的儲存目錄：data/_departments/{科別}/{type}_question.txt
+DEPARTMENT_DATA_DIR = os.path.join(BASE_DATA_DIR, "_departments")
+
+TEMPLATE_TYPES = ("subjective", "objective")
+SCOPES = ("user", "department")
+# 各範本類型可用的佔位符 (subjective 範本用於 FillTemplate，objective 範本用於 SOAP)
+ALLOWED_PLACEHOLDERS = {
+    "subjective": ("subjective",),
+    "objective": ("subjective", "objective"),
+}
+# 使用者未設定個人範本時，是否改用所屬科別的共用範本
+DEPARTMENT_SHARING = os.environ.get("PROMPT_TEMPLATE_DEPARTMENT_SHARING", "false").lower() in ("1", "true", "yes")
+# 檢查範本檔是否被其他行程 (或手動編輯) 修改的最短間隔；期間內生成時完全不碰檔案系統
+RELOAD_CHECK_SECONDS = float(os.environ.get("PROMPT_TEMPLATE_RELOAD_CHECK_SECONDS", "5"))
+
+# [subjective] 為前端範本使用的寫法；{subjective} 為舊版 str.format 時期也能運作的寫法
+_PLACEHOLDER = re.compile(r"\[(\w+)\]|\{(\w+)\}")
+
+
+class TemplateValidationError(ValueError):
+    """範本含有此類型不支援的佔位符"""
+
+
+class CompiledTemplate:
+    """編譯後的範本：segments 為字串 (原文) 與 (佔位符名稱,) 的序列"""
+
+    __slots__ = ("source", "segments", "placeholders")
+
+    def __init__(self, source: str, segments: List[Union[str, Tuple[str]]]):
+        self.source = source
+        self.segments = segments
+        self.placeholders = frozenset(segment[0] for segment in segments if isinstance(segment, tuple))
+
+    def has_placeholders(self, *names: str) -> bool:
+        return all(name in self.placeholders for name in names)
+
+    def fill(self, **values: str) -> str:
+        return "".join(
+            values.get(segment[0], "") if isinstance(segment, tuple) else segment
+            for segment in self.segments
+        )
+
+
+def compile_template(source: str, template_type: str, strict: bool = True) -> CompiledTemplate:
+    """
+    將範本切成文字片段與佔位符。strict 時遇到此類型不支援的佔位符 (例如 subjective 範本中的 [objective]
+    或 {patient}) 拋出 TemplateValidationError；非 strict 時 (載入既有範本) 保留原文並記錄警告。
+    """
+    allowed = ALLOWED_PLACEHOLDERS[template_type]
+    segments: List[Union[str, Tuple[str]]] = []
+    invalid = []
+    last = 0
+    for match in _PLACEHOLDER.finditer(source):
+        name = match.group(1) or match.group(2)
+        if name in allowed:
+            if match.start() > last:
+                segments.append(source[last:match.start()])
+            segments.append((name,))
+            last = match.end()
+        elif name in ("subjective", "objective") or match.group(2) is not None:
+            # [xxx] 在範本中很常見 (待填欄位)，只有主客觀名稱或 {xxx} 會被視為寫錯的佔位符
+            invalid.append(match.group(0))
+    if last < len(source):
+        segments.append(source[last:])
+
+    if invalid:
+        names = "、".join(dict.fromkeys(invalid))
+        message = f"{template_type} 範本不支援的佔位符: {names}，可用的佔位符為 " + \
+            "、".join(f"[{name}]" for name in allowed)
+        if strict:
+            raise TemplateValidationError(message)
+        logger.warning("%s (以原文保留)", message)
+    return CompiledTemplate(source, segments)
+
+
+def template_type_for(generation_type: str) -> str:
+    return 'subjective' if generation_type == 'FillTemplate' else 'objective'
+
+
+# --- 檔案位置 ---
+def _safe_segment(value: str) -> str:
+    if not value or value in (".", "..") or "/" in value or "\\" in value or "\0" in value:
+        raise ValueError(f"無效的名稱: {value!r}")
+    return value
+
+
+def template_path(scope: str, owner: str, template_type: str) -> str:
+    """owner 在 user 範圍為使用者名稱，在 department 範圍為科別名稱"""
+    base = BASE_DATA_DIR if scope == "user" else DEPARTMENT_DATA_DIR
+    return os.path.join(base, _safe_segment(owner), f"{template_type}_question.txt")
+
+
+# --- 快取 ---
+# (scope, owner, type) -> (編譯結果 (空範本為 None), 原文, 檔案簽章, 上次檢查時間)
+_cache: Dict[Tuple[str, str, str], Tuple[Optional[CompiledTemplate], str, Optional[tuple], float]] = {}
+_cache_lock = threading.Lock()
+
+
+def _file_signature(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load(key: Tuple[str, str, str]) -> Tuple[Optional[CompiledTemplate], str]:
+    now = time.monotonic()
+    entry = _cache.get(key)
+    if entry is not None and now - entry[3] < RELOAD_CHECK_SECONDS:
+        record_cache_lookup("prompt_template", True)
+        return entry[0], entry[1]
+
+    path = template_path(*key)
+    signature = _file_signature(path)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[2] == signature:
+            _cache[key] = (entry[0], entry[1], signature, now)
+            record_cache_lookup("prompt_template", True)
+            return entry[0], entry[1]
+        record_cache_lookup("prompt_template", False)
+        source = ""
+        if signature is not None:
+            with open(path, "r", encoding="utf-8") as f:
+                source = f.read()
+        compiled = compile_template(source, key[2], strict=False) if source else None
+        _cache[key] = (compiled, source, signature, now)
+        return compiled, source
+
+
+def read_template_source(scope: str, owner: str, template_type: str) -> str:
+    return _load((scope, owner, template_type))[1]
+
+
+def save_template(scope: str, owner: str, template_type: str, content: str) -> Optional[CompiledTemplate]:
+    """驗證並編譯後才寫入檔案，寫入成功即更新快取；驗證失敗時拋出 TemplateValidationError，不會寫入"""
+    compiled = compile_template(content, template_type, strict=True) if content else None
+    key = (scope, owner, template_type)
+    path = template_path(*key)
+    with _cache_lock:
+        atomic_write_text(path, content)
+        _cache[key] = (compiled, content, _file_signature(path), time.monotonic())
+    return compiled
+
+
+def _user_department(username: str) -> Optional[str]:
+    try:
+        record = get_user_repository().get(username)
+    except UserStoreError:
+        return None
+    return (record or {}).get("department") or None
+
+
+def get_compiled_template(username: str, template_type: str) -> Optional[CompiledTemplate]:
+    """
+    取得生成時使用的範本：使用者的個人範本優先；未設定且啟用科別共用時，改用所屬科別的範本。
+    都沒有時回傳 None (使用內建的預設結構)。
+    """
+    compiled, _ = _load(("user", username, template_type))
+    if compiled is None and DEPARTMENT_SHARING:
+        department = _user_department(username)
+        if department:
+            try:
+                compiled, _ = _load(("department", department, template_type))
+            except ValueError:
+                logger.warning("科別名稱無法作為範本目錄: %r", department)
+    return compiled
@@ -4,63 +4,70 @@ import json
 from typing import Literal
 
 # 導入 JWT 驗證依賴
-from .custom_template import get_current_username # 用於獲取當前登入的用戶名
+from .custom_template import Principal, get_current_principal # 當前登入的用戶及其角色、科別
+from . import prompt_templates
+from .prompt_templates import TemplateValidationError
+from .app_logging import get_logger
 
 router = APIRouter()
+logger = get_logger("template")
 
-# 數據儲存目錄的根路徑
-# 假設用戶範本儲存在 data/{username}/ 目錄下
-BASE_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+# 可以儲存科別共用範本的角色
+DEPARTMENT_TEMPLATE_EDITOR_ROLES = ("admin", "manager")
+
+
+def _template_owner(scope: str, principal: Principal, editing: bool = False) -> str:
+    """user 範圍為目前使用者，department 範圍為其所屬科別"""
+    if scope == "user":
+        return principal.username
+    if editing and principal.role not in DEPARTMENT_TEMPLATE_EDITOR_ROLES:
+        raise HTTPException(status_code=403, detail="只有 admin 或 manager 可以修改科別共用範本")
+    if not principal.department:
+        raise HTTPException(status_code=400, detail="使用者未設定科別，無法存取科別共用範本")
+    return principal.department
 
 # 獲取自定義範本
 @router.get("/user/custom-template")
 async def get_custom_template(
     type: Literal["subjective", "objective"], # 限定類型只能是 subjective 或 objective
-    current_username: str = Depends(get_current_username) # 需要驗證用戶
+    scope: Literal["user", "department"] = Query("user"),
+    principal: Principal = Depends(get_current_principal) # 需要驗證用戶
 ):
     """
-    獲取指定用戶的自定義範本內容。
-    範本檔案儲存在 data/{username}/{type}_question.txt。
+    獲取指定用戶 (或其科別共用) 的自定義範本內容。
+    範本檔案儲存在 data/{username}/{type}_question.txt，讀取後快取於記憶體。
     """
-    template_file_path = os.path.join(BASE_DATA_DIR, current_username, f"{type}_question.txt")
-
-    if not os.path.exists(template_file_path):
-        # 如果檔案不存在，返回空字串，而不是 404
-        # 讓前端可以創建新範本
-        print(f"[DEBUG] 用戶 {current_username} 的 {type} 範本檔案不存在: {template_file_path}")
-        return {"content": ""}
-    
+    owner = _template_owner(scope, principal)
     try:
-        with open(template_file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        return {"content": content}
+        content = prompt_templates.read_template_source(scope, owner, type)
     except Exception as e:
-        print(f"[ERROR] 讀取用戶 {current_username} 的 {type} 範本失敗: {e}")
+        logger.error("讀取 %s 的 %s 範本失敗: %s", owner, type, e)
         raise HTTPException(status_code=500, detail=f"讀取範本失敗: {e}")
+    # 檔案不存在時返回空字串，而不是 404，讓前端可以創建新範本
+    return {"content": content}
 
 # 儲存自定義範本
 @router.post("/user/custom-template")
 async def save_custom_template(
     request: Request,
     type: Literal["subjective", "objective"], # 限定類型
-    current_username: str = Depends(get_current_username) # 需要驗證用戶
+    scope: Literal["user", "department"] = Query("user"),
+    principal: Principal = Depends(get_current_principal) # 需要驗證用戶
 ):
     """
-    儲存指定用戶的自定義範本內容。
+    驗證並儲存自定義範本內容。佔位符不正確時回傳 422，不會寫入。
+    儲存後編譯好的範本立即生效，生成時不必再讀檔。
     """
     data = await request.json()
     content = data.get("content", "")
-
-    user_data_dir = os.path.join(BASE_DATA_DIR, current_username)
-    os.makedirs(user_data_dir, exist_ok=True) # 確保用戶資料夾存在
-
-    template_file_path = os.path.join(user_data_dir, f"{type}_question.txt")
+    owner = _template_owner(scope, principal, editing=True)
 
     try:
-        with open(template_file_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        # 寫入暫存檔後原子替換，同一範本檔的並發儲存依序進行
+        prompt_templates.save_template(scope, owner, type, content)
         return {"message": f"{type} 範本儲存成功"}
+    except TemplateValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
-        print(f"[ERROR] 儲存用戶 {current_username} 的 {type} 範本失敗: {e}")
+        logger.error("儲存 %s 的 %s 範本失敗: %s", owner, type, e)
         raise HTTPException(status_code=500, detail=f"儲存範本失敗: {e}")
-
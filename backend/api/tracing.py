@@ -0,0 +1,250 @@
+# api/tracing.py
+# 請求範圍的階段追蹤：以 span("名稱") 包住設定載入、Token 取得、LLM 呼叫 (含 401 重試)、後處理、資料庫存取等步驟，
+# 完成的 span 於回應的 Server-Timing 標頭列出 (瀏覽器開發者工具的 Timing 分頁可直接檢視)，
+# 設定 TRACE_EXPORT_FILE 時另以 OpenTelemetry (OTLP/JSON) 格式逐行寫入檔案，可匯入 Jaeger / otel-collector。
+#
+# 環境變數：
+#   TRACING_ENABLED        是否追蹤並加上 Server-Timing (預設 true)
+#   TRACE_EXPORT_FILE      OTLP/JSON 追蹤檔路徑 (未設定時不匯出)
+#   TRACE_EXPORT_MIN_MS    只匯出處理時間不少於此毫秒數的請求 (預設 0，全部匯出)
+
+import os
+import re
+import json
+import time
+import queue
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE") or None
+TRACE_EXPORT_MIN_MS = float(os.environ.get("TRACE_EXPORT_MIN_MS", "0"))
+
+SERVICE_NAME = "new_ui-backend"
+# Server-Timing 最多列出的 span 數，避免標頭過長
+MAX_SERVER_TIMING_ENTRIES = 32
+_EXPORT_QUEUE_SIZE = 1000
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_METRIC_NAME_INVALID = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "duration_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.duration_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+
+class RequestTrace:
+    """一個請求的所有 span；span 可能在執行緒池中完成，list.append 本身為原子操作"""
+
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None):
+        self.trace_id = trace_id or _new_id(128)
+        self.root = Span(name, parent_id, {})
+        self.spans: List[Span] = []
+        self._start = time.perf_counter_ns()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter_ns() - self._start) / 1e6
+
+    def finish(self, **attributes: Any) -> None:
+        self.root.duration_ns = time.perf_counter_ns() - self._start
+        self.root.attributes.update(attributes)
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+_current_span_id: ContextVar[Optional[str]] = ContextVar("current_span_id", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """
+    記錄一個階段；不在請求中 (例如背景工作、命令列工具) 時不做任何事。
+    同步與 async 程式碼皆可使用，也可在 run_in_threadpool 的函式內使用 (contextvars 會被複製到執行緒)。
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = Span(name, _current_span_id.get() or trace.root.span_id, attributes)
+    token = _current_span_id.set(current.span_id)
+    start = time.perf_counter_ns()
+    try:
+        yield current
+    except BaseException as e:
+        # 只記錄例外類型：例外訊息可能含上游回應或病歷內容
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration_ns = time.perf_counter_ns() - start
+        _current_span_id.reset(token)
+        trace.spans.append(current)
+
+
+# --- Server-Timing ---
+def server_timing_header(trace: RequestTrace) -> str:
+    """各 span 依完成順序列出 (同名 span 例如重試的 llm 會各列一次)，最後加上到目前為止的 total"""
+    entries = []
+    for item in trace.spans[:MAX_SERVER_TIMING_ENTRIES]:
+        entry = f"{_METRIC_NAME_INVALID.sub('_', item.name)};dur={item.duration_ns / 1e6:.1f}"
+        if item.error:
+            entry += ';desc="error"'
+        entries.append(entry)
+    entries.append(f"total;dur={trace.elapsed_ms():.1f}")
+    return ", ".join(entries)
+
+
+# --- OTLP/JSON 匯出 ---
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace: RequestTrace, item: Span) -> Dict[str, Any]:
+    entry = {
+        "traceId": trace.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": 2 if item is trace.root else 1,  # SERVER / INTERNAL
+        "startTimeUnixNano": str(item.start_ns),
+        "endTimeUnixNano": str(item.start_ns + (item.duration_ns or 0)),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+        "status": {"code": 2, "message": item.error} if item.error else {"code": 0},
+    }
+    if item.parent_id:
+        entry["parentSpanId"] = item.parent_id
+    return entry
+
+
+def to_otlp_json(trace: RequestTrace) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "new_ui.tracing"},
+                "spans": [_otlp_span(trace, item) for item in [trace.root] + trace.spans],
+            }],
+        }]
+    }
+
+
+class TraceFileExporter:
+    """背景執行緒逐行寫入追蹤檔；請求路徑上只做 put_nowait，佇列滿時丟棄"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.Queue[Optional[RequestTrace]]" = queue.Queue(maxsize=_EXPORT_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, trace: RequestTrace) -> None:
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                trace = self._queue.get()
+                if trace is None:
+                    return
+                f.write(json.dumps(to_otlp_json(trace), ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+_exporter: Optional[TraceFileExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter() -> Optional[TraceFileExporter]:
+    global _exporter
+    if TRACE_EXPORT_FILE is None:
+        return None
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = TraceFileExporter(TRACE_EXPORT_FILE)
+    return _exporter
+
+
+def shutdown_tracing() -> None:
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
+
+
+# --- 中介層 ---
+class TracingMiddleware:
+    """
+    為每個 HTTP 請求建立追蹤，於回應開始時加上 Server-Timing 標頭。
+    串流回應 (例如 /api/chat/voice-generate) 在第一個位元組送出後完成的 span 不會出現在標頭中，只會出現在匯出的追蹤檔。
+    請求帶有 W3C traceparent 標頭時沿用其 trace id。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = parent_id = None
+        for key, value in scope.get("headers") or []:
+            if key == b"traceparent":
+                match = _TRACEPARENT.match(value.decode("latin-1").strip())
+                if match:
+                    trace_id, parent_id = match.groups()
+                break
+        trace = RequestTrace(scope["method"], trace_id, parent_id)
+        trace_token = _current_trace.set(trace)
+        status_holder = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["status"] = message["status"]
+                headers = list(message.get("headers") or [])
+                headers.append((b"server-timing", server_timing_header(trace).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(trace_token)
+            # 以路由樣板命名 (實際路徑含病歷號等識別資料，不寫入追蹤檔)
+            route_path = getattr(scope.get("route"), "path", None) or "unmatched"
+            trace.root.name = f"{scope['method']} {route_path}"
+            trace.finish(**{
+                "http.method": scope["method"],
+                "http.route": route_path,
+                "http.status_code": status_holder["status"],
+            })
+            exporter = _get_exporter()
+            if exporter is not None and trace.root.duration_ns / 1e6 >= TRACE_EXPORT_MIN_MS:
+                exporter.submit(trace)
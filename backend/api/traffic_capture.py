@@ -0,0 +1,242 @@
+# api/traffic_capture.py
+# 選用的流量錄製：逐行記錄每個請求的路由樣板、到達時間、處理時間、請求/回應大小與 JSON 內容的「形狀」，
+# 供 benchmarks/replay_traffic.py 依實際的到達間隔與內容長度重播，比較兩個版本的延遲與吞吐量。
+# 不記錄任何內容原文：字串只記錄長度，使用者名稱與路徑參數 (病歷號等) 以 HMAC 雜湊取代；
+# 請求路徑上只計算位元組數並放進有界佇列，解析與寫檔在背景執行緒完成。
+#
+# 環境變數：
+#   TRAFFIC_CAPTURE_FILE           錄製檔路徑 (未設定時停用)
+#   TRAFFIC_CAPTURE_SALT           雜湊用的金鑰 (未設定時每次啟動隨機產生，重啟後同一使用者的雜湊不同)
+#   TRAFFIC_CAPTURE_MAX_BODY_BYTES 解析 JSON 內容的上限 (預設 1048576，超過時只記錄大小)
+
+import os
+import re
+import hmac
+import json
+import time
+import queue
+import struct
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+from .metrics import Counter, register
+
+TRAFFIC_CAPTURE_FILE = os.environ.get("TRAFFIC_CAPTURE_FILE") or None
+CAPTURE_SALT = (os.environ.get("TRAFFIC_CAPTURE_SALT") or "").encode("utf-8") or os.urandom(32)
+MAX_BODY_BYTES = int(os.environ.get("TRAFFIC_CAPTURE_MAX_BODY_BYTES", "1048576"))
+
+# 非 JSON 的請求 (例如音訊上傳) 只保留開頭，用來辨識 multipart 中的音訊格式
+HEAD_BYTES = 2048
+_QUEUE_SIZE = 10000
+# 不錄製的路徑 (Prometheus 定期抓取)
+EXCLUDED_PATHS = frozenset({"/metrics"})
+# 保留原值的欄位 (生成類型等列舉值，不含病患資料)；其餘字串只記錄長度
+SAFE_VALUE_FIELDS = frozenset({"type", "field", "vad", "limit", "format", "scope", "template_type"})
+# 以雜湊取代的識別欄位
+IDENTITY_FIELDS = frozenset({"username"})
+# JSON 陣列最多記錄的元素數
+MAX_LIST_ITEMS = 100
+_MULTIPART_AUDIO = re.compile(rb"(?i)content-type:\s*(audio/[\w.+-]+)")
+
+TRAFFIC_CAPTURE_DROPPED = register(Counter(
+    "traffic_capture_dropped_total", "錄製佇列已滿而丟棄的請求數",
+))
+
+
+def hash_identity(value: str) -> str:
+    return hmac.new(CAPTURE_SALT, value.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def shape_value(value: Any, key: Optional[str] = None) -> Any:
+    """
+    將 JSON 內容轉為不含原文的形狀：字串為 "<長度>"、識別欄位為 "#雜湊"、數值為 0，
+    SAFE_VALUE_FIELDS 的字串與布林值、null 保留原值。
+    """
+    if isinstance(value, dict):
+        return {k: shape_value(v, str(k)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [shape_value(v) for v in value[:MAX_LIST_ITEMS]]
+    if isinstance(value, str):
+        if key in IDENTITY_FIELDS:
+            return "#" + hash_identity(value)
+        if key in SAFE_VALUE_FIELDS and len(value) <= 32:
+            return value
+        return f"<{len(value)}>"
+    if isinstance(value, bool) or value is None:
+        return value
+    return 0
+
+
+class CapturedRequest:
+    """請求路徑上收集的原始資料；轉成紀錄 (解析 JSON、驗證 token、雜湊) 留給背景執行緒"""
+
+    __slots__ = ("started", "duration_ms", "method", "route", "path_params", "query_string", "content_type",
+                 "authorization", "status", "request_bytes", "response_bytes", "body_head", "body_complete")
+
+    def __init__(self, scope):
+        self.started = time.time()
+        self.duration_ms = 0.0
+        self.method = scope["method"]
+        self.route = "unmatched"
+        self.path_params: Dict[str, Any] = {}
+        self.query_string: bytes = scope.get("query_string") or b""
+        self.content_type: Optional[str] = None
+        self.authorization: Optional[str] = None
+        for key, value in scope.get("headers") or []:
+            if key == b"content-type":
+                self.content_type = value.decode("latin-1").split(";", 1)[0].strip().lower()
+            elif key == b"authorization":
+                self.authorization = value.decode("latin-1")
+        self.status = 500
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.body_head = b""
+        self.body_complete = True
+
+    def to_record(self) -> Dict[str, Any]:
+        from .custom_template import decode_token_username
+
+        record: Dict[str, Any] = {
+            "t": round(self.started, 3),
+            "method": self.method,
+            "route": self.route,
+            "status": self.status,
+            "duration_ms": round(self.duration_ms, 1),
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+        }
+        if self.path_params:
+            record["path_params"] = {k: "#" + hash_identity(str(v)) for k, v in self.path_params.items()}
+        if self.query_string:
+            query = parse_qsl(self.query_string.decode("latin-1"), keep_blank_values=True)
+            record["query"] = {k: shape_value(v, k) for k, v in query}
+        if self.content_type:
+            record["content_type"] = self.content_type
+        if self.authorization and self.authorization.lower().startswith("bearer "):
+            username = decode_token_username(self.authorization[7:].strip())
+            if username is not None:
+                record["user"] = "#" + hash_identity(username)
+
+        if self.content_type == "application/json" and self.body_head:
+            if self.body_complete:
+                try:
+                    record["body"] = shape_value(json.loads(self.body_head))
+                except (ValueError, UnicodeDecodeError):
+                    pass
+        elif self.content_type == "multipart/form-data" and self.body_head:
+            match = _MULTIPART_AUDIO.search(self.body_head)
+            if match:
+                record["audio_type"] = match.group(1).decode("latin-1").lower()
+            # PCM WAV 的取樣率與聲道數 (標準 44 位元組檔頭)，重播時據以還原相同時長與格式的音訊
+            riff = self.body_head.find(b"RIFF")
+            if riff != -1 and self.body_head[riff + 8:riff + 16] == b"WAVEfmt " and len(self.body_head) >= riff + 28:
+                channels, sample_rate = struct.unpack_from("<HI", self.body_head, riff + 22)
+                record["audio_channels"] = channels
+                record["audio_sample_rate"] = sample_rate
+        return record
+
+
+class CaptureWriter:
+    """背景執行緒逐行寫入錄製檔；請求路徑上只做 put_nowait，佇列滿時丟棄並計數"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: "queue.Queue[Optional[CapturedRequest]]" = queue.Queue(maxsize=_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._thread.start()
+
+    def submit(self, captured: CapturedRequest) -> None:
+        try:
+            self._queue.put_nowait(captured)
+        except queue.Full:
+            TRAFFIC_CAPTURE_DROPPED.inc()
+
+    def _run(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                captured = self._queue.get()
+                if captured is None:
+                    return
+                f.write(json.dumps(captured.to_record(), ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+_writer: Optional[CaptureWriter] = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> Optional[CaptureWriter]:
+    global _writer
+    if TRAFFIC_CAPTURE_FILE is None:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = CaptureWriter(TRAFFIC_CAPTURE_FILE)
+    return _writer
+
+
+def shutdown_traffic_capture() -> None:
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+# --- 中介層 ---
+class TrafficCaptureMiddleware:
+    """未設定 TRAFFIC_CAPTURE_FILE 時直接轉交，不包裝 receive / send"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXCLUDED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        writer = _get_writer()
+        if writer is None:
+            await self.app(scope, receive, send)
+            return
+
+        captured = CapturedRequest(scope)
+        limit = MAX_BODY_BYTES if captured.content_type == "application/json" else HEAD_BYTES
+        body_parts: List[bytes] = []
+        buffered = {"bytes": 0}
+        start = time.perf_counter()
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                captured.request_bytes += len(chunk)
+                room = limit - buffered["bytes"]
+                if room > 0:
+                    body_parts.append(chunk[:room])
+                    buffered["bytes"] += min(room, len(chunk))
+                if len(chunk) > room:
+                    captured.body_complete = False
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                captured.status = message["status"]
+            elif message["type"] == "http.response.body":
+                captured.response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            captured.duration_ms = (time.perf_counter() - start) * 1000
+            captured.route = getattr(scope.get("route"), "path", None) or "unmatched"
+            captured.path_params = scope.get("path_params") or {}
+            captured.body_head = b"".join(body_parts)
+            writer.submit(captured)
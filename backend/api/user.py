@@ -1,15 +1,14 @@
-from fastapi import APIRouter, HTTPException, Request, Depends, status # 引入 status
+from fastapi import APIRouter, HTTPException, Request, Depends, Query, Response, status # 引入 status
 from pydantic import BaseModel, Field
-import json
 import os
-import sys
+from typing import Optional
 from models.user_model import User, get_tw_time
-from datetime import datetime
-import pytz
-from .custom_template import get_current_username  # 引入 JWT 驗證依賴
+from .custom_template import Principal, get_current_principal, require_roles  # 引入 JWT 驗證依賴
+from .user_store import UserStoreError, get_user_repository
+from .password_hashing import hash_password, hash_password_async, is_hashed
 
 router = APIRouter()
-USER_DATA_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "users.json")
+MAX_USERS_PAGE_SIZE = 1000
 
 class User(BaseModel):
     username: str = Field(...)
@@ -24,32 +23,37 @@ class User(BaseModel):
     avatar: str = Field(...)
     note: str = Field(...)
 
-def load_users():
-    with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_users(users):
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+def get_users():
+    """取得使用者目錄，資料來源不存在或損毀時轉為 500"""
+    repo = get_user_repository()
+    try:
+        repo.count()
+    except UserStoreError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"伺服器設定錯誤：{e}")
+    return repo
 
 @router.get("/users")
-def list_users():
-    users = load_users()
-    return [user for user in users]
+def list_users(
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_USERS_PAGE_SIZE),
+):
+    """未帶 limit 時回傳全部使用者 (與舊版相容)；總數由 X-Total-Count 標頭提供"""
+    users, total = get_users().list(offset, limit)
+    response.headers["X-Total-Count"] = str(total)
+    return users
 
 @router.post("/users")
 def add_user(user: User):
-    users = load_users()
-    if any(u["username"] == user.username for u in users):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用戶已存在")
-    
     now = get_tw_time().strftime('%Y-%m-%d %H:%M:%S')
     user_dict = user.dict()
+    # 同步路由在執行緒池中執行，雜湊運算不會阻塞事件迴圈
+    user_dict["password"] = hash_password(user.password)
     user_dict["created_at"] = now
     user_dict["updated_at"] = now
     user_dict["last_login"] = now
-    users.append(user_dict)
-    save_users(users)
+    if not get_users().add(user_dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="用戶已存在")
 
     # === 新增：建立個人資料夾與預設檔案 ===
     base_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
@@ -79,19 +83,16 @@ def add_user(user: User):
     return {"success": True, "username": user.username}
 
 @router.put("/users/{username}")
-async def update_user(username: str, request: Request, current_username: str = Depends(get_current_username)):
+async def update_user(username: str, request: Request, operator: Principal = Depends(get_current_principal)):
     data = await request.json()
-    users = load_users()
-    
-    # 獲取當前操作者在 users.json 中的完整資料，以確認其角色
-    current_operator = next((u for u in users if u["username"] == current_username), None)
-    if not current_operator:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="操作者不存在")
+    users = get_users()
     
-    operator_role = current_operator.get("role")
+    # 當前操作者的角色
+    current_username = operator.username
+    operator_role = operator.role
 
     # 獲取目標使用者
-    target_user = next((u for u in users if u["username"] == username), None)
+    target_user = users.get(username)
     if not target_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
 
@@ -123,65 +124,46 @@ async def update_user(username: str, request: Request, current_username: str = D
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="只有 admin 可以更改用戶角色")
 
     # 更新使用者資料
-    for k, v in data.items():
-        # 確保不會修改 username, created_at, updated_at, last_login
-        if k not in ["username", "created_at", "updated_at", "last_login"]:
-            # 如果是 admin 或 manager，可以修改所有非受保護欄位
-            # 如果是 user，我們已在上面限制了可修改的欄位，所以這裡只需更新
-            target_user[k] = v
-    
-    target_user["updated_at"] = get_tw_time().strftime('%Y-%m-%d %H:%M:%S')
-    save_users(users)
+    # 確保不會修改 username, created_at, updated_at, last_login
+    # 如果是 admin 或 manager，可以修改所有非受保護欄位
+    # 如果是 user，我們已在上面限制了可修改的欄位，所以這裡只需更新
+    changes = {k: v for k, v in data.items() if k not in ["username", "created_at", "updated_at", "last_login"]}
+    if changes.get("password") and not is_hashed(changes["password"]):
+        changes["password"] = await hash_password_async(changes["password"])
+    changes["updated_at"] = get_tw_time().strftime('%Y-%m-%d %H:%M:%S')
+    if users.update(username, changes) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
     return {"success": True, "username": username}
 
 @router.delete("/users/{username}")
-async def delete_user(username: str, current_username: str = Depends(get_current_username)):
-    users = load_users()
-    current_user = next((u for u in users if u["username"] == current_username), None)
-    if not current_user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="操作者不存在")
-    role = current_user.get("role")
-    if role != "admin":
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="只有 admin 可以刪除用戶")
-    
-    for i, user in enumerate(users):
-        if user["username"] == username:
-            users.pop(i)
-            save_users(users)
-            return {"success": True, "username": username}
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
+async def delete_user(
+    username: str,
+    operator: Principal = Depends(require_roles("admin", detail="只有 admin 可以刪除用戶")),
+):
+    if not get_users().delete(username):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
+    return {"success": True, "username": username}
 
 @router.put("/users/{username}/password")
-async def change_password(username: str, request: Request, current_username: str = Depends(get_current_username)):
+async def change_password(username: str, request: Request, operator: Principal = Depends(get_current_principal)):
     data = await request.json()
     new_password = data.get("password")
     if not new_password:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="新密碼不得為空")
     
-    users = load_users()
-    current_user_data = next((u for u in users if u["username"] == current_username), None)
-    if not current_user_data:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="操作者不存在")
-    
-    operator_role = current_user_data.get("role")
+    users = get_users()
 
     # 判斷權限：
     # admin/manager 可以修改所有人的密碼
     # user 只能修改自己的密碼
-    if operator_role == "user" and current_username != username:
+    if operator.role == "user" and operator.username != username:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="一般用戶只能修改自己的密碼")
     
     # 檢查目標用戶是否存在
-    target_user_found = False
-    for user_item in users:
-        if user_item["username"] == username:
-            user_item["password"] = new_password
-            target_user_found = True
-            break
-    
-    if not target_user_found:
+    if users.get(username) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
+    if users.update(username, {"password": await hash_password_async(new_password)}) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="用戶不存在")
 
-    save_users(users)
     return {"success": True, "username": username}
 
@@ -0,0 +1,274 @@
+# api/user_store.py
+# 使用者目錄：以 username 為鍵的記憶體索引，登入與權限檢查不需讀取檔案；
+# 底層可為 data/users.json (預設) 或 SQLite (大型院所，USER_STORE_BACKEND=sqlite)。
+
+import os
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from itertools import islice
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text, create_engine, delete, event, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .atomic_write import atomic_write_json
+from .app_logging import get_logger
+
+logger = get_logger("user_store")
+
+BASE_DATA_DIR = Path(__file__).parent.parent / 'data'
+USERS_FILE = Path(os.environ.get("USERS_FILE", BASE_DATA_DIR / "users.json"))
+USER_DB_PATH = Path(os.environ.get("USER_DB_PATH", BASE_DATA_DIR / "users.db"))
+USER_STORE_BACKEND = os.environ.get("USER_STORE_BACKEND", "json").lower()
+# 檢查底層檔案是否被其他行程 (或手動編輯) 修改的最短間隔；期間內的讀取完全不碰檔案系統
+RELOAD_CHECK_SECONDS = float(os.environ.get("USER_STORE_RELOAD_CHECK_SECONDS", "2"))
+
+
+class UserStoreError(Exception):
+    """使用者資料來源不存在或格式錯誤"""
+
+
+def _file_signature(*paths: Path) -> tuple:
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class UserRepository(ABC):
+    """
+    所有使用者資料常駐記憶體 (dict 保留原始順序)，以 username 直接查詢。
+    每隔 RELOAD_CHECK_SECONDS 以 stat 比對底層檔案，發現外部修改才重新載入。
+    寫入以鎖序列化，先寫入底層儲存成功後才更新記憶體索引。回傳的資料皆為複本。
+    """
+
+    def __init__(self):
+        self._users: Dict[str, Dict] = {}
+        self._signature: Optional[tuple] = None
+        self._checked_at = 0.0
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    # --- 各後端實作 ---
+    @abstractmethod
+    def _storage_signature(self) -> tuple:
+        """底層儲存的變更標記 (例如檔案的 mtime 與大小)，不同時重新載入"""
+
+    @abstractmethod
+    def _read_all(self) -> List[Dict]:
+        """讀取所有使用者紀錄"""
+
+    @abstractmethod
+    def _persist(self, users: Dict[str, Dict], username: str, record: Optional[Dict]) -> None:
+        """users 為寫入後的完整目錄；record 為 None 表示刪除 username"""
+
+    # --- 索引維護 ---
+    def _reload(self, signature: tuple) -> None:
+        users = {}
+        for record in self._read_all():
+            username = record.get("username")
+            if username:
+                users[username] = record
+        self._users = users
+        self._signature = signature
+        self._loaded = True
+        logger.debug("使用者目錄已載入 %d 位使用者", len(users))
+
+    def _ensure_fresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if self._loaded and not force and now - self._checked_at < RELOAD_CHECK_SECONDS:
+            return
+        with self._lock:
+            signature = self._storage_signature()
+            if not self._loaded or signature != self._signature:
+                self._reload(signature)
+            self._checked_at = now
+
+    def _write(self, users: Dict[str, Dict], username: str, record: Optional[Dict]) -> None:
+        self._persist(users, username, record)
+        self._users = users
+        self._signature = self._storage_signature()
+        self._checked_at = time.monotonic()
+
+    # --- 查詢 ---
+    def get(self, username: str) -> Optional[Dict]:
+        self._ensure_fresh()
+        user = self._users.get(username)
+        return dict(user) if user is not None else None
+
+    def get_role(self, username: str) -> Optional[str]:
+        self._ensure_fresh()
+        user = self._users.get(username)
+        return user.get("role") if user is not None else None
+
+    def count(self) -> int:
+        self._ensure_fresh()
+        return len(self._users)
+
+    def list(self, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[Dict], int]:
+        """回傳 (該頁使用者, 總數)；limit 為 None 時回傳 offset 之後的全部"""
+        self._ensure_fresh()
+        users = self._users
+        stop = None if limit is None else offset + limit
+        return [dict(user) for user in islice(users.values(), offset, stop)], len(users)
+
+    # --- 寫入 ---
+    def add(self, record: Dict) -> bool:
+        """新增使用者；username 已存在時回傳 False"""
+        username = record["username"]
+        with self._lock:
+            self._ensure_fresh(force=True)
+            if username in self._users:
+                return False
+            users = dict(self._users)
+            users[username] = dict(record)
+            self._write(users, username, users[username])
+        return True
+
+    def update(self, username: str, fields: Dict) -> Optional[Dict]:
+        """合併更新欄位 (username 不可變更)，回傳更新後的資料；使用者不存在時回傳 None"""
+        with self._lock:
+            self._ensure_fresh(force=True)
+            current = self._users.get(username)
+            if current is None:
+                return None
+            record = {**current, **fields, "username": username}
+            users = dict(self._users)
+            users[username] = record
+            self._write(users, username, record)
+        return dict(record)
+
+    def delete(self, username: str) -> bool:
+        with self._lock:
+            self._ensure_fresh(force=True)
+            if username not in self._users:
+                return False
+            users = dict(self._users)
+            del users[username]
+            self._write(users, username, None)
+        return True
+
+
+class JsonUserRepository(UserRepository):
+    """data/users.json：每次寫入以暫存檔原子替換整個檔案，並保留原本的列表或字典格式"""
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self._dict_format = False
+
+    def _storage_signature(self) -> tuple:
+        return _file_signature(self.path)
+
+    def _read_all(self) -> List[Dict]:
+        if not self.path.is_file():
+            logger.critical("使用者資料庫檔案找不到！請確認路徑是否正確: %s", self.path)
+            raise UserStoreError("找不到使用者資料庫")
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            logger.critical("使用者資料庫檔案 %s 格式錯誤，無法解析 JSON。", self.path, exc_info=True)
+            raise UserStoreError("使用者資料庫損毀")
+
+        if isinstance(data, dict):
+            self._dict_format = True
+            return [{**record, "username": record.get("username") or username}
+                    for username, record in data.items() if isinstance(record, dict)]
+        if isinstance(data, list):
+            self._dict_format = False
+            return [record for record in data if isinstance(record, dict)]
+        raise UserStoreError("使用者資料庫格式不支援")
+
+    def _persist(self, users: Dict[str, Dict], username: str, record: Optional[Dict]) -> None:
+        atomic_write_json(str(self.path), users if self._dict_format else list(users.values()))
+
+
+class SqliteUserRepository(UserRepository):
+    """
+    SQLite：寫入只更新單筆資料列。資料表為空且 users.json 存在時，第一次載入會將其匯入。
+    """
+
+    _metadata = MetaData()
+    _table = Table(
+        "users",
+        _metadata,
+        # position 保留加入順序，讓列表順序與 users.json 一致
+        Column("position", Integer, primary_key=True, autoincrement=True),
+        Column("username", String, nullable=False, unique=True),
+        Column("data", Text, nullable=False),
+    )
+
+    def __init__(self, path: Path, legacy_json: Optional[Path] = None):
+        super().__init__()
+        self.path = path
+        self.legacy_json = legacy_json
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+        event.listen(self._engine, "connect", self._configure_sqlite)
+        self._metadata.create_all(self._engine)
+        self._import_legacy_json()
+
+    @staticmethod
+    def _configure_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    def _import_legacy_json(self) -> None:
+        if self.legacy_json is None or not self.legacy_json.is_file():
+            return
+        with self._engine.begin() as conn:
+            if conn.execute(select(self._table.c.position).limit(1)).first() is not None:
+                return
+            records = JsonUserRepository(self.legacy_json)._read_all()
+            if records:
+                conn.execute(
+                    sqlite_insert(self._table).on_conflict_do_nothing(index_elements=["username"]),
+                    [{"username": r["username"], "data": json.dumps(r, ensure_ascii=False)}
+                     for r in records if r.get("username")],
+                )
+                logger.info("已將 %s 的 %d 位使用者匯入使用者資料庫", self.legacy_json, len(records))
+
+    def _storage_signature(self) -> tuple:
+        return _file_signature(self.path, self.path.with_name(self.path.name + "-wal"))
+
+    def _read_all(self) -> List[Dict]:
+        stmt = select(self._table.c.data).order_by(self._table.c.position)
+        with self._engine.connect() as conn:
+            return [json.loads(row.data) for row in conn.execute(stmt)]
+
+    def _persist(self, users: Dict[str, Dict], username: str, record: Optional[Dict]) -> None:
+        table = self._table
+        with self._engine.begin() as conn:
+            if record is None:
+                conn.execute(delete(table).where(table.c.username == username))
+            else:
+                stmt = sqlite_insert(table).values(username=username, data=json.dumps(record, ensure_ascii=False))
+                conn.execute(stmt.on_conflict_do_update(index_elements=["username"], set_={"data": stmt.excluded.data}))
+
+
+# --- 單例 ---
+_repository: Optional[UserRepository] = None
+_repository_lock = threading.Lock()
+
+
+def get_user_repository() -> UserRepository:
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                if USER_STORE_BACKEND == "sqlite":
+                    _repository = SqliteUserRepository(USER_DB_PATH, legacy_json=USERS_FILE)
+                else:
+                    _repository = JsonUserRepository(USERS_FILE)
+    return _repository
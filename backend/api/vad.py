@@ -0,0 +1,116 @@
+# api/vad.py
+# 語音活動偵測 (VAD)：以能量與過零率判斷靜音，上傳 Whisper 前剪除頭尾靜音並壓縮過長的停頓
+
+import io
+import wave
+from typing import Dict, Tuple
+
+from .audio_processing import np, encode_wav_pcm16
+
+# --- 預設參數 (皆可由 config.json 覆寫) ---
+DEFAULT_FRAME_MS = 30  # 每個分析框的長度
+DEFAULT_ENERGY_MARGIN_DB = 12.0  # 高於背景噪音多少 dB 視為語音
+DEFAULT_ABSOLUTE_FLOOR_DB = -55.0  # 低於此能量 (dBFS) 一律視為靜音
+DEFAULT_ZCR_THRESHOLD = 0.25  # 過零率高於此值且有一定能量者視為子音 (如 s、f)
+DEFAULT_PADDING_MS = 200  # 語音段前後保留的緩衝，避免切掉字首字尾
+DEFAULT_MAX_PAUSE_MS = 800  # 內部停頓超過此長度時壓縮為此長度
+
+
+def _frame_features(samples: "np.ndarray", frame_len: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """回傳每個分析框的能量 (dBFS) 與過零率"""
+    n_frames = samples.size // frame_len
+    frames = samples[:n_frames * frame_len].reshape(n_frames, frame_len)
+    energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_len - 1)
+    return energy_db, zcr
+
+
+def _silent_runs(speech: "np.ndarray") -> "np.ndarray":
+    """找出連續靜音框的區段，回傳形狀為 (n, 2) 的 [start, end) 陣列"""
+    edges = np.diff(np.concatenate(([1], speech.astype(np.int8), [1])))
+    starts = np.flatnonzero(edges == -1)
+    ends = np.flatnonzero(edges == 1)
+    return np.stack([starts, ends], axis=1)
+
+
+def detect_keep_mask(samples: "np.ndarray", sample_rate: int, options: Dict) -> Tuple["np.ndarray", int]:
+    """
+    以分析框為單位回傳 (布林遮罩, 分析框樣本數)，True 表示保留。
+    頭尾的靜音整段移除，內部超過 max_pause_ms 的停頓只保留前後各一半。
+    """
+    frame_len = max(2, int(sample_rate * options.get("frame_ms", DEFAULT_FRAME_MS) / 1000))
+    energy_db, zcr = _frame_features(samples, frame_len)
+    if energy_db.size == 0:
+        return np.zeros(0, dtype=bool), frame_len
+
+    # 背景噪音以能量較低的 10% 分析框估計，門檻隨錄音環境自動調整
+    noise_floor = np.percentile(energy_db, 10)
+    margin = options.get("energy_margin_db", DEFAULT_ENERGY_MARGIN_DB)
+    threshold = max(noise_floor + margin, options.get("absolute_floor_db", DEFAULT_ABSOLUTE_FLOOR_DB))
+    speech = (energy_db > threshold) | (
+        (zcr > options.get("zcr_threshold", DEFAULT_ZCR_THRESHOLD)) & (energy_db > noise_floor + margin / 2)
+    )
+    if not speech.any():
+        return speech, frame_len
+
+    # 語音段前後延伸 padding，避免切到輕聲的字首字尾
+    frame_ms = frame_len * 1000 / sample_rate
+    pad = int(options.get("padding_ms", DEFAULT_PADDING_MS) / frame_ms)
+    if pad > 0:
+        speech = np.convolve(speech.astype(np.int8), np.ones(2 * pad + 1, dtype=np.int8), mode="same") > 0
+
+    keep = speech.copy()
+    max_pause = max(0, int(options.get("max_pause_ms", DEFAULT_MAX_PAUSE_MS) / frame_ms))
+    head_keep = max_pause // 2
+    for start, end in _silent_runs(speech):
+        if start == 0 or end == speech.size:
+            continue  # 頭尾靜音：整段移除
+        if end - start > max_pause:
+            keep[start:start + head_keep] = True
+            keep[end - (max_pause - head_keep):end] = True
+        else:
+            keep[start:end] = True
+    return keep, frame_len
+
+
+def strip_silence(wav_bytes: bytes, options: Dict) -> Tuple[bytes, Dict]:
+    """
+    對 16-bit 單聲道 PCM WAV 執行 VAD，回傳 (處理後 WAV, 統計報告)。
+    若偵測不到任何語音，回傳原始音訊，避免送出空白檔案。
+    """
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav_file:
+        if wav_file.getnchannels() != 1 or wav_file.getsampwidth() != 2:
+            raise ValueError("VAD 只處理 16-bit 單聲道 PCM WAV")
+        sample_rate = wav_file.getframerate()
+        pcm = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype="<i2")
+
+    original_seconds = pcm.size / sample_rate
+    keep_frames, frame_len = detect_keep_mask(pcm.astype(np.float32) / 32768.0, sample_rate, options)
+
+    if not keep_frames.any():
+        report = {"original_seconds": round(original_seconds, 2), "kept_seconds": round(original_seconds, 2),
+                  "removed_seconds": 0.0, "removed_ratio": 0.0, "speech_detected": False}
+        return wav_bytes, report
+
+    # 不足一個分析框的尾端樣本跟隨最後一個分析框的判斷
+    keep_samples = np.repeat(keep_frames, frame_len)
+    keep_samples = np.concatenate([keep_samples, np.full(pcm.size - keep_samples.size, keep_frames[-1])])
+    trimmed = pcm[keep_samples]
+
+    kept_seconds = trimmed.size / sample_rate
+    removed_seconds = original_seconds - kept_seconds
+    report = {
+        "original_seconds": round(original_seconds, 2),
+        "kept_seconds": round(kept_seconds, 2),
+        "removed_seconds": round(removed_seconds, 2),
+        "removed_ratio": round(removed_seconds / original_seconds, 3) if original_seconds else 0.0,
+        "speech_detected": True,
+    }
+    return encode_wav_pcm16(trimmed, sample_rate), report
+
+
+def vad_options_from_config(config: Dict) -> Dict:
+    """從 config.json 讀取 vad_* 參數"""
+    keys = ("frame_ms", "energy_margin_db", "absolute_floor_db", "zcr_threshold", "padding_ms", "max_pause_ms")
+    return {key: config[f"vad_{key}"] for key in keys if f"vad_{key}" in config}
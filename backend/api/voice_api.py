@@ -1,105 +1,84 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from fastapi import APIRouter, File, UploadFile, HTTPException, Query
+from starlette.concurrency import run_in_threadpool
 import os
-import io
 import httpx
 import json
-import traceback # 新增：導入 traceback 模組
+from typing import Optional, Tuple
 
 # 導入 get_auth_token 函式和 auth_token_cache
 from .custom_template import get_auth_token, auth_token_cache, load_llm_config
 
-# --- 引入音訊轉換庫 (您需要安裝 ffmpeg 和 pydub) ---
-try:
-    from pydub import AudioSegment
-    # 這裡不需要 play，移除它
-except ImportError:
-    print("[ERROR] pydub 庫未安裝。音訊格式轉換功能將不可用。")
-    print("請運行: pip install pydub")
-    print("並確保您的系統已安裝 ffmpeg。")
-    AudioSegment = None # 設置為 None，以便在後續代碼中進行檢查
+# 音訊正規化 (檔頭偵測、PCM 原生重取樣、壓縮格式交給 ffmpeg)
+from .audio_processing import normalize_audio, WHISPER_SAMPLE_RATE, np
+# 語音活動偵測 (剪除靜音)
+from .vad import strip_silence, vad_options_from_config
+from .metrics import time_stage, track_upstream
+from .app_logging import get_logger, log_fields, log_payload
 
 router = APIRouter()
+logger = get_logger("voice")
+
+
+def prepare_audio_for_whisper(
+    audio_file_content: bytes, file_format: str, config: dict, vad_enabled: bool
+) -> Tuple[bytes, str, str, Optional[dict]]:
+    """
+    正規化音訊並 (選擇性) 剪除靜音。回傳 (音訊內容, MIME 類型, 副檔名, VAD 報告)。
+    VAD 只在正規化後為 PCM WAV 時執行；未執行時報告為 None。
+    """
+    target_format = config.get("whisper_target_audio_format", "m4a")
+    target_rate = int(config.get("whisper_target_sample_rate", WHISPER_SAMPLE_RATE))
+
+    # 依檔頭判斷實際編碼與取樣率，而非比對 MIME 字串：
+    # PCM WAV 以 NumPy 轉為 16kHz 單聲道，只有 webm/opus、m4a 等壓縮格式才啟動 ffmpeg
+    with time_stage("audio_conversion"):
+        content, mime, ext, _ = normalize_audio(audio_file_content, file_format, target_format, target_rate)
+
+    if not vad_enabled or np is None or ext != "wav":
+        return content, mime, ext, None
+    try:
+        with time_stage("vad"):
+            trimmed, report = strip_silence(content, vad_options_from_config(config))
+    except Exception as e:
+        logger.warning("VAD 處理失敗，將送出未剪除靜音的音訊: %s", e)
+        return content, mime, ext, None
+    logger.debug("VAD 剪除靜音", extra=log_fields(**report))
+    return trimmed, mime, ext, report
+
 
 # 實際語音轉文字的核心函式
-async def perform_actual_speech_to_text_conversion(audio_file_content: bytes, file_format: str) -> str:
-    print(f"接收到音訊檔案，大小: {len(audio_file_content)} bytes. 正在準備進行地端語音辨識...")
+# audio_report: 若傳入 dict，VAD 執行後會將移除靜音的統計寫入 audio_report["vad"]
+async def perform_actual_speech_to_text_conversion(
+    audio_file_content: bytes,
+    file_format: str,
+    vad_enabled: Optional[bool] = None,
+    audio_report: Optional[dict] = None,
+) -> str:
+    logger.debug("接收到音訊檔案，準備進行地端語音辨識", extra=log_fields(bytes=len(audio_file_content), format=file_format))
 
     try:
         config = load_llm_config()
     except Exception as e:
-        print(f"[ERROR] 載入 LLM 配置失敗 (在 voice_api.py 中): {e}")
+        logger.error("載入 LLM 配置失敗: %s", e)
         raise HTTPException(status_code=500, detail="無法載入地端 Whisper 配置。")
 
     whisper_url = config.get("whisper_url")
     whisper_file_field = config.get("whisper_file_field", "file")
     whisper_lang_param = config.get("whisper_lang_param_key", "language")
     whisper_lang_value = config.get("whisper_lang_param_value", "zh_TW")
-    TARGET_AUDIO_FORMAT = config.get("whisper_target_audio_format", "m4a") 
 
     if not whisper_url:
         raise ValueError("Whisper URL 未設定，請檢查 config.json")
 
-    processed_audio_content = audio_file_content
-    processed_file_format = file_format
-    # 修正：確保處理 ;codecs=opus 和 x-m4a
-    processed_filename_ext = file_format.split('/')[-1].split(';')[0].replace('x-', '') if '/' in file_format else "bin" 
-    
-    # === 修正點：更健壯的音訊格式轉換邏輯 ===
-    # 檢查是否需要轉換：只有當 pydub 可用，且輸入格式不是目標格式時才轉換
-    # 或者如果原始格式是 webm (通常後端不直接支持)
-    # 或者如果原始格式是 m4a (通常也需要轉換成通用格式如 wav/mp3)
-    needs_conversion = AudioSegment and (
-        (f"audio/{processed_filename_ext}" != f"audio/{TARGET_AUDIO_FORMAT}") or
-        file_format.startswith("audio/webm") or
-        file_format.startswith("audio/x-m4a") or # 包含 x-m4a
-        file_format.startswith("audio/mp4") # 也考慮 mp4
-    )
+    if vad_enabled is None:
+        vad_enabled = bool(config.get("vad_enabled", False))
 
-    if needs_conversion:
-        print(f"[DEBUG] 檢測到音訊格式為 {file_format}，目標轉換為 {TARGET_AUDIO_FORMAT} 格式。")
-        try:
-            # 嘗試從 bytes 讀取原始音訊
-            if file_format.startswith("audio/webm"):
-                audio_segment = AudioSegment.from_file(io.BytesIO(audio_file_content), format="webm")
-            elif file_format.startswith("audio/x-m4a") or file_format.startswith("audio/mp4"): # 處理 m4a/mp4
-                audio_segment = AudioSegment.from_file(io.BytesIO(audio_file_content), format="m4a")
-            else:
-                # 對於其他格式，讓 pydub 嘗試自動檢測
-                audio_segment = AudioSegment.from_file(io.BytesIO(audio_file_content)) 
-                
-            print(f"[DEBUG] pydub 成功讀取原始音訊 ({file_format})。持續時間: {audio_segment.duration_seconds:.2f}秒, 幀率: {audio_segment.frame_rate}Hz, 聲道: {audio_segment.channels}")
-
-            # 將音訊轉換為目標格式的 bytes
-            output_buffer = io.BytesIO()
-            
-            export_params = {}
-            if TARGET_AUDIO_FORMAT == "wav":
-                export_params['codec'] = "pcm_s16le" # 確保使用兼容性最好的 PCM
-            elif TARGET_AUDIO_FORMAT == "mp3":
-                export_params['codec'] = "libmp3lame" # 常用 MP3 編碼器
-            
-            audio_segment.export(output_buffer, format=TARGET_AUDIO_FORMAT, **export_params)
-            
-            output_buffer.seek(0) # 重置緩衝區指針
-            processed_audio_content = output_buffer.read()
-            processed_file_format = f"audio/{TARGET_AUDIO_FORMAT}"
-            processed_filename_ext = TARGET_AUDIO_FORMAT
-            print(f"[DEBUG] 成功將音訊轉換為 {processed_file_format} 格式。新大小: {len(processed_audio_content)} bytes")
-            
-            if not processed_audio_content:
-                print(f"[WARNING] 轉換後的音訊內容為空，原始大小: {len(audio_file_content)} bytes。")
-
-        except Exception as e:
-            # 修正點：使用 traceback.format_exc() 獲取詳細錯誤堆棧
-            print(f"[ERROR] 音訊轉換失敗 ({file_format} -> {TARGET_AUDIO_FORMAT}): {e}")
-            print(f"詳細錯誤堆棧：\n{traceback.format_exc()}") # 打印詳細堆棧信息
-            print(f"[WARNING] 轉換失敗，將以原始 {file_format} 格式繼續發送請求，但這可能導致地端服務錯誤。")
-            # 如果轉換失敗，則仍使用原始內容
-            processed_audio_content = audio_file_content
-            processed_file_format = file_format
-            processed_filename_ext = file_format.split('/')[-1].split(';')[0].replace('x-', '') if '/' in file_format else "bin"
-    else: # pydub 不可用，或格式已經匹配目標，無需轉換
-        print(f"[DEBUG] 音訊格式為 {file_format}，且無需轉換或無法進行轉換，將直接發送。")
+    # 解碼、重取樣與 VAD 屬 CPU 密集工作，移到執行緒池以免阻塞事件迴圈
+    processed_audio_content, processed_file_format, processed_filename_ext, vad_report = await run_in_threadpool(
+        prepare_audio_for_whisper, audio_file_content, file_format, config, vad_enabled
+    )
+    if vad_report is not None and audio_report is not None:
+        audio_report["vad"] = vad_report
 
     # 修正點：在發送前再次檢查 processed_audio_content 是否為空
     if not processed_audio_content:
@@ -112,27 +91,31 @@ async def perform_actual_speech_to_text_conversion(audio_file_content: bytes, fi
         files_payload = {whisper_file_field: (f"audio.{processed_filename_ext}", processed_audio_content, processed_file_format)}
         full_whisper_url = f"{whisper_url}?{whisper_lang_param}={whisper_lang_value}"
 
-        print(f"[DEBUG] 發送請求到地端 Whisper URL: {full_whisper_url}")
-        print(f"[DEBUG] 發送的檔案欄位名稱: '{whisper_file_field}'")
-        print(f"[DEBUG] 發送的檔案名稱 (給服務): 'audio.{processed_filename_ext}'")
-        print(f"[DEBUG] 發送的檔案 MIME 類型: '{processed_file_format}'")
-        print(f"[DEBUG] 發送的請求頭: {headers}") 
+        # 請求標頭含 Bearer token，不記錄
+        logger.debug("發送請求到地端 Whisper", extra=log_fields(
+            url=full_whisper_url, field=whisper_file_field, filename=f"audio.{processed_filename_ext}",
+            mime=processed_file_format, bytes=len(processed_audio_content),
+        ))
 
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(full_whisper_url, files=files_payload, headers=headers)
+        with track_upstream("whisper") as call:
+            async with httpx.AsyncClient(timeout=180.0) as client:
+                response = await client.post(full_whisper_url, files=files_payload, headers=headers)
+            call.status = response.status_code
         
         if response.status_code == 401:
-            print("[DEBUG] 地端 Whisper 服務返回 401，嘗試刷新 Token...")
+            logger.info("地端 Whisper 服務返回 401，重新取得 Token")
             auth_token_cache["token"] = None 
             auth_token = await get_auth_token() 
             headers["Authorization"] = f"Bearer {auth_token}"
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(full_whisper_url, files=files_payload, headers=headers)
+            with track_upstream("whisper") as call:
+                async with httpx.AsyncClient(timeout=180.0) as client:
+                    response = await client.post(full_whisper_url, files=files_payload, headers=headers)
+                call.status = response.status_code
         
         response.raise_for_status() 
         
         whisper_response_data = response.json()
-        print(f"[DEBUG] 地端 Whisper 服務原始響應: {whisper_response_data}")
+        log_payload(logger, "地端 Whisper 服務原始響應", whisper_response_data, clinical=True)
 
         transcribed_text = whisper_response_data.get("data", "")
         
@@ -147,32 +130,30 @@ async def perform_actual_speech_to_text_conversion(audio_file_content: bytes, fi
 
         return transcribed_text
     except httpx.HTTPStatusError as e:
-        print(f"[ERROR] 地端 Whisper 服務 HTTP 錯誤: {e.response.status_code} - {e.response.text}")
         try:
             error_detail = e.response.json()
-            print(f"[ERROR] 地端 Whisper 服務詳細錯誤響應: {error_detail}")
         except json.JSONDecodeError:
             error_detail = e.response.text
-            print(f"[ERROR] 地端 Whisper 服務原始錯誤響應文本: {error_detail}")
+        logger.error("地端 Whisper 服務 HTTP 錯誤: %s - %s", e.response.status_code, error_detail)
         raise HTTPException(status_code=500, detail=f"地端 Whisper 服務錯誤: {e.response.status_code} - {error_detail}")
     except httpx.RequestError as e:
-        print(f"[ERROR] 無法連線至地端 Whisper 服務: {e}")
+        logger.error("無法連線至地端 Whisper 服務: %s", e)
         raise HTTPException(status_code=500, detail=f"無法連線至地端 Whisper 服務: {e}")
     except json.JSONDecodeError as e:
-        print(f"[ERROR] 解析地端 Whisper 響應 JSON 錯誤: {e}. Response text: {response.text}")
+        logger.error("解析地端 Whisper 響應 JSON 錯誤: %s", e, extra=log_fields(response_chars=len(response.text)))
         raise HTTPException(status_code=500, detail=f"地端 Whisper 服務響應格式錯誤: {e}")
     except ValueError as e:
-        print(f"[ERROR] 地端 Whisper 服務響應處理錯誤: {e}")
+        logger.error("地端 Whisper 服務響應處理錯誤: %s", e)
         raise HTTPException(status_code=500, detail=f"地端 Whisper 服務響應處理錯誤: {e}")
     except Exception as e:
-        print(f"[CRITICAL ERROR] 地端 Whisper 辨識時發生未預期錯誤: {type(e).__name__}: {e}")
-        print(f"詳細錯誤堆棧：\n{traceback.format_exc()}") # 打印詳細堆棧信息
+        logger.exception("地端 Whisper 辨識時發生未預期錯誤: %s: %s", type(e).__name__, e)
         raise HTTPException(status_code=500, detail=f"地端語音辨識時發生未知錯誤: {e}")
 
 
 @router.post("/voicetotext")
 async def transcribe_audio_endpoint(
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    vad: Optional[bool] = Query(None, description="是否剪除靜音；未指定時依 config.json 的 vad_enabled")
 ):
     if not file.content_type.startswith('audio/'):
         raise HTTPException(status_code=400, detail="只接受音訊檔案。")
@@ -181,14 +162,15 @@ async def transcribe_audio_endpoint(
         audio_content = await file.read()
         file_format = file.content_type
         
-        transcribed_text = await perform_actual_speech_to_text_conversion(audio_content, file_format)
+        audio_report = {}
+        transcribed_text = await perform_actual_speech_to_text_conversion(
+            audio_content, file_format, vad_enabled=vad, audio_report=audio_report
+        )
 
-        return {"text": transcribed_text}
+        return {"text": transcribed_text, **audio_report}
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
-        # 修正點：這裡也使用 traceback.format_exc()
-        print(f"語音辨識處理失敗 (非 HTTPException): {e}")
-        print(f"詳細錯誤堆棧：\n{traceback.format_exc()}") # 打印詳細堆棧信息
+        logger.exception("語音辨識處理失敗 (非 HTTPException): %s", e)
         raise HTTPException(status_code=500, detail=f"語音辨識處理失敗: {str(e)}")
 
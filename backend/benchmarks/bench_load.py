@@ -0,0 +1,385 @@
+# benchmarks/bench_load.py
+# 端到端負載測試：以 fake_services 在子行程中模擬 vLLM / Whisper / Token 服務，
+# 於同一行程內 (httpx.ASGITransport) 以多種情境驅動完整的 FastAPI 應用程式：
+#   login_burst     早上交班時大量同時登入 (bcrypt)
+#   generate_storm  大量同時生成 FillTemplate / SOAP (長短不一的主觀/客觀內容，LLM 串流)
+#   icd             ICD 建議 (檢索 + 非串流 LLM)
+#   long_audio      長時間錄音上傳 (重取樣 + VAD + Whisper)
+# 每個情境回報吞吐量、p50/p95/p99 延遲、錯誤數、事件迴圈延遲與 RSS，結果可存成 JSON 並與先前的結果比較。
+#
+# 用法 (在 backend/ 目錄下)：
+#   python benchmarks/bench_load.py --output before.json
+#   python benchmarks/bench_load.py --scenarios generate_storm,icd --requests 400 --concurrency 64 \
+#       --llm-tokens-per-second 60 --unauthorized-rate 0.01 --output after.json --compare before.json
+# 模擬服務的參數 (--llm-ttft-ms、--whisper-realtime-factor、--error-rate 等) 見 fake_services.FakeServiceOptions。
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_login import make_users_file, percentile
+import fake_services
+
+SCENARIOS = ("login_burst", "generate_storm", "icd", "long_audio")
+# 比較結果時列出的指標與「數值越大越好」與否
+COMPARED_METRICS = (
+    ("throughput_rps", True),
+    ("latency_ms_p50", False),
+    ("latency_ms_p95", False),
+    ("latency_ms_p99", False),
+    ("error_rate", False),
+    ("loop_lag_ms_p99", False),
+    ("rss_mb_peak", False),
+)
+
+SUBJECTIVE_SENTENCES = (
+    "病人主訴頭痛三天，以兩側太陽穴為主，下午較嚴重。",
+    "伴隨輕微噁心，無嘔吐，無發燒。",
+    "過去有高血壓病史，規則服用 amlodipine。",
+    "最近工作壓力大，睡眠約五小時。",
+    "否認外傷、視力模糊或肢體無力。",
+)
+OBJECTIVE_SENTENCES = (
+    "BP 138/86 mmHg, HR 78 bpm, BT 36.8 C.",
+    "Alert and oriented, no focal neurological deficit.",
+    "Neck supple, no lymphadenopathy.",
+    "Heart: regular rhythm without murmur.",
+)
+
+
+# --- 量測 ---
+def rss_mb() -> float:
+    """目前的常駐記憶體 (Linux 讀 /proc；其他平台退回 ru_maxrss，為歷史峰值)"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(latencies: List[float], statuses: Counter, elapsed: float,
+              loop_lags: List[float], rss_samples: List[float]) -> Dict[str, Any]:
+    total = sum(statuses.values())
+    errors = sum(count for status, count in statuses.items() if not 200 <= status < 300)
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "latency_ms_p50": round(percentile(latencies, 50), 1),
+        "latency_ms_p95": round(percentile(latencies, 95), 1),
+        "latency_ms_p99": round(percentile(latencies, 99), 1),
+        "latency_ms_max": round(max(latencies), 1),
+        "loop_lag_ms_p99": round(percentile(loop_lags, 99), 1) if loop_lags else 0.0,
+        "loop_lag_ms_max": round(max(loop_lags), 1) if loop_lags else 0.0,
+        "rss_mb_start": round(rss_samples[0], 1),
+        "rss_mb_peak": round(max(rss_samples), 1),
+        "rss_mb_end": round(rss_samples[-1], 1),
+    }
+
+
+class ResourceProbe:
+    """以 sleep 探測事件迴圈延遲 (sleep 超出預期的時間即為迴圈被阻塞的時間)，並取樣 RSS"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.loop_lags: List[float] = []
+        self.rss_samples: List[float] = [rss_mb()]
+        self._done = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.loop_lags.append((time.perf_counter() - start - self.interval) * 1000)
+            self.rss_samples.append(rss_mb())
+
+    async def stop(self) -> None:
+        self._done.set()
+        await self._task
+        self.rss_samples.append(rss_mb())
+
+
+async def run_jobs(jobs: List[Callable[[], Awaitable[Any]]], concurrency: int,
+                   probe_interval: float) -> Dict[str, Any]:
+    """以 concurrency 個同時請求執行 jobs，同時探測事件迴圈延遲與 RSS"""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    probe = ResourceProbe(probe_interval)
+
+    async def worker(job):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await job()
+                statuses[response.status_code] += 1
+            except Exception:
+                statuses[0] += 1  # 連線錯誤或逾時
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    probe.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(job) for job in jobs))
+    elapsed = time.perf_counter() - start
+    await probe.stop()
+    return summarize(latencies, statuses, elapsed, probe.loop_lags, probe.rss_samples)
+
+
+# --- 測試資料 ---
+def make_text(rng: random.Random, sentences, min_chars: int, max_chars: int) -> str:
+    target = rng.randint(min_chars, max_chars)
+    parts: List[str] = []
+    while sum(len(p) for p in parts) < target:
+        parts.append(rng.choice(sentences))
+    return "".join(parts)
+
+
+def make_wav(seconds: float, sample_rate: int, channels: int = 1) -> bytes:
+    """3 秒語音 (440Hz 方波近似) 與 1 秒靜音交錯，讓 VAD 有東西可剪"""
+    import io
+    import wave
+
+    frame = b"".join(
+        (6000 if (i * 440 // sample_rate) % 2 == 0 else -6000).to_bytes(2, "little", signed=True) * channels
+        for i in range(sample_rate)
+    )
+    silence = b"\x00\x00" * channels * sample_rate
+    pattern = frame * 3 + silence
+    whole = int(seconds)
+    body = (pattern * (whole // 4 + 1))[:whole * sample_rate * 2 * channels]
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(body)
+    return buffer.getvalue()
+
+
+# --- 情境 ---
+def build_jobs(name: str, client, args, rng: random.Random, tokens: List[str]):
+    """回傳 (jobs, concurrency)"""
+    def auth(i):
+        return {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+
+    if name == "login_burst":
+        # 所有登入同時送出
+        jobs = [
+            (lambda i=i: client.post("/auth/login", json={"username": f"doctor{i % args.users}", "password": "pw-0"}))
+            for i in range(args.logins)
+        ]
+        return jobs, max(1, args.logins)
+
+    if name == "generate_storm":
+        jobs = []
+        for i in range(args.requests):
+            body = {
+                "type": rng.choice(("FillTemplate", "SOAP")),
+                "subjective": make_text(rng, SUBJECTIVE_SENTENCES, 50, args.max_input_chars),
+                "objective": make_text(rng, OBJECTIVE_SENTENCES, 0, args.max_input_chars // 2),
+            }
+            jobs.append(lambda i=i, body=body: client.post("/api/chat/generate", json=body, headers=auth(i)))
+        return jobs, args.concurrency
+
+    if name == "icd":
+        jobs = []
+        for i in range(args.requests):
+            body = {"subjective_text": make_text(rng, SUBJECTIVE_SENTENCES, 30, 300)}
+            jobs.append(lambda i=i, body=body: client.post("/api/icd/infer", json=body, headers=auth(i)))
+        return jobs, args.concurrency
+
+    if name == "long_audio":
+        audio = make_wav(args.audio_seconds, args.audio_sample_rate, args.audio_channels)
+        jobs = [
+            (lambda: client.post("/api/voice/voicetotext", files={"file": ("recording.wav", audio, "audio/wav")}))
+            for _ in range(args.audio_requests)
+        ]
+        return jobs, args.audio_concurrency
+
+    raise ValueError(f"未知的情境: {name}")
+
+
+async def run_all(app, args, base_url: str) -> Dict[str, Any]:
+    import httpx
+    from api.login import create_access_token
+
+    rng = random.Random(args.seed)
+    tokens = [create_access_token({"sub": f"doctor{i}"}) for i in range(min(args.users, 50))]
+    results: Dict[str, Any] = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+        for name in args.scenarios:
+            jobs, concurrency = build_jobs(name, client, args, rng, tokens)
+            results[name] = await run_jobs(jobs, concurrency, args.probe_interval)
+            results[name]["concurrency"] = concurrency
+            print(f"{name}: {results[name]['requests']} 個請求, {results[name]['throughput_rps']} req/s, "
+                  f"p99 {results[name]['latency_ms_p99']} ms, 錯誤 {results[name]['errors']}", file=sys.stderr)
+    async with httpx.AsyncClient() as client:
+        results["_upstream_calls"] = (await client.get(base_url + "/health")).json()
+    return results
+
+
+# --- 結果比較 ---
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """兩份結果中共同情境的各指標變化；change_pct 為正表示數值增加，regression 依指標方向判斷"""
+    rows = []
+    for scenario, metrics in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(scenario)
+        if scenario.startswith("_") or not before:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = before.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else (0.0 if new == old else float("inf"))
+            rows.append({
+                "scenario": scenario,
+                "metric": metric,
+                "baseline": old,
+                "current": new,
+                "change_pct": round(change, 1),
+                "regression": (new < old) if higher_is_better else (new > old),
+            })
+    return rows
+
+
+def format_comparison(rows: List[Dict[str, Any]], threshold_pct: float) -> str:
+    width = max([16] + [len(row["scenario"]) + 2 for row in rows])
+    lines = [f"{'scenario':<{width}}{'metric':<18}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for row in rows:
+        flag = " !" if row["regression"] and abs(row["change_pct"]) >= threshold_pct else ""
+        lines.append(f"{row['scenario']:<{width}}{row['metric']:<18}{row['baseline']:>12}{row['current']:>12}"
+                     f"{row['change_pct']:>+9.1f}%{flag}")
+    return "\n".join(lines)
+
+
+def add_load_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt 成本參數")
+    parser.add_argument("--timeout", type=float, default=120.0, help="單一請求逾時秒數")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="事件迴圈探測的間隔秒數")
+    parser.add_argument("--output", help="結果 JSON 的存檔路徑")
+    parser.add_argument("--compare", help="要比較的先前結果 JSON")
+    parser.add_argument("--threshold", type=float, default=10.0, help="比較時標示退步的變化百分比")
+    fake_services.add_arguments(parser)
+
+
+def prepare_environment(args) -> Dict[str, str]:
+    """必須在匯入 api 模組之前呼叫：建立暫存的使用者檔與病患資料庫，回傳需清除的路徑"""
+    os.environ["PASSWORD_BCRYPT_ROUNDS"] = str(args.rounds)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from passlib.context import CryptContext
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    users_file = make_users_file(args.users, CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.rounds).hash)
+    os.environ["USERS_FILE"] = users_file
+    os.environ["PATIENT_DB_PATH"] = os.path.join(workdir, "patients.db")
+    return {"workdir": workdir, "users_file": users_file}
+
+
+def point_config_at(base_url: str, workdir: str) -> None:
+    """以指向模擬服務的暫存 config.json 取代 backend/config.json"""
+    from api import custom_template, chat
+
+    config_file = os.path.join(workdir, "config.json")
+    with open(config_file, "w", encoding="utf-8") as f:
+        json.dump(fake_services.service_config(base_url), f, ensure_ascii=False)
+    custom_template.CONFIG_FILE = config_file
+    custom_template.auth_token_cache["token"] = None
+    chat.auth_token_cache["token"] = None
+
+
+def cleanup_environment(paths: Dict[str, str]) -> None:
+    import shutil
+    os.remove(paths["users_file"])
+    shutil.rmtree(paths["workdir"], ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端負載測試 (模擬的 vLLM / Whisper / Token 服務)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"以逗號分隔，可用：{', '.join(SCENARIOS)}")
+    parser.add_argument("--logins", type=int, default=200, help="login_burst 同時送出的登入數")
+    parser.add_argument("--requests", type=int, default=200, help="generate_storm / icd 的請求數")
+    parser.add_argument("--concurrency", type=int, default=32, help="generate_storm / icd 的同時請求數")
+    parser.add_argument("--max-input-chars", type=int, default=1500, help="生成請求主觀內容的最大字數")
+    parser.add_argument("--audio-requests", type=int, default=8)
+    parser.add_argument("--audio-concurrency", type=int, default=4)
+    parser.add_argument("--audio-seconds", type=float, default=180.0, help="每段錄音的長度")
+    parser.add_argument("--audio-sample-rate", type=int, default=48000)
+    parser.add_argument("--audio-channels", type=int, default=1)
+    add_load_arguments(parser)
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的情境: {', '.join(sorted(unknown))}")
+
+    options = fake_services.options_from_args(args)
+    paths = prepare_environment(args)
+    process, base_url = fake_services.start_fake_services(options)
+    try:
+        from main import app
+        point_config_at(base_url, paths["workdir"])
+        scenarios = asyncio.run(run_all(app, args, base_url))
+    finally:
+        fake_services.stop_fake_services(process)
+        cleanup_environment(paths)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": scenarios,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n與 {args.compare} (commit {baseline.get('meta', {}).get('git_commit')}) 比較：")
+        print(format_comparison(compare_results(baseline, report), args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# benchmarks/bench_login.py
+# 登入尖峰 (例如交班時大量同時登入) 的吞吐量，以及同時間其他路由的回應延遲。
+# 比較 bcrypt 驗證在專用執行緒池執行 (目前實作) 與直接在事件迴圈上執行 (naive) 的差異。
+#
+# 用法 (在 backend/ 目錄下)：
+#   python benchmarks/bench_login.py --users 200 --logins 200 --rounds 12
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def make_users_file(count, hash_fn):
+    users = []
+    stored = hash_fn("pw-0")  # 全部使用相同雜湊，省去建立測試資料的時間
+    for i in range(count):
+        users.append({
+            "username": f"doctor{i}", "password": stored, "name": f"醫師{i}", "department": "內科",
+            "title": "主治醫師", "role": "user", "email": "", "phone": "", "status": "active",
+            "avatar": "", "note": "",
+        })
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(users, f, ensure_ascii=False)
+    return path
+
+
+async def run_burst(app, logins, users, probe_interval):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        probe_latencies = []
+        loop_lags = []
+        done = asyncio.Event()
+
+        async def probe():
+            # 模擬同時間的其他請求 (不需驗證的輕量路由)；sleep 超出預期的時間即為事件迴圈被阻塞的時間
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(probe_interval)
+                loop_lags.append((time.perf_counter() - start - probe_interval) * 1000)
+                start = time.perf_counter()
+                await client.get("/ping")
+                probe_latencies.append((time.perf_counter() - start) * 1000)
+
+        async def login(i):
+            start = time.perf_counter()
+            r = await client.post("/auth/login", json={"username": f"doctor{i % users}", "password": "pw-0"})
+            assert r.status_code == 200, r.text
+            return (time.perf_counter() - start) * 1000
+
+        probe_task = asyncio.create_task(probe())
+        await asyncio.sleep(probe_interval * 5)
+        start = time.perf_counter()
+        login_latencies = await asyncio.gather(*(login(i) for i in range(logins)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    return {
+        "logins": logins,
+        "elapsed_seconds": round(elapsed, 3),
+        "logins_per_second": round(logins / elapsed, 1),
+        "login_ms_p50": round(percentile(login_latencies, 50), 1),
+        "login_ms_p99": round(percentile(login_latencies, 99), 1),
+        "probe_requests": len(probe_latencies),
+        "probe_ms_p50": round(percentile(probe_latencies, 50), 2),
+        "probe_ms_p99": round(percentile(probe_latencies, 99), 2),
+        "probe_ms_max": round(max(probe_latencies), 2),
+        "probe_ms_mean": round(statistics.mean(probe_latencies), 2),
+        "loop_lag_ms_p99": round(percentile(loop_lags, 99), 1),
+        "loop_lag_ms_max": round(max(loop_lags), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="登入尖峰吞吐量與事件迴圈阻塞測試")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--logins", type=int, default=200, help="同時送出的登入請求數")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt 成本參數")
+    parser.add_argument("--workers", type=int, help="雜湊執行緒數 (預設依 PASSWORD_HASH_WORKERS)")
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="探測請求的間隔秒數")
+    args = parser.parse_args()
+
+    # 必須在匯入 api 模組之前設定
+    os.environ["PASSWORD_BCRYPT_ROUNDS"] = str(args.rounds)
+    if args.workers:
+        os.environ["PASSWORD_HASH_WORKERS"] = str(args.workers)
+    from passlib.context import CryptContext
+    users_file = make_users_file(args.users, CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.rounds).hash)
+    os.environ["USERS_FILE"] = users_file
+
+    from fastapi import FastAPI
+    from api import login, password_hashing
+
+    app = FastAPI()
+    app.include_router(login.router, prefix="/auth")
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    print(f"{args.users} 位使用者，{args.logins} 個同時登入，bcrypt rounds={args.rounds}，"
+          f"雜湊執行緒={password_hashing.HASH_WORKERS}\n")
+    try:
+        results = {"thread_pool": asyncio.run(run_burst(app, args.logins, args.users, args.probe_interval))}
+
+        # naive：直接在事件迴圈上驗證
+        async def verify_inline(password, stored):
+            return password_hashing.verify_password(password, stored)
+
+        login.verify_password_async = verify_inline
+        results["event_loop"] = asyncio.run(run_burst(app, args.logins, args.users, args.probe_interval))
+    finally:
+        os.remove(users_file)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# benchmarks/bench_objective_parser.py
+# Objective 解析效能比較：舊版逐行逐類別 re.match 的兩次走訪 vs. objective_parser 的單一編譯交替式
+#
+# 用法 (在 backend/ 目錄下)：
+#   python benchmarks/bench_objective_parser.py --visits 20000 --lines 40
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.objective_parser import DEFAULT_CATEGORIES, GENERAL_CATEGORY, ObjectiveParser  # noqa: E402
+
+# --- 舊版實作 (改版前 ChtnoPatient.from_opd_data 的解析邏輯，只回傳 tuple 以便公平比較) ---
+LEGACY_PATTERNS = {
+    "超音波 (Sono)": r"(?:sono|ultrasound|超音波):\s*(.*)",
+    "X光 (X-ray)": r"(?:x-ray|xray|X光):\s*(.*)",
+    "電腦斷層 (CT)": r"(?:CT|ct|電腦斷層):\s*(.*)",
+    "核磁共振 (MRI)": r"(?:MRI|mri|核磁共振):\s*(.*)",
+    "抽血 (Blood Test)": r"(?:blood test|lab results|抽血|血液檢查):\s*(.*)",
+    "病理報告 (Pathology)": r"(?:pathology|病理):\s*(.*)",
+}
+
+
+def legacy_parse(text):
+    result = []
+    processed = set()
+    lines = text.replace('\n', '\r\n').split('\r\n')
+    for i, line in enumerate(lines):
+        line_stripped = line.strip()
+        if not line_stripped:
+            continue
+        for category, pattern in LEGACY_PATTERNS.items():
+            match = re.match(pattern, line_stripped, re.IGNORECASE)
+            if match:
+                result.append((category, match.group(1).strip(), line_stripped))
+                processed.add(i)
+                break
+    for i, line in enumerate(lines):
+        if i not in processed:
+            line_stripped = line.strip()
+            if line_stripped:
+                result.append((GENERAL_CATEGORY, line_stripped, line_stripped))
+    return result
+
+
+# --- 合成資料 ---
+EXAM_LINES = [
+    "Sono: liver parenchyma coarse, no focal lesion",
+    "ultrasound: GB wall thickening",
+    "X-ray: no active lung lesion",
+    "X光: 心臟大小正常",
+    "CT: 2cm nodule at RUL",
+    "MRI: L4-5 disc herniation",
+    "blood test: WBC 8500, Hb 13.2",
+    "抽血: AST 35, ALT 40",
+    "pathology: adenocarcinoma, moderately differentiated",
+    "病理: 良性增生",
+]
+VITAL_LINES = ["BMI: 23.4", "BP: 128/82 mmHg", "PR: 78/min", "Height: 170 cm", "Weight: 68 kg"]
+GENERAL_LINES = [
+    "Conscious clear, E4V5M6",
+    "HEENT: not anemic, not icteric",
+    "Chest: bilateral clear breath sound",
+    "Abdomen: soft, no tenderness",
+    "四肢無水腫",
+    "精神狀態良好，對答切題",
+    "Skin: no rash",
+]
+
+
+def make_texts(visits, lines_per_visit, include_vitals, seed):
+    rng = random.Random(seed)
+    pool = EXAM_LINES + GENERAL_LINES + (VITAL_LINES if include_vitals else [])
+    texts = []
+    for _ in range(visits):
+        lines = [rng.choice(pool) for _ in range(lines_per_visit)]
+        # 混入空白行與前後空白，與實際輸入相近
+        lines.insert(rng.randrange(len(lines) + 1), "")
+        texts.append("\n".join(f"  {line} " if rng.random() < 0.1 else line for line in lines))
+    return texts
+
+
+def bench(label, fn, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(texts)
+        best = min(best, time.perf_counter() - start)
+    total_lines = sum(text.count("\n") + 1 for text in texts)
+    print(f"{label:<28} {best * 1000:9.1f} ms   {len(texts) / best:11.0f} visits/s   {total_lines / best:12.0f} lines/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Objective 解析器效能比較")
+    parser.add_argument("--visits", type=int, default=20000)
+    parser.add_argument("--lines", type=int, default=40, help="每筆就診的 Objective 行數")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # 只含原有六類檢查時，新舊結果必須完全一致
+    texts = make_texts(args.visits, args.lines, include_vitals=False, seed=args.seed)
+    exam_only = ObjectiveParser(DEFAULT_CATEGORIES[:len(LEGACY_PATTERNS)])
+    for text in texts[:1000]:
+        assert exam_only.parse(text) == legacy_parse(text), f"解析結果不一致:\n{text}"
+    print(f"{args.visits} 筆就診，每筆 {args.lines} 行 (取 {args.repeat} 次最佳)\n")
+
+    legacy = bench("舊版 (逐類別 re.match)", lambda ts: [legacy_parse(t) for t in ts], texts, args.repeat)
+    single = bench("單一交替式 parse()", lambda ts: [exam_only.parse(t) for t in ts], texts, args.repeat)
+    batch = bench("單一交替式 parse_many()", exam_only.parse_many, texts, args.repeat)
+    print(f"\n加速倍數: parse() {legacy / single:.2f}x, parse_many() {legacy / batch:.2f}x")
+
+    # 含生命徵象類別的完整預設註冊表
+    texts_with_vitals = make_texts(args.visits, args.lines, include_vitals=True, seed=args.seed)
+    print()
+    bench("預設註冊表 (含生命徵象)", ObjectiveParser().parse_many, texts_with_vitals, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# benchmarks/fake_services.py
+# 本機的 vLLM / Whisper / Token 服務替身，供負載測試在沒有 GPU 服務的環境下驅動完整的請求流程。
+# 延遲以對數常態分布抽樣 (中位數 + sigma)，LLM 串流依設定的 token 速率逐段送出，並可注入 401 (Token 輪替) 與 500 錯誤。
+#
+# 單獨啟動 (在 backend/ 目錄下)，再把 config.json 的 openai_api_base / whisper_url / token_url 指向它：
+#   python benchmarks/fake_services.py --port 9100 --llm-ttft-ms 300 --llm-tokens-per-second 40
+#
+#   openai_api_base = http://127.0.0.1:9100/v1/chat/completions
+#   whisper_url     = http://127.0.0.1:9100/api/Inference/voicetotext
+#   token_url       = http://127.0.0.1:9100/api/Account/Login
+
+import io
+import json
+import math
+import time
+import wave
+import socket
+import random
+import asyncio
+import argparse
+import multiprocessing
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+LLM_PATH = "/v1/chat/completions"
+WHISPER_PATH = "/api/Inference/voicetotext"
+TOKEN_PATH = "/api/Account/Login"
+
+# 模擬的病歷輸出 (依範本的方括號格式，逐行循環使用直到達到輸出 token 數)
+SAMPLE_OUTPUT_LINES = (
+    "Chief Complaint:[intermittent headache for three days]",
+    "History of Present Illness:[throbbing pain over bilateral temporal area, worse in the afternoon]",
+    "Past Medical History:[hypertension under regular medication]",
+    "Medication History:[amlodipine 5 mg once daily]",
+    "Physical Examination:[alert, BP 138/86 mmHg, no focal neurological deficit]",
+    "Allergy History:[no data]",
+    "Review of Systems:[no fever, no nausea or vomiting]",
+)
+SAMPLE_ICD_RESPONSE = [{"code": "R51", "name": "頭痛"}, {"code": "G44.2", "name": "緊張型頭痛"}]
+
+
+class FakeServiceOptions(BaseModel):
+    seed: Optional[int] = None
+    latency_sigma: float = 0.35  # 對數常態分布的 sigma；0 表示固定延遲
+    token_ms: float = 20.0  # Token 服務的延遲中位數
+    llm_ttft_ms: float = 300.0  # LLM 第一個 token 的延遲中位數 (非串流時為回應前的等待)
+    llm_tokens_per_second: float = 40.0  # 串流時每秒送出的 token 數 (非串流時用於計算總時間)
+    llm_output_tokens: int = 180  # 每次生成的 token 數 (不超過請求的 max_tokens)
+    whisper_ms: float = 150.0  # Whisper 的固定延遲中位數
+    whisper_realtime_factor: float = 0.05  # 每秒音訊額外需要的處理秒數
+    error_rate: float = 0.0  # LLM / Whisper 回傳 500 的機率
+    unauthorized_rate: float = 0.0  # 輪替 Token 使呼叫端收到 401 的機率
+
+
+# --- 服務 ---
+def _sample_seconds(rng: random.Random, median_ms: float, sigma: float) -> float:
+    if median_ms <= 0:
+        return 0.0
+    return median_ms / 1000 * (math.exp(rng.gauss(0, sigma)) if sigma > 0 else 1.0)
+
+
+def _audio_seconds(data: bytes) -> float:
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            return w.getnframes() / float(w.getframerate())
+    except (wave.Error, EOFError):
+        return len(data) / 32000.0  # 非 WAV 時以 16kHz 16-bit 單聲道估算
+
+
+def _output_tokens(limit: Optional[int], options: FakeServiceOptions) -> List[str]:
+    """以一個英文單字近似一個 token，逐行循環 SAMPLE_OUTPUT_LINES 直到目標數量"""
+    target = min(options.llm_output_tokens, limit or options.llm_output_tokens)
+    pieces: List[str] = []
+    line_index = 0
+    while len(pieces) < target:
+        words = SAMPLE_OUTPUT_LINES[line_index % len(SAMPLE_OUTPUT_LINES)].split(" ")
+        for j, word in enumerate(words[:target - len(pieces)]):
+            pieces.append(word if j == 0 else " " + word)
+        pieces[-1] += "\n"
+        line_index += 1
+    return pieces
+
+
+def create_app(options: FakeServiceOptions):
+    from fastapi import FastAPI, Request
+    from starlette.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+    rng = random.Random(options.seed)
+    state = {"token": "fake-token-0", "generation": 0}
+    counters = {"llm": 0, "whisper": 0, "token": 0, "unauthorized": 0, "errors": 0}
+
+    def check_request(request: Request) -> Optional[JSONResponse]:
+        if options.unauthorized_rate and rng.random() < options.unauthorized_rate:
+            state["generation"] += 1
+            state["token"] = f"fake-token-{state['generation']}"
+        if request.headers.get("authorization") != f"Bearer {state['token']}":
+            counters["unauthorized"] += 1
+            return JSONResponse({"detail": "token expired"}, status_code=401)
+        if options.error_rate and rng.random() < options.error_rate:
+            counters["errors"] += 1
+            return JSONResponse({"detail": "injected failure"}, status_code=500)
+        return None
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True, **counters}
+
+    @app.post(TOKEN_PATH)
+    async def login():
+        counters["token"] += 1
+        await asyncio.sleep(_sample_seconds(rng, options.token_ms, options.latency_sigma))
+        return {"data": {"token": state["token"]}}
+
+    @app.post(WHISPER_PATH)
+    async def whisper(request: Request):
+        counters["whisper"] += 1
+        form = await request.form()
+        upload = next((value for value in form.values() if hasattr(value, "read")), None)
+        data = await upload.read() if upload is not None else b""
+        failure = check_request(request)
+        if failure is not None:
+            return failure
+        seconds = _sample_seconds(rng, options.whisper_ms, options.latency_sigma) + \
+            _audio_seconds(data) * options.whisper_realtime_factor
+        await asyncio.sleep(seconds)
+        return {"data": "病人主訴頭痛三天，下午較嚴重，無發燒。"}
+
+    @app.post(LLM_PATH)
+    async def chat_completions(request: Request):
+        counters["llm"] += 1
+        body = await request.json()
+        failure = check_request(request)
+        if failure is not None:
+            return failure
+        prompt = json.dumps(body.get("messages", []), ensure_ascii=False)
+        ttft = _sample_seconds(rng, options.llm_ttft_ms, options.latency_sigma)
+        interval = 1.0 / options.llm_tokens_per_second if options.llm_tokens_per_second > 0 else 0.0
+
+        if "ICD-10" in prompt:
+            pieces = [json.dumps(SAMPLE_ICD_RESPONSE, ensure_ascii=False)]
+        else:
+            pieces = _output_tokens(body.get("max_tokens"), options)
+        usage = {"prompt_tokens": len(prompt) // 3, "completion_tokens": len(pieces), "total_tokens": len(prompt) // 3 + len(pieces)}
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + interval * len(pieces))
+            return {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        async def stream():
+            await asyncio.sleep(ttft)
+            for piece in pieces:
+                yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": piece}}]}, ensure_ascii=False) + "\n\n"
+                if interval:
+                    await asyncio.sleep(interval)
+            if include_usage:
+                yield "data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+# --- 以子行程啟動 (不與被測應用程式共用事件迴圈與 GIL) ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(options_dict: dict, port: int) -> None:
+    import uvicorn
+    uvicorn.run(create_app(FakeServiceOptions(**options_dict)), host="127.0.0.1", port=port, log_level="warning")
+
+
+def start_fake_services(options: FakeServiceOptions, port: int = 0, timeout: float = 15.0) -> Tuple[multiprocessing.Process, str]:
+    """回傳 (子行程, base_url)；結束時請呼叫 stop_fake_services"""
+    import httpx
+
+    port = port or _free_port()
+    process = multiprocessing.get_context("spawn").Process(target=_serve, args=(options.model_dump(), port), daemon=True)
+    process.start()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + "/health", timeout=1.0).status_code == 200:
+                return process, base_url
+        except httpx.TransportError:
+            pass
+        if not process.is_alive():
+            break
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"模擬服務未能於 {timeout} 秒內啟動 (port {port})")
+
+
+def stop_fake_services(process: multiprocessing.Process) -> None:
+    process.terminate()
+    process.join(timeout=5)
+
+
+def service_config(base_url: str, **overrides) -> dict:
+    """指向模擬服務的 config.json 內容"""
+    return {
+        "openai_api_key": "EMPTY",
+        "openai_api_base": base_url + LLM_PATH,
+        "llm_model": "fake-model",
+        "whisper_url": base_url + WHISPER_PATH,
+        "token_url": base_url + TOKEN_PATH,
+        "token_account": "bench",
+        "token_password": "bench",
+        "whisper_file_field": "file",
+        "whisper_target_audio_format": "wav",
+        "whisper_target_sample_rate": 16000,
+        "vad_enabled": True,
+        **overrides,
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """將 FakeServiceOptions 的欄位加為命令列參數 (--llm-ttft-ms 等)"""
+    for name, field in FakeServiceOptions.model_fields.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=int if name == "seed" else type(field.default),
+                            default=field.default)
+
+
+def options_from_args(args: argparse.Namespace) -> FakeServiceOptions:
+    return FakeServiceOptions(**{name: getattr(args, name) for name in FakeServiceOptions.model_fields})
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="vLLM / Whisper / Token 服務替身")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    options = options_from_args(args)
+    print(json.dumps(service_config(f"http://127.0.0.1:{args.port}"), ensure_ascii=False, indent=2))
+    uvicorn.run(create_app(options), host="127.0.0.1", port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
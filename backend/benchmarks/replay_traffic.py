@@ -0,0 +1,308 @@
+# benchmarks/replay_traffic.py
+# 重播 api/traffic_capture.py 錄下的流量：依錄製時的到達間隔 (可加速) 送出相同路由、相同內容長度的請求，
+# 上游服務以 fake_services 替代，回報整體與各路由的延遲、吞吐量、事件迴圈延遲與 RSS。
+# 同一份錄製檔在兩個版本上各重播一次，再以 --compare 比較，即為以實際流量組成進行的效能回歸測試。
+#
+# 請求內容依錄製的形狀合成：字串欄位以相同長度的假病歷文字填入，使用者與路徑參數 (雜湊) 對應到固定的測試帳號與識別碼，
+# 音訊上傳以相同時長的 WAV 送出 (壓縮格式依 COMPRESSED_AUDIO_BYTES_PER_SECOND 估算時長，不含解碼成本)。
+# 測試資料庫為空，需要既有病患資料的路由會回傳 404，兩個版本的結果仍可比較。
+#
+# 用法 (在 backend/ 目錄下)：
+#   TRAFFIC_CAPTURE_FILE=/path/traffic.jsonl uvicorn main:app --host 0.0.0.0 --port 9988   # 錄製
+#   python benchmarks/replay_traffic.py /path/traffic.jsonl --speed 4 --output before.json
+#   git checkout <新版本>
+#   python benchmarks/replay_traffic.py /path/traffic.jsonl --speed 4 --output after.json --compare before.json
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import datetime
+import platform
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_load
+import fake_services
+from bench_login import percentile
+
+# WAV 依錄製的取樣率與聲道數重建 (未錄到時以 16kHz 單聲道)；其他格式 (例如瀏覽器錄音的 webm/opus) 以約 32kbps 估算時長，
+# 並以 16kHz 單聲道 WAV 送出
+WAV_TYPES = frozenset({"audio/wav", "audio/x-wav", "audio/wave", "audio/vnd.wave"})
+COMPRESSED_AUDIO_BYTES_PER_SECOND = 4000
+REPLAY_SAMPLE_RATE = 16000
+# multipart 表單欄位未錄製，以下路由補上必要的欄位
+MULTIPART_FORM_DEFAULTS = {
+    "/api/chat/voice-generate": {"type": "FillTemplate"},
+}
+REPLAY_PASSWORD = "pw-0"  # 與 bench_login.make_users_file 相同
+_PATH_PARAM = re.compile(r"\{(\w+)(?::\w+)?\}")
+_LENGTH_PLACEHOLDER = re.compile(r"^<(\d+)>$")
+FILLER_TEXT = "".join(bench_load.SUBJECTIVE_SENTENCES)
+
+
+# --- 讀取錄製檔 ---
+def load_capture(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            # 未對應到路由的請求 (404 掃描等) 無法還原路徑
+            if record.get("route") == "unmatched":
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r["t"])
+    return records[:limit] if limit else records
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+# --- 合成請求 ---
+class Identities:
+    """錄製檔中的雜湊 -> 固定的測試帳號 (doctor0, doctor1, ...) 與路徑參數值"""
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.users: Dict[str, int] = {}
+        self.values: Dict[str, str] = {}
+        for record in records:
+            if record.get("user"):
+                self.user_index(record["user"])
+            self._collect_users(record.get("body"))
+
+    def _collect_users(self, shape: Any) -> None:
+        if isinstance(shape, dict):
+            for key, value in shape.items():
+                if key == "username" and isinstance(value, str) and value.startswith("#"):
+                    self.user_index(value)
+                else:
+                    self._collect_users(value)
+        elif isinstance(shape, list):
+            for value in shape:
+                self._collect_users(value)
+
+    def user_index(self, hashed: str) -> int:
+        return self.users.setdefault(hashed, len(self.users))
+
+    def username(self, hashed: str) -> str:
+        return f"doctor{self.user_index(hashed)}"
+
+    def value(self, hashed: str) -> str:
+        return self.values.setdefault(hashed, f"replay{len(self.values)}")
+
+
+def filler_text(length: int) -> str:
+    repeats = length // len(FILLER_TEXT) + 1
+    return (FILLER_TEXT * repeats)[:length]
+
+
+def unshape(shape: Any, identities: Identities, key: Optional[str] = None) -> Any:
+    """traffic_capture.shape_value 的反向：以相同長度的文字與測試帳號重建 JSON 內容"""
+    if isinstance(shape, dict):
+        return {k: unshape(v, identities, k) for k, v in shape.items()}
+    if isinstance(shape, list):
+        return [unshape(v, identities) for v in shape]
+    if isinstance(shape, str):
+        if key == "password":
+            return REPLAY_PASSWORD
+        if shape.startswith("#"):
+            return identities.username(shape) if key == "username" else identities.value(shape)
+        match = _LENGTH_PLACEHOLDER.match(shape)
+        if match:
+            return filler_text(int(match.group(1)))
+    return shape
+
+
+class ReplayRequest:
+    __slots__ = ("offset", "key", "method", "url", "kwargs", "user", "captured_ms")
+
+    def __init__(self, offset: float, key: str, method: str, url: str, kwargs: Dict[str, Any],
+                 user: Optional[int], captured_ms: float):
+        self.offset = offset
+        self.key = key
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.user = user
+        self.captured_ms = captured_ms
+
+
+def build_requests(records: List[Dict[str, Any]], identities: Identities) -> List[ReplayRequest]:
+    """在開始計時之前合成全部請求 (含音訊)，重播時只需送出"""
+    if not records:
+        return []
+    t0 = records[0]["t"]
+    audio_cache: Dict[Tuple[int, int, int], bytes] = {}
+    requests = []
+    for record in records:
+        route = record["route"]
+        params = record.get("path_params") or {}
+        url = _PATH_PARAM.sub(lambda m: identities.value(params.get(m.group(1), "#" + m.group(1))), route)
+        kwargs: Dict[str, Any] = {}
+        if record.get("query"):
+            kwargs["params"] = {k: str(unshape(v, identities, k)) for k, v in record["query"].items()}
+
+        content_type = record.get("content_type")
+        if content_type == "application/json":
+            kwargs["json"] = unshape(record.get("body", {}), identities)
+        elif content_type == "multipart/form-data":
+            sample_rate = record.get("audio_sample_rate") or REPLAY_SAMPLE_RATE
+            channels = record.get("audio_channels") or 1
+            if record.get("audio_type") in WAV_TYPES or record.get("audio_sample_rate"):
+                bytes_per_second = sample_rate * channels * 2
+            else:
+                bytes_per_second = COMPRESSED_AUDIO_BYTES_PER_SECOND
+            seconds = max(1, round(record.get("request_bytes", 0) / bytes_per_second))
+            audio_key = (seconds, sample_rate, channels)
+            if audio_key not in audio_cache:
+                audio_cache[audio_key] = bench_load.make_wav(seconds, sample_rate, channels)
+            kwargs["files"] = {"file": ("recording.wav", audio_cache[audio_key], "audio/wav")}
+            if route in MULTIPART_FORM_DEFAULTS:
+                kwargs["data"] = MULTIPART_FORM_DEFAULTS[route]
+        elif record.get("request_bytes"):
+            kwargs["content"] = b"x" * record["request_bytes"]
+            kwargs["headers"] = {"Content-Type": content_type or "application/octet-stream"}
+
+        user = identities.user_index(record["user"]) if record.get("user") else None
+        requests.append(ReplayRequest(
+            record["t"] - t0, f"{record['method']} {route}", record["method"], url, kwargs, user,
+            record.get("duration_ms", 0.0),
+        ))
+    return requests
+
+
+# --- 重播 ---
+async def replay(app, requests: List[ReplayRequest], user_count: int, args) -> Dict[str, Any]:
+    import httpx
+    from api.login import create_access_token
+
+    tokens = [create_access_token({"sub": f"doctor{i}"}) for i in range(user_count)]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    statuses: Dict[str, Counter] = defaultdict(Counter)
+    dispatch_lags: List[float] = []
+    probe = bench_load.ResourceProbe(args.probe_interval)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=args.timeout) as client:
+        async def send(item: ReplayRequest):
+            kwargs = dict(item.kwargs)
+            if item.user is not None:
+                kwargs["headers"] = {**kwargs.get("headers", {}), "Authorization": f"Bearer {tokens[item.user]}"}
+            start = time.perf_counter()
+            try:
+                response = await client.request(item.method, item.url, **kwargs)
+                statuses[item.key][response.status_code] += 1
+            except Exception:
+                statuses[item.key][0] += 1  # 連線錯誤或逾時
+            latencies[item.key].append((time.perf_counter() - start) * 1000)
+
+        probe.start()
+        tasks = []
+        start = time.perf_counter()
+        for item in requests:
+            due = item.offset / args.speed
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # 重播端來不及依時送出的程度；偏大時表示事件迴圈已飽和，結果不代表錄製時的到達模式
+            dispatch_lags.append(max(0.0, (time.perf_counter() - start - due) * 1000))
+            tasks.append(asyncio.create_task(send(item)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        await probe.stop()
+
+    captured: Dict[str, List[float]] = defaultdict(list)
+    for item in requests:
+        captured[item.key].append(item.captured_ms)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_statuses = sum(statuses.values(), Counter())
+    results = {"replay": bench_load.summarize(all_latencies, all_statuses, elapsed, probe.loop_lags, probe.rss_samples)}
+    results["replay"]["dispatch_lag_ms_p99"] = round(percentile(dispatch_lags, 99), 1)
+    results["replay"]["dispatch_lag_ms_max"] = round(max(dispatch_lags), 1)
+    for key in sorted(latencies, key=lambda k: -len(latencies[k])):
+        summary = bench_load.summarize(latencies[key], statuses[key], elapsed, probe.loop_lags, probe.rss_samples)
+        # 事件迴圈延遲與 RSS 為整個行程的量測，只列在 replay
+        results[key] = {k: v for k, v in summary.items() if not k.startswith(("loop_lag_", "rss_"))}
+        results[key]["captured_ms_p50"] = round(percentile(captured[key], 50), 1)
+        results[key]["captured_ms_p99"] = round(percentile(captured[key], 99), 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="依錄製的流量重播並比較版本間的延遲與吞吐量")
+    parser.add_argument("capture", help="TRAFFIC_CAPTURE_FILE 錄下的 JSONL 檔")
+    parser.add_argument("--speed", type=float, default=1.0, help="重播速度倍數 (4 表示以四倍速送出)")
+    parser.add_argument("--limit", type=int, help="只重播前 N 個請求")
+    bench_load.add_load_arguments(parser)
+    # 重播需可重現：模擬服務的延遲抽樣預設固定亂數種子
+    parser.set_defaults(seed=0, users=1)
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed 必須大於 0")
+
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        parser.error(f"{args.capture} 中沒有可重播的請求")
+    identities = Identities(records)
+    requests = build_requests(records, identities)
+    args.users = max(args.users, len(identities.users))
+    print(f"{len(requests)} 個請求，{len(identities.users)} 位使用者，錄製時長 {requests[-1].offset:.1f} 秒，"
+          f"以 {args.speed:g} 倍速重播", file=sys.stderr)
+
+    options = fake_services.options_from_args(args)
+    paths = bench_load.prepare_environment(args)
+    process, base_url = fake_services.start_fake_services(options)
+    try:
+        from main import app
+        bench_load.point_config_at(base_url, paths["workdir"])
+        scenarios = asyncio.run(replay(app, requests, args.users, args))
+    finally:
+        fake_services.stop_fake_services(process)
+        bench_load.cleanup_environment(paths)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+            "git_commit": bench_load.git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "capture": os.path.basename(args.capture),
+            "capture_digest": file_digest(args.capture),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": scenarios,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        baseline_meta = baseline.get("meta", {})
+        print(f"\n與 {args.compare} (commit {baseline_meta.get('git_commit')}) 比較：")
+        if baseline_meta.get("capture_digest") != report["meta"]["capture_digest"] or \
+                baseline_meta.get("args", {}).get("speed") != args.speed:
+            print("注意：兩次重播的錄製檔或速度不同，結果不可直接比較。")
+        print(bench_load.format_comparison(bench_load.compare_results(baseline, report), args.threshold))
+
+
+if __name__ == "__main__":
+    main()
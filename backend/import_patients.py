@@ -0,0 +1,42 @@
+# import_patients.py
+# 批次匯入 HIS 匯出的門診排程至病患資料庫 (與 POST /api/patients/import 相同的流程)
+#
+# 用法 (在 backend/ 目錄下)：
+#   python import_patients.py schedule.ndjson --user doctor1
+#   python import_patients.py schedule.csv --user doctor1 --batch-size 5000 --strict
+#   cat schedule.ndjson | python import_patients.py - --user doctor1 --format ndjson
+
+import sys
+import json
+import argparse
+
+from api import patient_import
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="批次匯入病患門診資料 (NDJSON / CSV)")
+    parser.add_argument("path", help="匯入檔案路徑，- 表示標準輸入")
+    parser.add_argument("--user", required=True, help="資料所屬的使用者帳號")
+    parser.add_argument("--format", choices=patient_import.SUPPORTED_FORMATS, help="未指定時依副檔名判斷")
+    parser.add_argument("--batch-size", type=int, default=patient_import.DEFAULT_BATCH_SIZE, help="每個交易寫入的筆數")
+    parser.add_argument("--strict", action="store_true", help="另需符合完整的 Patient (OPD.json) 模型")
+    args = parser.parse_args()
+
+    try:
+        fmt = patient_import.detect_format(None if args.path == "-" else args.path, args.format)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        return 2
+
+    if args.path == "-":
+        report = patient_import.import_stream(args.user, sys.stdin.buffer, fmt, args.batch_size, args.strict)
+    else:
+        with open(args.path, "rb") as f:
+            report = patient_import.import_stream(args.user, f, fmt, args.batch_size, args.strict)
+
+    print(json.dumps(report.model_dump(), ensure_ascii=False, indent=2))
+    return 1 if report.rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
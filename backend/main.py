@@ -3,13 +3,22 @@ from fastapi.middleware.cors import CORSMiddleware
 import sys
 import os
 
+# 日誌需在匯入各路由模組之前設定 (部分模組在匯入時即會記錄)
+from api.app_logging import setup_logging, shutdown_logging
+setup_logging()
+
 # 確保所有 router 都被正確匯入
 from api.user import router as user_router
 from api.login import router as login_router
-from api.patient import router as patient_router
+from api.patient import router as patient_router, flush_all_pending_patient_writes
+from api.patient_history import start_compaction_task, stop_compaction_task
+from api.password_hashing import shutdown_executor as shutdown_password_executor
 from api.icd import router as icd_router
 from api.chat import router as chat_router 
 from api.voice_api import router as voice_api_router
+from api.metrics import MetricsMiddleware, router as metrics_router
+from api.tracing import TracingMiddleware, shutdown_tracing
+from api.traffic_capture import TrafficCaptureMiddleware, shutdown_traffic_capture
 
 # --- 診斷性導入 template_router ---
 try:
@@ -44,7 +53,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 讓前端可讀取分頁游標、總筆數、ETag 與各階段耗時
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag", "Server-Timing"],
 )
+# 請求範圍的階段追蹤 (Server-Timing 標頭與選用的 OTLP/JSON 追蹤檔)
+app.add_middleware(TracingMiddleware)
+# 選用的流量錄製 (TRAFFIC_CAPTURE_FILE)，供 benchmarks/replay_traffic.py 重播
+app.add_middleware(TrafficCaptureMiddleware)
+# 最外層：請求延遲包含 CORS 處理與串流回應的傳送時間
+app.add_middleware(MetricsMiddleware)
 
 # --- 路由註冊 ---
 app.include_router(login_router, prefix="/auth", tags=["Authentication"])
@@ -54,6 +71,8 @@ app.include_router(icd_router, prefix="/api/icd", tags=["ICD"])
 app.include_router(chat_router, prefix="/api/chat", tags=["Chat"])
 # 確保這裡的 prefix 是 /api/voice
 app.include_router(voice_api_router, prefix="/api/voice", tags=["Voice"]) 
+# Prometheus 抓取端點
+app.include_router(metrics_router, tags=["Metrics"])
 
 # 只有在 template_router 被成功導入時才掛載
 if template_router:
@@ -62,6 +81,23 @@ else:
     print("[CRITICAL WARNING] template_router 未被成功導入，'Template' 相關功能將不可用。")
 
 
+# 啟動病患修訂歷史的背景壓縮
+@app.on_event("startup")
+async def start_background_tasks():
+    start_compaction_task()
+
+
+# 關閉前寫入仍在合併時間窗內的病患自動儲存
+@app.on_event("shutdown")
+async def flush_pending_writes():
+    await stop_compaction_task()
+    await flush_all_pending_patient_writes()
+    shutdown_password_executor()
+    shutdown_tracing()
+    shutdown_traffic_capture()
+    shutdown_logging()
+
+
 # 根目錄的測試端點，用於確認伺服器是否正常運行
 @app.get("/")
 def read_root():
@@ -1,7 +1,11 @@
 # models/chtno_patient_model.py
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional
-import re
+
+from models.objective_parser import default_parser
+from api.app_logging import get_logger, log_fields
+
+logger = get_logger("patient_model")
 
 class ChtnoICDXAssessment(BaseModel):
     ICDX: str
@@ -12,6 +16,23 @@ class ObjectiveDetail(BaseModel):
     value: str # 該細項的具體內容
     original_line: str # 儲存原始行，方便前端顯示和選擇
 
+
+def objective_details_from_text(text: Optional[str]) -> List[ObjectiveDetail]:
+    """將 Objective 文字解析為 ObjectiveDetail 列表"""
+    return [
+        ObjectiveDetail.model_construct(key=key, value=value, original_line=line)
+        for key, value, line in default_parser.parse(text)
+    ]
+
+
+def objective_details_from_texts(texts: List[Optional[str]]) -> List[List[ObjectiveDetail]]:
+    """批次版本，供大量匯入時一次解析多筆就診的 Objective"""
+    return [
+        [ObjectiveDetail.model_construct(key=key, value=value, original_line=line) for key, value, line in parsed]
+        for parsed in default_parser.parse_many(texts)
+    ]
+
+
 class ChtnoPatient(BaseModel):
     CHTNO: str
     NAME: str
@@ -38,7 +59,13 @@ class ChtnoPatient(BaseModel):
     # ============================================
 
     @classmethod
-    def from_opd_data(cls, opd_data: dict):
+    def from_opd_data(cls, opd_data: dict, trusted: bool = False, rejected: Optional[List[str]] = None):
+        """
+        將 OPD.json 格式的資料轉換為 ChtnoPatient。
+        trusted=True 表示這筆資料在寫入時已通過本方法的完整驗證，
+        此時以 model_construct 建立模型，略過 Pydantic 驗證。
+        無法解析的 ObjectiveDetails 項目會被略過；傳入 rejected 列表時，被略過項目的原因會附加到列表中。
+        """
         chtno_data = {}
         
         chtno_data["CHTNO"] = str(opd_data.get("CHTNO", ""))
@@ -76,11 +103,21 @@ class ChtnoPatient(BaseModel):
         if "ObjectiveDetails" in opd_data and isinstance(opd_data["ObjectiveDetails"], list):
             # 驗證並轉換為 ObjectiveDetail 列表
             parsed_details = []
-            for item in opd_data["ObjectiveDetails"]:
+            for index, item in enumerate(opd_data["ObjectiveDetails"]):
+                # 已驗證的紀錄仍需檢查項目結構：舊版寫入時可能在略過無效項目後被標記為已驗證
+                if trusted and _is_constructible_detail(item):
+                    parsed_details.append(ObjectiveDetail.model_construct(**item))
+                    continue
                 try:
                     parsed_details.append(ObjectiveDetail(**item))
                 except Exception as e:
-                    print(f"[WARNING] 無法解析 ObjectiveDetail 項目: {item}, 錯誤: {e}")
+                    # 項目內容為病歷資料，只記錄欄位名稱與錯誤類型
+                    reason = _describe_detail_error(e)
+                    logger.warning("略過無法解析的 ObjectiveDetail 項目", extra=log_fields(
+                        index=index, item_fields=sorted(item) if isinstance(item, dict) else type(item).__name__, error=reason,
+                    ))
+                    if rejected is not None:
+                        rejected.append(f"ObjectiveDetails[{index}]: {reason}")
             chtno_data["ObjectiveDetails"] = parsed_details
             chtno_data["Objective"] = "\r\n".join([d.original_line for d in parsed_details])
         else:
@@ -97,66 +134,59 @@ class ChtnoPatient(BaseModel):
             # 如果您需要基本資料也出現在 ObjectiveDetails 中，則需要更精細的判斷。
             # 目前，這些基本資訊應該已經在頂層屬性中。
 
-            # 2. 處理原始 OPD.json 的 Objective 文本內容，嘗試識別檢驗結果類型 (保持不變)
-            opd_raw_objective_text = opd_data.get("Objective", "").replace('\n', '\r\n')
-            
-            examination_patterns = {
-                "超音波 (Sono)": r"(?:sono|ultrasound|超音波):\s*(.*)",
-                "X光 (X-ray)": r"(?:x-ray|xray|X光):\s*(.*)",
-                "電腦斷層 (CT)": r"(?:CT|ct|電腦斷層):\s*(.*)",
-                "核磁共振 (MRI)": r"(?:MRI|mri|核磁共振):\s*(.*)",
-                "抽血 (Blood Test)": r"(?:blood test|lab results|抽血|血液檢查):\s*(.*)",
-                "病理報告 (Pathology)": r"(?:pathology|病理):\s*(.*)",
-            }
-
-            processed_lines_indices = set()
-            lines_from_raw_objective = opd_raw_objective_text.split('\r\n')
-
-            for i, line in enumerate(lines_from_raw_objective):
-                line_stripped = line.strip()
-                if not line_stripped:
-                    continue
-
-                matched_category = None
-                matched_value = None
-
-                for category, pattern in examination_patterns.items():
-                    match = re.match(pattern, line_stripped, re.IGNORECASE)
-                    if match:
-                        matched_category = category
-                        matched_value = match.group(1).strip()
-                        break
-
-                if matched_category:
-                    parsed_details.append(ObjectiveDetail(key=matched_category, value=matched_value, original_line=line_stripped))
-                    processed_lines_indices.add(i)
-
-            # 處理 Objective 中未被識別為特定檢查的普通文本
-            for i, line in enumerate(lines_from_raw_objective):
-                if i not in processed_lines_indices:
-                    line_stripped = line.strip()
-                    if line_stripped:
-                        # 避免將基本生命徵象等文本作為 "一般描述" 重複添加，如果它們已經在頂層字段中
-                        # 這裡需要一個更智能的過濾，以避免重複顯示。
-                        # 最好的做法是，如果 OPD.json 已經提供了 ObjectiveDetails，則直接使用。
-                        # 否則，從原始 Objective 文本中解析並創建 ObjectiveDetails
-                        # 但因為我們現在優先使用 ObjectiveDetails，且頂層資訊已處理，
-                        # 這裡可能只會捕捉到 "未分類" 的客觀描述。
-                        parsed_details.append(ObjectiveDetail(key="一般描述", value=line_stripped, original_line=line_stripped))
-            
+            # 2. 處理原始 OPD.json 的 Objective 文本內容，以 objective_parser 單次走訪識別檢查與生命徵象類別；
+            #    已識別的行在前，其餘歸為 "一般描述"。內容皆為解析器產生的字串，不需再經 Pydantic 驗證
+            parsed_details = objective_details_from_text(opd_data.get("Objective", ""))
             chtno_data["ObjectiveDetails"] = parsed_details
             chtno_data["Objective"] = "\r\n".join([d.original_line for d in parsed_details])
 
 
         # 轉換 Assessment 格式 (保持不變)
+        assessment_factory = ChtnoICDXAssessment.model_construct if trusted else ChtnoICDXAssessment
         transformed_assessment = []
         if "Assessment" in opd_data and isinstance(opd_data["Assessment"], list):
             for item in opd_data["Assessment"]:
                 if isinstance(item, dict) and "code" in item:
-                    transformed_assessment.append(ChtnoICDXAssessment(ICDX=item["code"], ICDX_NAME=item.get("name", "")))
+                    transformed_assessment.append(assessment_factory(ICDX=item["code"], ICDX_NAME=item.get("name", "")))
                 elif isinstance(item, dict) and "ICDX" in item:
-                    transformed_assessment.append(ChtnoICDXAssessment(ICDX=item["ICDX"], ICDX_NAME=item.get("ICDX_NAME", "")))
+                    transformed_assessment.append(assessment_factory(ICDX=item["ICDX"], ICDX_NAME=item.get("ICDX_NAME", "")))
 
         chtno_data["Assessment"] = transformed_assessment
         
+        if trusted:
+            # 略過驗證時仍需做與驗證相同的數值轉型 (例如 HEIGHT 的 int -> float)
+            for key, cast in _NUMERIC_FIELDS.items():
+                if chtno_data.get(key) is not None:
+                    chtno_data[key] = cast(chtno_data[key])
+            return cls.model_construct(**chtno_data)
         return cls(**chtno_data)
+
+
+# from_opd_data(trusted=True) 時需手動轉型的數值欄位
+_NUMERIC_FIELDS = {"AGE": int, "HEIGHT": float, "WEIGHT": float, "BMI": float, "PULSE": int}
+_DETAIL_FIELDS = ("key", "value", "original_line")
+
+
+def _is_constructible_detail(item) -> bool:
+    """免驗證建構的前提：三個欄位都存在且為字串"""
+    return isinstance(item, dict) and all(isinstance(item.get(field), str) for field in _DETAIL_FIELDS)
+
+
+def _describe_detail_error(e: Exception) -> str:
+    """只描述欄位與錯誤類型，不含項目內容"""
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(str(loc) for loc in err['loc'])}: {err['type']}" for err in e.errors())
+    return type(e).__name__
+
+
+def is_fully_valid(opd_data: dict) -> bool:
+    """
+    寫入前的完整驗證：可轉換為 ChtnoPatient 且沒有任何 ObjectiveDetails 項目被略過，
+    才可將紀錄標記為 validated (讀取時走 from_opd_data(trusted=True) 的免驗證路徑)。
+    """
+    rejected: List[str] = []
+    try:
+        ChtnoPatient.from_opd_data(opd_data, rejected=rejected)
+    except Exception:
+        return False
+    return not rejected
@@ -0,0 +1,106 @@
+# models/objective_parser.py
+# Objective 文字解析：將每一行歸類為檢查/生命徵象類別或「一般描述」。
+# 所有類別編譯成單一的具名群組交替式，每行只需一次比對，整段文字只走訪一次。
+
+import re
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+GENERAL_CATEGORY = "一般描述"
+
+# (類別名稱, 關鍵字的正規表示式片段)；順序即優先順序
+DEFAULT_CATEGORIES: List[Tuple[str, str]] = [
+    ("超音波 (Sono)", r"sono|ultrasound|超音波"),
+    ("X光 (X-ray)", r"x-ray|xray|X光"),
+    ("電腦斷層 (CT)", r"CT|電腦斷層"),
+    ("核磁共振 (MRI)", r"MRI|核磁共振"),
+    ("抽血 (Blood Test)", r"blood test|lab results|抽血|血液檢查"),
+    ("病理報告 (Pathology)", r"pathology|病理"),
+    # 模板中常見的生命徵象
+    ("身高 (Height)", r"height|身高"),
+    ("體重 (Weight)", r"weight|體重"),
+    ("身體質量指數 (BMI)", r"BMI"),
+    ("血壓 (BP)", r"BP|blood pressure|血壓"),
+    ("脈搏 (PR)", r"PR|pulse|脈搏"),
+]
+
+# 一筆解析結果：(類別, 冒號後的內容, 原始行)
+ParsedLine = Tuple[str, str, str]
+
+
+class ObjectiveParser:
+    """
+    可擴充的 Objective 解析器。register() 新增類別後，下次解析時重新編譯交替式。
+    行首為「關鍵字 + 冒號 (半形或全形)」者歸入該類別，其餘非空行歸入一般描述。
+    """
+
+    def __init__(self, categories: Optional[Iterable[Tuple[str, str]]] = None):
+        self._categories: List[Tuple[str, str]] = list(categories if categories is not None else DEFAULT_CATEGORIES)
+        # (編譯後的交替式, 類別群組名稱 -> (類別名稱, 內容群組名稱))；兩者一起替換，避免讀到不一致的組合
+        self._compiled_state: Optional[Tuple[Pattern, Dict[str, Tuple[str, str]]]] = None
+
+    @property
+    def categories(self) -> List[str]:
+        return [name for name, _ in self._categories]
+
+    def register(self, category: str, keyword_pattern: str) -> None:
+        """新增類別；若類別已存在則以新的關鍵字取代 (保留原本的優先順序)"""
+        for i, (name, _) in enumerate(self._categories):
+            if name == category:
+                self._categories[i] = (category, keyword_pattern)
+                break
+        else:
+            self._categories.append((category, keyword_pattern))
+        self._compiled_state = None
+
+    def _compiled(self) -> Tuple[Pattern, Dict[str, Tuple[str, str]]]:
+        state = self._compiled_state
+        if state is None:
+            alternatives = []
+            group_to_category = {}
+            for i, (name, keyword_pattern) in enumerate(self._categories):
+                # 內容群組包在類別群組內，類別群組最後結束，match.lastgroup 即為命中的類別
+                group_to_category[f"c{i}"] = (name, f"v{i}")
+                alternatives.append(f"(?P<c{i}>(?:{keyword_pattern})\\s*[:：]\\s*(?P<v{i}>.*))")
+            state = self._compiled_state = (re.compile("|".join(alternatives), re.IGNORECASE), group_to_category)
+        return state
+
+    def parse(self, text: Optional[str]) -> List[ParsedLine]:
+        """
+        解析一段 Objective 文字。結果中已歸類的行在前、一般描述在後，各自維持原始行序。
+        """
+        if not text:
+            return []
+        pattern, group_to_category = self._compiled()
+        matched: List[ParsedLine] = []
+        general: List[ParsedLine] = []
+        for line in text.split("\n"):
+            line_stripped = line.strip()
+            if not line_stripped:
+                continue
+            match = pattern.match(line_stripped)
+            if match:
+                category, value_group = group_to_category[match.lastgroup]
+                matched.append((category, match.group(value_group).strip(), line_stripped))
+            else:
+                general.append((GENERAL_CATEGORY, line_stripped, line_stripped))
+        return matched + general
+
+    def parse_many(self, texts: Iterable[Optional[str]]) -> List[List[ParsedLine]]:
+        """批次解析，供大量匯入時使用 (只編譯一次，避免逐筆的函式與模型開銷)"""
+        return [self.parse(text) for text in texts]
+
+
+default_parser = ObjectiveParser()
+
+
+def register_category(category: str, keyword_pattern: str) -> None:
+    """在預設解析器上註冊新類別"""
+    default_parser.register(category, keyword_pattern)
+
+
+def parse_objective(text: Optional[str]) -> List[ParsedLine]:
+    return default_parser.parse(text)
+
+
+def parse_objectives(texts: Iterable[Optional[str]]) -> List[List[ParsedLine]]:
+    return default_parser.parse_many(texts)
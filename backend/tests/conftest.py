@@ -0,0 +1,7 @@
+# tests/conftest.py
+# 讓測試以 backend/ 為根目錄匯入 api、models (與 main.py 相同)
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
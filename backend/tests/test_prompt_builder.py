@@ -0,0 +1,36 @@
+# tests/test_prompt_builder.py
+# 串流提前結束的判斷：範本最後一個欄位結束後才可停止，跨多行的欄位內容不可被截斷
+
+from api.prompt_builder import is_output_complete, plan_generation
+
+TEMPLATE = "Chief Complaint:[]\nHistory of Present Illness:[]\nPlan:[]"
+
+
+def plan():
+    return plan_generation(TEMPLATE, input_tokens=100, max_tokens_ceiling=1024)
+
+
+def test_single_line_final_field_completes_after_newline():
+    text = "Chief Complaint:[headache]\nHistory of Present Illness:[three days]\nPlan:[rest]\n"
+    assert is_output_complete(text, plan())
+
+
+def test_final_field_not_complete_before_newline():
+    text = "Chief Complaint:[headache]\nHistory of Present Illness:[three days]\nPlan:[rest]"
+    assert not is_output_complete(text, plan())
+
+
+def test_multi_line_final_field_waits_for_closing_bracket():
+    head = "Chief Complaint:[headache]\nHistory of Present Illness:[three days]\nPlan:[\n- rest\n"
+    assert not is_output_complete(head, plan())
+    assert not is_output_complete(head + "- acetaminophen 500 mg as needed\n", plan())
+    assert is_output_complete(head + "- acetaminophen 500 mg as needed\n- follow up in one week]\n", plan())
+
+
+def test_unbracketed_final_field_never_stops_early():
+    text = "Chief Complaint:[headache]\nHistory of Present Illness:[three days]\nPlan: rest\n- fluids\n"
+    assert not is_output_complete(text, plan())
+
+
+def test_template_without_bracketed_last_line_disables_early_stop():
+    assert plan_generation("Chief Complaint:[]\nPlan:", 10, 1024).last_line_header is None